@@ -0,0 +1,66 @@
+"""Throughput and peak memory of batch scoring (`src.batch_scoring`) on a synthetic raw DVF file, with and without
+overlapping stages, at several chunk sizes. The vocabulary of the file is read beforehand, as with --vocabulary, so
+runs measure a single pass over the file.
+
+Usage (from the repository root):
+    python -m benchmarks.batch_scoring_benchmark --n-rows 1000000 --chunksizes 20000 100000
+"""
+import argparse
+import json
+import os
+import tempfile
+
+from lightgbm import LGBMRegressor
+
+import src.batch_scoring as batch_scoring
+import src.compiled_pipeline as compiled
+import src.constants as cst
+import src.instrumentation as instrumentation
+import src.pipeline as pipe
+import src.preprocessing as prep
+import src.serving as serving
+from benchmarks import synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-rows', type=int, default=500000, help='raw rows of the file to score')
+    parser.add_argument('--chunksizes', type=int, nargs='+', default=[cst.batch_scoring_chunk_size])
+    parser.add_argument('--n-train-rows', type=int, default=20000)
+    parser.add_argument('--output', help='optional path of a JSON file with the results')
+    args = parser.parse_args()
+
+    features = pipe.get_features_from_dict(synthetic.FEATURES_DICT)
+    train = synthetic.make_housing_data(args.n_train_rows)
+    pipeline = pipe.build_pipeline(LGBMRegressor(n_estimators=300, random_state=cst.random_seed, verbose=-1), synthetic.FEATURES_DICT)
+    pipeline = compiled.compile_pipeline(pipeline.fit(train[features], train['valeur'] / train['surface_reelle_bati']))
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        input_path, output_path = os.path.join(directory, 'dvf_test.csv'), os.path.join(directory, 'predictions.csv')
+        raw_test = synthetic.make_raw_dvf_data(args.n_rows, is_train=False, seed=1)
+        raw_test.to_csv(input_path)
+        context = serving.build_enrichment_context(
+            synthetic.make_transports(), synthetic.make_revenus(), raw_test.rename(columns=cst.column_names_mapping)
+        )
+        del raw_test
+        vocabulary = prep.get_raw_housing_vocabulary([input_path], is_train=False)
+
+        for chunksize in args.chunksizes:
+            for overlap in [False, True]:
+                is_peak_reset = instrumentation.reset_peak_rss()
+                rss_before = instrumentation.get_rss_mb()
+                report = batch_scoring.score_file(
+                    input_path, output_path, pipeline, features, context, chunksize, overlap, vocabulary=vocabulary
+                )
+                peak_rss_increase_mb = max(0.0, instrumentation.get_peak_rss_mb() - rss_before) if is_peak_reset else None
+                results.append({'chunksize': chunksize, 'overlap': overlap, 'peak_rss_increase_mb': peak_rss_increase_mb} | report)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
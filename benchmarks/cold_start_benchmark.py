@@ -0,0 +1,102 @@
+"""Cold start of a scoring worker: time to import the scoring modules, load a model and make a first prediction, in
+a new Python process, for a pickled pipeline (compiled after unpickling) and for a model artifact (`src.artifacts`).
+
+Each stage is the median over several processes, and `total` is the wall time of the process (interpreter startup
+included). The benchmark fails if the predictions of the artifact differ from those of the pipeline. Results are
+written in the format of `benchmarks.pipeline_benchmark`, so that cold start can be tracked across commits with
+`benchmarks.compare_results` (peak memory is the peak resident memory of the worker process).
+
+Usage (from the repository root):
+    python -m benchmarks.cold_start_benchmark --repeats 5 --output cold_start.json
+"""
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from lightgbm import LGBMRegressor
+
+import src.artifacts as artifacts
+import src.constants as cst
+import src.pipeline as pipe
+from benchmarks import synthetic
+from benchmarks.pipeline_benchmark import get_metadata
+
+# Code run by each worker process, with the model path and a JSON record as arguments
+WORKER_CODE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import pandas as pd
+import src.artifacts as artifacts
+import src.serving as serving
+imported = time.perf_counter()
+model = artifacts.load_model(sys.argv[1])
+loaded = time.perf_counter()
+model.predict(pd.DataFrame(json.loads(sys.argv[2]))[artifacts.get_model_features(model)])
+predicted = time.perf_counter()
+print(json.dumps({
+    'import': imported - start, 'load': loaded - imported, 'first_prediction': predicted - loaded,
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+'''
+
+
+def run_worker(model_path: str, record: str) -> dict:
+    """Run a worker process and get the time of each stage, its total wall time and its peak memory."""
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', WORKER_CODE, model_path, record], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1]) | {'total': time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5, help='worker processes per model format')
+    parser.add_argument('--n-estimators', type=int, default=300)
+    parser.add_argument('--n-train-rows', type=int, default=20000)
+    parser.add_argument('--output', help='optional path of a JSON file with the results')
+    args = parser.parse_args()
+
+    # Target encoded type_voie has missing values, so artifacts are checked on missing categories
+    features_dict = synthetic.FEATURES_DICT | {'target_encoded': ['type_voie']}
+    features = pipe.get_features_from_dict(features_dict)
+    train = synthetic.make_housing_data(args.n_train_rows)
+    test = synthetic.make_housing_data(1000, seed=1)
+    pipeline = pipe.build_pipeline(LGBMRegressor(n_estimators=args.n_estimators, random_state=cst.random_seed, verbose=-1), features_dict)
+    pipeline.fit(train[features], train['valeur'] / train['surface_reelle_bati'])
+    record = test[features].iloc[:1]
+
+    results = {'metadata': get_metadata(), 'parameters': vars(args), 'results': []}
+    with tempfile.TemporaryDirectory() as directory:
+        model_paths = {'pickle': os.path.join(directory, 'model.sav'), 'artifact': os.path.join(directory, 'model')}
+        with open(model_paths['pickle'], 'wb') as f:
+            pickle.dump(pipeline, f)
+        artifacts.save_model_artifact(pipeline, model_paths['artifact'])
+        results['max_prediction_difference'] = float(np.max(np.abs(
+            artifacts.load_model(model_paths['artifact']).predict(test[features]) - pipeline.predict(test[features])
+        )))
+        if results['max_prediction_difference'] != 0:
+            sys.exit(f'Artifact predictions differ from the pipeline predictions by up to {results["max_prediction_difference"]}')
+
+        for model_format, model_path in model_paths.items():
+            runs = [run_worker(model_path, record.to_json(orient='records')) for _ in range(args.repeats)]
+            for stage in ['import', 'load', 'first_prediction', 'total']:
+                results['results'].append({
+                    'n_rows': 1,
+                    'stage': f'{model_format}_{stage}',
+                    'seconds': float(np.median([run[stage] for run in runs])),
+                    'peak_rss_increase_mb': float(np.median([run['peak_rss_mb'] for run in runs])),
+                })
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Compare two result files of `benchmarks.pipeline_benchmark` (e.g. from two commits), stage by stage.
+
+Exits with status 1 if a stage got slower than the threshold ratio, so that it can be used as a regression check.
+
+Usage (from the repository root):
+    python -m benchmarks.compare_results baseline.json results.json --threshold 1.2
+"""
+import argparse
+import json
+import sys
+
+import pandas as pd
+
+
+def read_results(path: str) -> pd.DataFrame:
+    """Read the stage results of a benchmark file, indexed by number of rows and stage."""
+    with open(path) as f:
+        return pd.DataFrame(json.load(f)['results']).set_index(['n_rows', 'stage'])
+
+
+def compare_results(baseline: pd.DataFrame, results: pd.DataFrame) -> pd.DataFrame:
+    """Join the stages of two benchmark runs and compute time ratios and memory differences.
+
+    Args:
+        baseline (pd.DataFrame): baseline results (see `read_results`).
+        results (pd.DataFrame): new results.
+
+    Returns:
+        pd.DataFrame: seconds and peak memory of both runs, time ratio and memory difference by stage
+    """
+    comparison = baseline[['seconds', 'peak_rss_increase_mb']].join(
+        results[['seconds', 'peak_rss_increase_mb']], how='inner', lsuffix='_baseline', rsuffix='_new'
+    )
+    comparison['time_ratio'] = comparison['seconds_new'] / comparison['seconds_baseline']
+    comparison['memory_difference_mb'] = comparison['peak_rss_increase_mb_new'] - comparison['peak_rss_increase_mb_baseline']
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline', help='baseline result file')
+    parser.add_argument('results', help='new result file')
+    parser.add_argument('--threshold', type=float, default=1.2, help='time ratio above which a stage is a regression')
+    args = parser.parse_args()
+
+    comparison = compare_results(read_results(args.baseline), read_results(args.results))
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.3f}'.format):
+        print(comparison)
+
+    regressions = comparison[comparison['time_ratio'] > args.threshold]
+    if not regressions.empty:
+        print(f'\n{len(regressions)} stage(s) slower than {args.threshold}x the baseline:')
+        print('\n'.join(f'  {n_rows} rows - {stage}' for n_rows, stage in regressions.index))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Compare the predictions and latency of a fitted pipeline and its compiled plan on small batches.
+Exits with status 1 if the predictions are not identical (the synthetic data include missing categories).
+
+Usage (from the repository root):
+    python -m benchmarks.compiled_pipeline_benchmark --batch-sizes 1 10 100
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+from lightgbm import LGBMRegressor
+
+import src.compiled_pipeline as compiled
+import src.constants as cst
+import src.pipeline as pipe
+from benchmarks import synthetic
+
+
+def time_predict(predict, X, n_repeats: int) -> float:
+    """Median latency of a predict function in milliseconds."""
+    predict(X)  # warm-up
+    latencies = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        predict(X)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--n-repeats', type=int, default=200)
+    parser.add_argument('--n-train-rows', type=int, default=20000)
+    parser.add_argument('--n-test-rows', type=int, default=5000)
+    parser.add_argument('--output', help='optional path of a JSON file with the results')
+    args = parser.parse_args()
+
+    features_dict = synthetic.FEATURES_DICT | {'target_encoded': ['type_voie']}
+    features = pipe.get_features_from_dict(features_dict)
+    train = synthetic.make_housing_data(args.n_train_rows)
+    test = synthetic.make_housing_data(args.n_test_rows, seed=1)
+
+    pipeline = pipe.build_pipeline(LGBMRegressor(n_estimators=300, random_state=cst.random_seed, verbose=-1), features_dict)
+    pipeline.fit(train[features], train['valeur'] / train['surface_reelle_bati'])
+    compiled_pipeline = compiled.compile_pipeline(pipeline)
+
+    predictions = pipeline.predict(test[features])
+    compiled_predictions = compiled_pipeline.predict(test[features])
+    results = {
+        'identical_predictions': bool(np.array_equal(predictions, compiled_predictions)),
+        'max_abs_difference': float(np.abs(predictions - compiled_predictions).max()),
+        'latency_ms': [],
+    }
+    for batch_size in args.batch_sizes:
+        X = test[features].iloc[:batch_size]
+        pipeline_ms = time_predict(pipeline.predict, X, args.n_repeats)
+        compiled_ms = time_predict(compiled_pipeline.predict, X, args.n_repeats)
+        results['latency_ms'].append({
+            'batch_size': batch_size, 'pipeline': pipeline_ms, 'compiled': compiled_ms, 'speedup': pipeline_ms / compiled_ms,
+        })
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not results['identical_predictions']:
+        sys.exit('Compiled predictions differ from the pipeline predictions')
+
+
+if __name__ == '__main__':
+    main()
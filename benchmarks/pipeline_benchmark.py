@@ -0,0 +1,178 @@
+"""Time and memory profile of every stage of the pipeline on synthetic DVF data, at one or several scales.
+
+Stages run in order on the output of the previous one: prepare_housing_data, preprocess_housing_data, station counts,
+IRIS revenue, pipeline fit and predict. For each stage, the results report elapsed time and the increase of peak
+resident memory during the stage, and the memory per row of the datasets it outputs. Results are written as JSON
+together with the commit and library versions, to be compared across commits with `benchmarks.compare_results`.
+With --trace, the run is instrumented (see `src.instrumentation`) and a Chrome trace of every instrumented call is
+written as well.
+
+Usage (from the repository root):
+    python -m benchmarks.pipeline_benchmark --n-rows 10000 100000 1000000 --output results.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import lightgbm
+import numpy as np
+import pandas as pd
+import sklearn
+from lightgbm import LGBMRegressor
+
+import src.constants as cst
+import src.instrumentation as instrumentation
+import src.pipeline as pipe
+import src.preprocessing as prep
+import src.schema as schema
+import src.external_data.external_geo_data as ext_geo
+import src.external_data.external_insee_data as ext_insee
+from benchmarks import synthetic
+
+
+def measure_stage(results: list, stage: str, n_rows: int, stage_rows: int, func, *args):
+    """Run a stage on stage_rows rows (of a scale of n_rows raw rows), append its time and memory profile to results
+    and return its output."""
+    is_peak_reset = instrumentation.reset_peak_rss()
+    rss_before = instrumentation.get_rss_mb()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr):
+        output = func(*args)
+    elapsed = time.perf_counter() - start
+
+    results.append({
+        'n_rows': n_rows,
+        'stage': stage,
+        'stage_rows': stage_rows,
+        'seconds': elapsed,
+        'rows_per_second': stage_rows / elapsed,
+        # Without a peak reset, the increase is relative to the peak of previous stages (a lower bound)
+        'peak_rss_increase_mb': max(0.0, instrumentation.get_peak_rss_mb() - rss_before) if is_peak_reset else None,
+        'rss_after_mb': instrumentation.get_rss_mb(),
+        'bytes_per_row': get_bytes_per_row(output),
+    })
+    print(f'{n_rows} rows - {stage}: {elapsed:.2f}s', file=sys.stderr)
+    return output
+
+
+def get_bytes_per_row(output) -> float:
+    """Memory per row of the datasets output by a stage (see `schema.get_memory_per_row`), None for other outputs."""
+    datasets = [value for value in (output if isinstance(output, tuple) else [output]) if isinstance(value, pd.DataFrame)]
+    if not datasets:
+        return None
+    return sum(schema.get_memory_per_row(data) * data.shape[0] for data in datasets) / max(sum(data.shape[0] for data in datasets), 1)
+
+
+def run_stages(n_rows: int, test_share: float, n_stations: int, n_estimators: int, seed: int, n_workers: int = 1) -> list:
+    """Generate a synthetic train/test split of n_rows raw DVF rows and profile every stage on it."""
+    n_test_rows = int(n_rows * test_share)
+    raw_train = synthetic.make_raw_dvf_data(n_rows - n_test_rows, is_train=True, seed=seed)
+    raw_test = synthetic.make_raw_dvf_data(n_test_rows, is_train=False, seed=seed + 1)
+    transports = synthetic.make_transports(n_stations, seed=seed)
+    revenus = synthetic.make_revenus(seed=seed)
+
+    features_dict = synthetic.FEATURES_DICT | {'target_encoded': ['type_voie']}
+    features = pipe.get_features_from_dict(features_dict)
+    pipeline = pipe.build_pipeline(LGBMRegressor(n_estimators=n_estimators, random_state=cst.random_seed, verbose=-1), features_dict)
+
+    def prepare():
+        return prep.prepare_housing_data(raw_train, is_train=True), prep.prepare_housing_data(raw_test, is_train=False)
+
+    def preprocess(train, test):
+        vocabulary = schema.get_housing_vocabulary(train, test)
+        return prep.preprocess_housing_data(train, True, vocabulary), prep.preprocess_housing_data(test, False, vocabulary)
+
+    def fit(train):
+        return pipeline.fit(train[features], train[cst.raw_target_col] / train['surface_reelle_bati'])
+
+    results = []
+    train, test = measure_stage(results, 'prepare', n_rows, n_rows, prepare)
+    del raw_train, raw_test
+    train, test = measure_stage(results, 'preprocess', n_rows, n_rows, preprocess, train, test)
+
+    n_preprocessed_rows = train.shape[0] + test.shape[0]
+    train, test = measure_stage(
+        results, 'station_counts', n_rows, n_preprocessed_rows,
+        ext_geo.count_close_stations_all_housing_units_in_train_test, train, test, transports, None, n_workers
+    )
+    # Speedups of the station counts are only comparable between runs with the same workers and cores
+    results[-1] |= {'n_workers': n_workers or os.cpu_count(), 'available_cpu_count': get_available_cpu_count()}
+    train, test = measure_stage(
+        results, 'iris_revenue', n_rows, n_preprocessed_rows, ext_insee.add_external_insee_revenue_data, train, test, revenus
+    )
+    measure_stage(results, 'fit', n_rows, train.shape[0], fit, train)
+    measure_stage(results, 'predict', n_rows, test.shape[0], pipeline.predict, test[features])
+    return results
+
+
+def get_metadata() -> dict:
+    """Commit, library versions and machine of a benchmark run."""
+    def run_git(*args):
+        try:
+            return subprocess.run(['git', *args], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        'commit': run_git('rev-parse', 'HEAD'),
+        'is_dirty': bool(run_git('status', '--porcelain', '--untracked-files=no')),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'available_cpu_count': get_available_cpu_count(),
+        'versions': {
+            'numpy': np.__version__, 'pandas': pd.__version__, 'sklearn': sklearn.__version__, 'lightgbm': lightgbm.__version__,
+        },
+    }
+
+
+def get_available_cpu_count() -> int:
+    """Number of cores the process may run on (lower than the CPU count with affinity masks or container limits)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-rows', type=int, nargs='+', default=[10000, 100000], help='raw rows (train + test) per scale')
+    parser.add_argument('--test-share', type=float, default=0.25)
+    parser.add_argument('--n-stations', type=int, default=1000)
+    parser.add_argument('--n-estimators', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n-workers', type=int, default=1, help='processes of the station-count stage (0 for all CPUs)')
+    parser.add_argument('--output', help='optional path of a JSON file with the results')
+    parser.add_argument('--trace', help='optional path of a Chrome trace of the instrumented functions (adds overhead)')
+    args = parser.parse_args()
+
+    if args.trace:
+        instrumentation.enable()
+
+    results = {'metadata': get_metadata(), 'parameters': vars(args), 'results': []}
+    print(
+        f"{results['metadata']['available_cpu_count']} of {results['metadata']['cpu_count']} cores available, "
+        f"station counts with {args.n_workers or os.cpu_count()} workers", file=sys.stderr
+    )
+    for n_rows in args.n_rows:
+        results['results'] += run_stages(n_rows, args.test_share, args.n_stations, args.n_estimators, args.seed, args.n_workers or None)
+
+    if args.trace:
+        trace = instrumentation.disable()
+        trace.write_chrome_trace(args.trace)
+        results['counters'] = trace.counters
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Load generator for the prediction service: throughput and latency percentiles by number of concurrent clients.
+
+The service runs in a separate process with a LightGBM pipeline fitted on synthetic data, and clients send single
+records over persistent HTTP connections.
+
+Usage (from the repository root):
+    python -m benchmarks.serving_benchmark --concurrency 1 8 32 --n-requests 2000
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import threading
+import time
+
+import numpy as np
+from lightgbm import LGBMRegressor
+
+import src.compiled_pipeline as compiled
+import src.constants as cst
+import src.pipeline as pipe
+import src.serving as serving
+from benchmarks import synthetic
+
+
+def run_server(port_queue, max_batch_size: int, n_train_rows: int, compile_pipeline: bool = True):
+    """Fit a pipeline on synthetic data and serve it until the process is terminated."""
+    train = synthetic.make_housing_data(n_train_rows)
+    features = pipe.get_features_from_dict(synthetic.FEATURES_DICT)
+    pipeline = pipe.build_pipeline(LGBMRegressor(n_estimators=300, random_state=cst.random_seed), synthetic.FEATURES_DICT)
+    pipeline.fit(train[features], train['valeur'] / train['surface_reelle_bati'])
+    if compile_pipeline:
+        pipeline = compiled.compile_pipeline(pipeline)
+
+    reference_data = synthetic.make_raw_dvf_data(n_train_rows, is_train=False).rename(columns=cst.column_names_mapping)
+    context = serving.build_enrichment_context(synthetic.make_transports(), synthetic.make_revenus(), reference_data)
+
+    server = serving.create_server(pipeline, features, context, port=0, max_batch_size=max_batch_size)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def run_client(port: int, bodies: list, latencies: list):
+    """Send requests one after the other on a persistent connection and record their latencies."""
+    connection = http.client.HTTPConnection(cst.serving_host, port)
+    for body in bodies:
+        start = time.perf_counter()
+        connection.request('POST', '/predict', body=body, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            raise RuntimeError(f'request failed with status {response.status}')
+    connection.close()
+
+
+def run_load(port: int, records: list, concurrency: int, n_requests: int) -> dict:
+    """Run n_requests single-record requests spread over concurrent clients."""
+    bodies = [json.dumps(records[i % len(records)]).encode() for i in range(n_requests)]
+    latencies = [[] for _ in range(concurrency)]
+    clients = [
+        threading.Thread(target=run_client, args=(port, bodies[client::concurrency], latencies[client]))
+        for client in range(concurrency)
+    ]
+
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.concatenate([np.array(client_latencies) for client_latencies in latencies]) * 1000
+    return {
+        'concurrency': concurrency,
+        'n_requests': len(latencies_ms),
+        'throughput_rps': len(latencies_ms) / elapsed,
+        'latency_ms': {
+            'mean': float(latencies_ms.mean()),
+            'p50': float(np.percentile(latencies_ms, 50)),
+            'p95': float(np.percentile(latencies_ms, 95)),
+            'p99': float(np.percentile(latencies_ms, 99)),
+            'max': float(latencies_ms.max()),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--n-requests', type=int, default=2000)
+    parser.add_argument('--max-batch-size', type=int, default=cst.serving_max_batch_size)
+    parser.add_argument('--n-train-rows', type=int, default=20000)
+    parser.add_argument('--no-compile', action='store_true', help='score with the sklearn pipeline instead of its compiled plan')
+    parser.add_argument('--output', help='optional path of a JSON file with the results')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    port_queue = context.Queue()
+    server_process = context.Process(target=run_server, args=(port_queue, args.max_batch_size, args.n_train_rows, not args.no_compile), daemon=True)
+    server_process.start()
+
+    try:
+        port = port_queue.get(timeout=300)
+        records = synthetic.make_records(1000, seed=1)
+        run_load(port, records, concurrency=1, n_requests=50)  # warm-up
+        results = [run_load(port, records, concurrency, args.n_requests) for concurrency in args.concurrency]
+    finally:
+        server_process.terminate()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Accuracy and throughput of the precomputed spatial feature grid (`serving.build_enrichment_grid`) against exact
+enrichment with the station and IRIS indexes, on synthetic data at several cell sizes.
+
+Usage (from the repository root):
+    python -m benchmarks.spatial_grid_benchmark --n-rows 200000 --cell-sizes 10 25 50
+"""
+import argparse
+import json
+import tempfile
+
+import src.constants as cst
+import src.serving as serving
+from benchmarks import synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-rows', type=int, default=200000, help='reference housing units')
+    parser.add_argument('--cell-sizes', type=float, nargs='+', default=[cst.spatial_grid_cell_size_m], help='cell sides in meters')
+    parser.add_argument('--output', help='optional path of a JSON file with the results')
+    args = parser.parse_args()
+
+    reference_data = synthetic.make_raw_dvf_data(args.n_rows, is_train=False, seed=1).rename(columns=cst.column_names_mapping)
+    context = serving.build_enrichment_context(synthetic.make_transports(), synthetic.make_revenus(), reference_data)
+
+    results = []
+    for cell_size_m in args.cell_sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            report = serving.build_enrichment_grid(context, reference_data, directory, cst.spatial_grid_bounds, cell_size_m)
+        results.append(report | {'speedup': report['grid_rows_per_second'] / report['exact_rows_per_second']})
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Compare load time and memory of the training set stored as CSV vs Feather with column projection.
+
+Usage (from the repository root):
+    python -m benchmarks.storage_benchmark --n-rows 1000000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+import src.instrumentation as instrumentation
+import src.storage as storage
+from benchmarks.synthetic import FEATURES_DICT, make_housing_data
+
+
+def measure_load(load, path: str, queue):
+    """Load a dataset in a fresh process and report elapsed time, peak RSS increase and dataframe size."""
+    rss_before = instrumentation.get_peak_rss_mb()
+    start = time.perf_counter()
+    data = load(path)
+    elapsed = time.perf_counter() - start
+    queue.put({
+        'seconds': elapsed,
+        'peak_rss_increase_mb': instrumentation.get_peak_rss_mb() - rss_before,
+        'dataframe_mb': data.memory_usage(deep=True).sum() / 1024 ** 2,
+    })
+
+
+def load_csv(path: str) -> pd.DataFrame:
+    return pd.read_csv(path, index_col=0)
+
+
+def load_feather_features(path: str) -> pd.DataFrame:
+    return storage.read_housing_features(path, FEATURES_DICT, extra_columns=['valeur'])
+
+
+def run_in_fresh_process(load, path: str) -> dict:
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure_load, args=(load, path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-rows', type=int, default=1000000)
+    parser.add_argument('--output', help='optional path of a JSON file with the results')
+    args = parser.parse_args()
+
+    data = make_housing_data(args.n_rows)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'train.csv')
+        feather_path = os.path.join(tmp_dir, 'train.feather')
+        data.to_csv(csv_path, index=True)
+        storage.write_housing_data(data, feather_path)
+
+        results = {
+            'n_rows': args.n_rows,
+            'csv': run_in_fresh_process(load_csv, csv_path) | {'file_mb': os.path.getsize(csv_path) / 1024 ** 2},
+            'feather_projected': run_in_fresh_process(load_feather_features, feather_path) | {'file_mb': os.path.getsize(feather_path) / 1024 ** 2},
+        }
+
+    results['load_speedup'] = results['csv']['seconds'] / results['feather_projected']['seconds']
+    results['memory_reduction'] = results['csv']['dataframe_mb'] / results['feather_projected']['dataframe_mb']
+    results['peak_rss_reduction'] = results['csv']['peak_rss_increase_mb'] / max(results['feather_projected']['peak_rss_increase_mb'], 1)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
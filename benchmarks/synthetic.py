@@ -0,0 +1,159 @@
+"""Synthetic DVF-shaped datasets and external data fixtures, to run benchmarks offline.
+Generation is vectorized and repeated labels share the same string objects, so datasets of 10M rows can be built."""
+import numpy as np
+import pandas as pd
+
+# Bounding box of Paris
+LAT_RANGE = (48.815, 48.902)
+LON_RANGE = (2.225, 2.42)
+
+N_DISTRICTS = 80
+N_IRIS = 900
+
+FEATURES_DICT = {
+    'min_max_scaled': ['date_mutation', 'lat', 'lon', 'n_metros_within_0.5km', 'n_trains_within_0.5km'],
+    'standard_scaled': ['surface_carrez_1er_lot', 'surface_carrez_2e_lot', 'surface_reelle_bati'],
+    'one_hot_encoded': ['commune'],
+    'target_encoded': [],
+    'count_freq_encoded': ['district'],
+    'unprocessed': ['nb_lots', 'nb_pieces'],
+}
+
+
+def make_locations(n_rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Random housing locations in Paris, with the district, IRIS code and commune of each location.
+    Districts and IRIS zones are cells of regular grids over the bounding box of Paris."""
+    lat = rng.uniform(*LAT_RANGE, n_rows)
+    lon = rng.uniform(*LON_RANGE, n_rows)
+
+    lat_share = (lat - LAT_RANGE[0]) / (LAT_RANGE[1] - LAT_RANGE[0])
+    lon_share = (lon - LON_RANGE[0]) / (LON_RANGE[1] - LON_RANGE[0])
+    district = (np.minimum(lat_share * 8, 7).astype(int) * 10 + np.minimum(lon_share * 10, 9).astype(int))
+    iris = (np.minimum(lat_share * 30, 29).astype(int) * 30 + np.minimum(lon_share * 30, 29).astype(int))
+    arrondissement = district % 20 + 1
+
+    return pd.DataFrame({
+        'lat': lat,
+        'lon': lon,
+        'district': get_labels('Quartier {}', range(N_DISTRICTS))[district],
+        'code_iris': 751000000 + iris * 101,
+        'commune': get_labels('Paris {}e Arrondissement', range(21))[arrondissement],
+    })
+
+
+def get_labels(template: str, codes) -> np.ndarray:
+    """Array of string labels by code, indexed to build columns whose cells share the same string objects."""
+    return np.array([template.format(code) for code in codes], dtype=object)
+
+
+def choose(labels: list, n_rows: int, rng: np.random.Generator, p: list = None) -> np.ndarray:
+    """Random labels (object array sharing one string object per label)."""
+    return np.array(labels, dtype=object)[rng.choice(len(labels), n_rows, p=p)]
+
+
+def to_french_decimals(values: np.ndarray) -> pd.Series:
+    """Format floats as strings with a comma decimal separator (missing values stay missing)."""
+    values = pd.Series(values).round(2)
+    return values.astype(str).str.replace('.', ',', regex=False).where(values.notna())
+
+
+def make_raw_dvf_data(n_rows: int, is_train: bool = True, seed: int = 0) -> pd.DataFrame:
+    """Random raw DVF dataset with the columns selected by `prepare_housing_data` and a few unused ones."""
+    rng = np.random.default_rng(seed)
+    locations = make_locations(n_rows, rng)
+    surface = rng.uniform(10, 150, n_rows).round()
+
+    data = pd.DataFrame({
+        'Code service CH': np.nan,
+        'No disposition': 1,
+        'Date mutation': rng.integers(0, 1800, n_rows),
+        'Nature mutation': choose(['Vente', 'Echange', 'Adjudication'], n_rows, rng, p=[0.96, 0.02, 0.02]),
+        'Type de voie': choose(['RUE', 'AV', 'BD', 'PL', 'QUAI', None], n_rows, rng),
+        'Commune': locations['commune'],
+        'Surface Carrez du 1er lot': to_french_decimals(np.where(rng.random(n_rows) < 0.3, np.nan, surface - rng.uniform(0, 5, n_rows))),
+        'Surface Carrez du 2eme lot': to_french_decimals(np.where(rng.random(n_rows) < 0.9, np.nan, rng.uniform(1, 20, n_rows))),
+        'Nombre de lots': rng.integers(1, 4, n_rows),
+        'Type local': choose(['Appartement', 'Maison'], n_rows, rng, p=[0.97, 0.03]),
+        'Surface reelle bati': surface,
+        'Nombre pieces principales': rng.integers(0, 7, n_rows).astype(float),
+        'lon': locations['lon'],
+        'lat': locations['lat'],
+        'code_IRIS': locations['code_iris'].astype(float),
+        'code_district_custom': locations['district'].where(rng.random(n_rows) > 0.005),
+        'Valeur fonciere': to_french_decimals(surface * rng.uniform(7000, 15000, n_rows)),
+    })
+    if not is_train:
+        data = data.drop(columns=['Valeur fonciere'])
+
+    return data.rename_axis('index')
+
+
+def make_housing_data(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """Random enriched housing dataset with the columns of the training set after the external data stage."""
+    rng = np.random.default_rng(seed)
+    locations = make_locations(n_rows, rng)
+    surface = rng.uniform(10, 150, n_rows).round()
+
+    return pd.DataFrame({
+        'date_mutation': rng.integers(0, 1800, n_rows),
+        'nature_mutation': 'Vente',
+        'type_voie': choose(['RUE', 'AV', 'BD', 'PL', 'QUAI', None], n_rows, rng),
+        'commune': locations['commune'],
+        'surface_carrez_1er_lot': surface - rng.uniform(0, 5, n_rows).round(2),
+        'surface_carrez_2e_lot': np.where(rng.random(n_rows) < 0.9, 0, rng.uniform(1, 20, n_rows).round(2)),
+        'nb_lots': rng.integers(1, 4, n_rows),
+        'type_local': choose(['Appartement', 'Maison'], n_rows, rng, p=[0.97, 0.03]),
+        'surface_reelle_bati': surface,
+        'nb_pieces': rng.integers(1, 7, n_rows).astype(float),
+        'lon': locations['lon'],
+        'lat': locations['lat'],
+        'district': locations['district'],
+        'n_metros_within_0.5km': rng.integers(0, 12, n_rows),
+        'n_trains_within_0.5km': rng.integers(0, 6, n_rows),
+        'med_revenue_iris_2018': rng.uniform(15000, 60000, n_rows).round(),
+        'valeur': surface * rng.uniform(7000, 15000, n_rows).round(),
+    }).rename_axis('index')
+
+
+def make_records(n_rows: int, seed: int = 0) -> list:
+    """Random housing records as sent to the prediction service (renamed DVF columns, French decimals)."""
+    data = make_raw_dvf_data(n_rows, is_train=False, seed=seed).dropna(subset=['code_district_custom'])
+    data = data.drop(columns=['Code service CH', 'No disposition', 'Nature mutation'])
+    data = data.rename(columns={
+        'Date mutation': 'date_mutation', 'Type de voie': 'type_voie', 'Commune': 'commune',
+        'Surface Carrez du 1er lot': 'surface_carrez_1er_lot', 'Surface Carrez du 2eme lot': 'surface_carrez_2e_lot',
+        'Nombre de lots': 'nb_lots', 'Type local': 'type_local', 'Surface reelle bati': 'surface_reelle_bati',
+        'Nombre pieces principales': 'nb_pieces', 'code_district_custom': 'district', 'code_IRIS': 'code_iris',
+    })
+    data = data.astype(object).where(data.notna(), None)
+    return data.to_dict(orient='records')
+
+
+def make_transports(n_stations: int = 400, seed: int = 0) -> pd.DataFrame:
+    """Random IDF Mobilités station dataset, with several rows (lines) per station as in the open data file."""
+    rng = np.random.default_rng(seed)
+    n_rows = n_stations * 2
+    station = rng.integers(0, n_stations, n_rows)
+    station_lat = rng.uniform(LAT_RANGE[0] - 0.02, LAT_RANGE[1] + 0.02, n_stations)
+    station_lon = rng.uniform(LON_RANGE[0] - 0.03, LON_RANGE[1] + 0.03, n_stations)
+    mode = choose(['metro', 'rer', 'train'], n_rows, rng, p=[0.7, 0.15, 0.15])
+
+    return pd.DataFrame({
+        'nom_long': [f'Station {code}' for code in station],
+        'Geo Point': [f'{station_lat[code]}, {station_lon[code]}' for code in station],
+        'fer': (mode != 'metro').astype(int),
+        'train': (mode == 'train').astype(int),
+        'rer': (mode == 'rer').astype(int),
+        'metro': (mode == 'metro').astype(int),
+    })
+
+
+def make_revenus(missing_share: float = 0.1, seed: int = 0) -> pd.DataFrame:
+    """Random INSEE median revenue dataset by IRIS code, with a share of the synthetic IRIS codes missing."""
+    rng = np.random.default_rng(seed)
+    iris_codes = 751000000 + np.arange(N_IRIS) * 101
+    iris_codes = iris_codes[rng.random(N_IRIS) >= missing_share]
+    return pd.DataFrame({
+        'IRIS': iris_codes.astype(str),
+        'DISP_MED18': rng.uniform(15000, 60000, len(iris_codes)).round(),
+    })
@@ -0,0 +1,245 @@
+"""Versioned model artifacts: fitted pipelines saved as a native booster file, encoder tables and metadata.
+
+Usage (from the repository root):
+    python -m src.artifacts --model models/tuned_lgbr.sav --output models/tuned_lgbr
+
+An artifact is a directory with:
+- `metadata.json`: format version, input features, compiled preprocessing plan (see `compiled_pipeline`), categories
+  of the lookup tables and estimator description. It is written last, so that an artifact is only read once complete.
+- `tables.npz`: numeric arrays of the plan (scaler statistics and lookup table values).
+- the booster in the native format of its library (`booster.txt` for LightGBM, `booster.json` for XGBoost,
+  `booster.cbm` for CatBoost).
+
+`load_model_artifact` rebuilds the compiled prediction path without unpickling sklearn, category_encoders or
+feature_engine objects, and only imports the library of the booster.
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+
+import src.compiled_pipeline as compiled
+import src.instrumentation as instrumentation
+
+ARTIFACT_FORMAT_VERSION = 1
+METADATA_FILE_NAME = 'metadata.json'
+TABLES_FILE_NAME = 'tables.npz'
+
+# Native booster file of each supported library
+BOOSTER_FILE_NAMES = {'lightgbm': 'booster.txt', 'xgboost': 'booster.json', 'catboost': 'booster.cbm'}
+
+
+def save_model_artifact(pipeline, path: str) -> dict:
+    """Save a fitted pipeline as a model artifact, readable with `load_model_artifact`.
+    The preprocessing is compiled with `compiled_pipeline.compile_pipeline`, so the same transformers are supported.
+
+    Args:
+        pipeline: fitted sklearn pipeline with `feature_engine`, `encoder` and `estimator` steps, whose estimator is
+            a LightGBM, XGBoost or CatBoost regressor.
+        path (str): artifact directory.
+
+    Returns:
+        dict: metadata of the artifact
+    """
+    compiled_pipeline = compiled.compile_pipeline(pipeline)
+    get_booster_library(compiled_pipeline.estimator)
+    os.makedirs(path, exist_ok=True)
+    # Remove the metadata of a previous artifact first, so that a partially written artifact is never read
+    if os.path.exists(os.path.join(path, METADATA_FILE_NAME)):
+        os.remove(os.path.join(path, METADATA_FILE_NAME))
+
+    arrays = {}
+    frequency_tables = {
+        col: get_table_metadata(table, f'frequency_tables/{col}', arrays)
+        for col, table in compiled_pipeline.frequency_tables.items()
+    }
+    steps = []
+    for i, step in enumerate(compiled_pipeline.steps):
+        step_metadata = {name: step[name] for name in ['kind', 'cols', 'start', 'stop']}
+        step_metadata['arrays'] = {}
+        for name, values in step.items():
+            if isinstance(values, np.ndarray):
+                arrays[f'steps/{i}/{name}'] = values
+                step_metadata['arrays'][name] = f'steps/{i}/{name}'
+        if 'tables' in step:
+            step_metadata['tables'] = [
+                get_table_metadata(table, f'steps/{i}/tables/{j}', arrays) for j, table in enumerate(step['tables'])
+            ]
+        steps.append(step_metadata)
+
+    np.savez(os.path.join(path, TABLES_FILE_NAME), **arrays)
+    metadata = {
+        'format_version': ARTIFACT_FORMAT_VERSION,
+        'features': compiled_pipeline.features,
+        'n_outputs': compiled_pipeline.n_outputs,
+        'sparse_output': bool(compiled_pipeline.sparse_output),
+        'frequency_tables': frequency_tables,
+        'steps': steps,
+        'estimator': save_booster(compiled_pipeline.estimator, path),
+    }
+    with open(os.path.join(path, METADATA_FILE_NAME), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def load_model_artifact(path: str) -> compiled.CompiledPipeline:
+    """Load a model artifact saved with `save_model_artifact`.
+
+    Args:
+        path (str): artifact directory.
+
+    Returns:
+        CompiledPipeline: object with the `predict` and `transform` methods of the saved pipeline, whose estimator
+        is the native booster (see `NativeBooster`)
+    """
+    metadata_path = os.path.join(path, METADATA_FILE_NAME)
+    if not os.path.exists(metadata_path):
+        raise ValueError(f'No model artifact in {path}')
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    if metadata.get('format_version') != ARTIFACT_FORMAT_VERSION:
+        raise ValueError(f'Unsupported model artifact format {metadata.get("format_version")}, expected {ARTIFACT_FORMAT_VERSION}')
+
+    with np.load(os.path.join(path, TABLES_FILE_NAME), allow_pickle=False) as tables:
+        arrays = {key: tables[key] for key in tables.files}
+
+    frequency_tables = {col: get_table(table, arrays) for col, table in metadata['frequency_tables'].items()}
+    steps = []
+    for step_metadata in metadata['steps']:
+        step = {name: step_metadata[name] for name in ['kind', 'cols', 'start', 'stop']}
+        step |= {name: arrays[key] for name, key in step_metadata['arrays'].items()}
+        if 'tables' in step_metadata:
+            step['tables'] = [get_table(table, arrays) for table in step_metadata['tables']]
+        steps.append(step)
+
+    estimator = NativeBooster(metadata['estimator'], path)
+    return compiled.CompiledPipeline(
+        metadata['features'], frequency_tables, steps, metadata['n_outputs'], estimator, metadata['sparse_output']
+    )
+
+
+def get_table_metadata(table: compiled.LookupTable, key: str, arrays: dict) -> dict:
+    """Describe a lookup table in the metadata, adding its values (unknown values included) to arrays under key."""
+    arrays[key] = table.values
+    return {
+        'categories': [instrumentation.to_json_compatible(category) for category in table.index],
+        'values': key,
+        'missing_value': instrumentation.to_json_compatible(table.missing_value),
+    }
+
+
+def get_table(table_metadata: dict, arrays: dict) -> compiled.LookupTable:
+    """Rebuild a lookup table described with `get_table_metadata`."""
+    return compiled.LookupTable(
+        table_metadata['categories'], arrays[table_metadata['values']],
+        unknown_value=None, missing_value=table_metadata['missing_value'],
+    )
+
+
+def save_booster(estimator, path: str) -> dict:
+    """Save the booster of a fitted estimator in the native format of its library, in the artifact directory.
+
+    Args:
+        estimator: fitted LightGBM, XGBoost or CatBoost regressor.
+        path (str): artifact directory.
+
+    Returns:
+        dict: estimator metadata (library and version, class, booster file and best iteration)
+    """
+    library = get_booster_library(estimator)
+    file_name = BOOSTER_FILE_NAMES[library]
+    best_iteration = None
+    if library == 'lightgbm':
+        # The best iteration, if any, is the last iteration saved
+        estimator.booster_.save_model(os.path.join(path, file_name))
+    elif library == 'xgboost':
+        estimator.get_booster().save_model(os.path.join(path, file_name))
+        best_iteration = getattr(estimator.get_booster(), 'best_iteration', None)
+    else:
+        estimator.save_model(os.path.join(path, file_name))
+
+    return {
+        'library': library,
+        'version': sys.modules[library].__version__,
+        'class': type(estimator).__name__,
+        'file': file_name,
+        'best_iteration': best_iteration,
+    }
+
+
+def get_booster_library(estimator) -> str:
+    """Library of an estimator that can be saved as a native booster (a LightGBM, XGBoost or CatBoost regressor)."""
+    library = type(estimator).__module__.split('.')[0]
+    if library not in BOOSTER_FILE_NAMES or 'Regressor' not in type(estimator).__name__:
+        raise ValueError(f'{type(estimator).__name__} cannot be saved as a native booster')
+    return library
+
+
+class NativeBooster:
+    """Booster loaded from its native file, predicting as the fitted estimator it was saved from.
+    Only the library of the booster is imported.
+
+    Args:
+        estimator_metadata (dict): estimator metadata written by `save_booster`.
+        path (str): artifact directory.
+    """
+    def __init__(self, estimator_metadata: dict, path: str):
+        self.library = estimator_metadata['library']
+        self.best_iteration = estimator_metadata['best_iteration']
+        booster_path = os.path.join(path, estimator_metadata['file'])
+
+        if self.library == 'lightgbm':
+            import lightgbm
+            self.booster = lightgbm.Booster(model_file=booster_path)
+        elif self.library == 'xgboost':
+            import xgboost
+            self.booster = xgboost.Booster(model_file=booster_path)
+        elif self.library == 'catboost':
+            import catboost
+            self.booster = catboost.CatBoostRegressor().load_model(booster_path)
+        else:
+            raise ValueError(f'Unsupported booster library {self.library}')
+
+    def predict(self, X) -> np.ndarray:
+        if self.library == 'xgboost':
+            # As XGBRegressor.predict, only the trees up to the best iteration are used after early stopping
+            iteration_range = (0, self.best_iteration + 1) if self.best_iteration is not None else (0, 0)
+            return self.booster.inplace_predict(X, iteration_range=iteration_range)
+        return self.booster.predict(X)
+
+
+def load_model(path: str, compile_pipeline: bool = True):
+    """Load a model artifact directory (see `load_model_artifact`) or a pickled pipeline, compiled with
+    `compiled_pipeline.compile_pipeline` unless compile_pipeline is set to False (artifacts are always compiled)."""
+    if os.path.isdir(path):
+        return load_model_artifact(path)
+
+    with open(path, 'rb') as f:
+        pipeline = pickle.load(f)
+    return compiled.compile_pipeline(pipeline) if compile_pipeline else pipeline
+
+
+def get_model_features(model) -> list:
+    """Input features of a model loaded with `load_model`."""
+    if isinstance(model, compiled.CompiledPipeline):
+        return list(model.features)
+    return list(model.feature_names_in_)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='pickled pipeline (e.g. models/tuned_lgbr.sav)')
+    parser.add_argument('--output', required=True, help='artifact directory')
+    args = parser.parse_args()
+
+    with open(args.model, 'rb') as f:
+        pipeline = pickle.load(f)
+    metadata = save_model_artifact(pipeline, args.output)
+    print(json.dumps({name: metadata[name] for name in ['format_version', 'features', 'estimator']}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""Batch scoring of a raw DVF file with a fitted pipeline, from raw rows to a predictions file in a single command.
+
+Usage (from the repository root):
+    python -m src.batch_scoring --model models/tuned_lgbr.sav --features-dict features_lgb.json \
+        --input ../data/raw/dvf/dvf_test.csv --output ../data/predictions/test_predictions.csv
+
+Raw rows are read by chunks and go through `prepare_housing_data`, `preprocess_housing_data`, the station and IRIS
+enrichment (with the prebuilt indexes of `serving.build_enrichment_context`) and the pipeline. Predicted `valeur_m2`
+and total `valeur` are appended to the output file chunk by chunk, so memory only depends on the chunk size.
+
+All chunks are cast with the same categories. --vocabulary reads them from a JSON file (see
+`schema.write_housing_vocabulary`), written from the --reference-data files if missing; without it, the categorical
+columns of the input file are read in a first pass over the file.
+
+With --overlap, stages run in separate threads connected by bounded queues, so that reading, enrichment, scoring and
+writing of consecutive chunks overlap (see `run_chunk_pipeline`). It is off by default: stages mostly hold the GIL,
+and `benchmarks.batch_scoring_benchmark` has not shown a throughput gain so far.
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+
+import pandas as pd
+
+import src.artifacts as artifacts
+import src.constants as cst
+import src.instrumentation as instrumentation
+import src.pipeline as pipe
+import src.preprocessing as prep
+import src.schema as schema
+import src.serving as serving
+
+# Marks the end of the chunks in a queue
+END_OF_CHUNKS = object()
+
+
+class PredictionWriter:
+    """Append the predictions of each chunk to a CSV file (the header is written with the first chunk)."""
+    def __init__(self, path: str):
+        self.path = path
+        self.n_rows = 0
+        self.is_first_chunk = True
+
+    def write(self, predictions: pd.DataFrame):
+        predictions.to_csv(self.path, index=True, mode='w' if self.is_first_chunk else 'a', header=self.is_first_chunk)
+        self.n_rows += predictions.shape[0]
+        self.is_first_chunk = False
+
+
+def score_file(input_path: str, output_path: str, pipeline, features: list, context: dict, chunksize: int = cst.batch_scoring_chunk_size, overlap: bool = False, queue_size: int = cst.batch_scoring_queue_size, vocabulary: dict = None) -> dict:
+    """Score a raw DVF file by chunks and write predicted price per m2 and total price to a CSV file indexed like
+    the input file. Rows removed by `preprocess_housing_data` (other than sales, missing district) are not scored.
+    All chunks use the same categories: without a vocabulary, they are read from the file before scoring, which
+    reads the categorical columns of the file a second time.
+
+    Args:
+        input_path (str): path of the raw DVF csv file.
+        output_path (str): path of the predictions csv file.
+        pipeline: fitted pipeline (or compiled pipeline) predicting the price per m2.
+        features (list): features used by the pipeline.
+        context (dict): enrichment context (see `serving.build_enrichment_context`).
+        chunksize (int, optional): number of raw rows per chunk. Defaults to cst.batch_scoring_chunk_size.
+        overlap (bool, optional): run stages concurrently on consecutive chunks. Defaults to False.
+        queue_size (int, optional): maximum number of chunks waiting between two stages. Defaults to
+            cst.batch_scoring_queue_size.
+        vocabulary (dict, optional): categories of the categorical columns (see `schema.get_housing_vocabulary`).
+            Defaults to None (categories of the file, see `preprocessing.get_raw_housing_vocabulary`).
+
+    Returns:
+        dict: rows read and scored, elapsed time, rows per second and busy time by stage
+    """
+    n_rows_read = 0
+
+    def read_chunks():
+        nonlocal n_rows_read
+        for chunk in prep.read_raw_housing_data(input_path, is_train=False, chunksize=chunksize):
+            n_rows_read += chunk.shape[0]
+            yield chunk
+
+    start = time.perf_counter()
+    if vocabulary is None:
+        vocabulary = prep.get_raw_housing_vocabulary([input_path], is_train=False, chunksize=chunksize)
+
+    stages = {
+        'preprocess': lambda chunk: prep.preprocess_housing_data(prep.prepare_housing_data(chunk, is_train=False), is_train=False, vocabulary=vocabulary),
+        'enrich': lambda data: serving.add_external_features(data, context),
+        'predict': lambda data: predict_chunk(data, pipeline, features),
+    }
+    writer = PredictionWriter(output_path)
+
+    def write(predictions: pd.DataFrame):
+        writer.write(predictions)
+        elapsed = time.perf_counter() - start
+        instrumentation.progress(
+            'batch_scoring', rows_read=n_rows_read, rows_scored=writer.n_rows, rows_per_second=round(n_rows_read / elapsed)
+        )
+
+    stage_seconds = run_chunk_pipeline(read_chunks(), stages, write, overlap, queue_size)
+    # Write the header of an empty predictions file if no row was scored
+    if writer.is_first_chunk:
+        index_name = pd.read_csv(input_path, index_col=0, nrows=0).index.name
+        writer.write(pd.DataFrame(columns=[cst.target_col, cst.raw_target_col]).rename_axis(index_name))
+
+    elapsed = time.perf_counter() - start
+    return {
+        'n_rows_read': n_rows_read,
+        'n_rows_scored': writer.n_rows,
+        'seconds': elapsed,
+        'rows_per_second': n_rows_read / elapsed,
+        'stage_seconds': stage_seconds,
+    }
+
+
+def predict_chunk(data: pd.DataFrame, pipeline, features: list) -> pd.DataFrame:
+    """Predict the price per m2 and total price of a chunk of enriched housing data."""
+    predictions_m2 = pipeline.predict(data[features])
+    return pd.DataFrame({
+        cst.target_col: predictions_m2,
+        cst.raw_target_col: predictions_m2 * data['surface_reelle_bati'].to_numpy(dtype=float),
+    }, index=data.index)
+
+
+def run_chunk_pipeline(chunks, stages: dict, consume, overlap: bool = False, queue_size: int = cst.batch_scoring_queue_size) -> dict:
+    """Apply stages in order to each chunk and pass the results to consume.
+
+    With overlap, chunks are read in a producer thread and each stage runs in its own thread, connected by queues of
+    at most queue_size chunks (consume runs in the calling thread). While a chunk is scored, the next one is enriched
+    and the one after is read, and at most (number of stages + 1) * (queue_size + 1) chunks are in memory. An error in
+    any thread stops the others and is raised in the calling thread.
+
+    Args:
+        chunks (iterable): input chunks.
+        stages (dict): dictionary of stage names and functions applied to each chunk.
+        consume (callable): function called with the output of the last stage for each chunk.
+        overlap (bool, optional): run stages concurrently. Defaults to False.
+        queue_size (int, optional): maximum number of chunks waiting between two stages. Defaults to
+            cst.batch_scoring_queue_size.
+
+    Returns:
+        dict: time spent in each stage (reading, stages and consume), in seconds
+    """
+    stage_seconds = {name: 0.0 for name in ['read', *stages, 'write']}
+
+    def timed(name: str, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        stage_seconds[name] += time.perf_counter() - start
+        return result
+
+    if not overlap:
+        chunks = iter(chunks)
+        while (chunk := timed('read', next, chunks, END_OF_CHUNKS)) is not END_OF_CHUNKS:
+            for name, stage in stages.items():
+                chunk = timed(name, stage, chunk)
+            timed('write', consume, chunk)
+        return stage_seconds
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+    errors = []
+
+    # Queue operations give up once a thread has failed, so that no thread stays blocked
+    def put(output_queue: queue.Queue, item) -> bool:
+        while not stop.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(input_queue: queue.Queue):
+        while not stop.is_set():
+            try:
+                return input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return END_OF_CHUNKS
+
+    def produce():
+        try:
+            iterator = iter(chunks)
+            while (chunk := timed('read', next, iterator, END_OF_CHUNKS)) is not END_OF_CHUNKS:
+                if not put(queues[0], chunk):
+                    return
+            put(queues[0], END_OF_CHUNKS)
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+
+    def run_stage(name: str, stage, input_queue: queue.Queue, output_queue: queue.Queue):
+        try:
+            while (chunk := get(input_queue)) is not END_OF_CHUNKS:
+                if not put(output_queue, timed(name, stage, chunk)):
+                    return
+            put(output_queue, END_OF_CHUNKS)
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+
+    threads = [threading.Thread(target=produce, daemon=True)] + [
+        threading.Thread(target=run_stage, args=(name, stage, queues[i], queues[i + 1]), daemon=True)
+        for i, (name, stage) in enumerate(stages.items())
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while (chunk := get(queues[-1])) is not END_OF_CHUNKS:
+            timed('write', consume, chunk)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return stage_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='model artifact directory (see `src.artifacts`) or pickled pipeline (e.g. models/tuned_lgbr.sav)')
+    parser.add_argument('--features-dict', help='JSON file with the features_dict used to fit the pipeline (defaults to the input features of the model)')
+    parser.add_argument('--input', default=cst.RAW_NB_TEST_PATH, help='raw DVF csv file to score')
+    parser.add_argument('--output', default=cst.PREDICTIONS_PATH, help='predictions csv file')
+    parser.add_argument('--chunksize', type=int, default=cst.batch_scoring_chunk_size)
+    parser.add_argument('--queue-size', type=int, default=cst.batch_scoring_queue_size)
+    parser.add_argument('--overlap', action='store_true', help='run stages concurrently on consecutive chunks')
+    parser.add_argument('--vocabulary', help='JSON file with the categories of the categorical columns, written from the '
+                                             '--reference-data files if missing (defaults to a first pass over the input file)')
+    parser.add_argument('--no-compile', action='store_true', help='score a pickled sklearn pipeline instead of its compiled plan')
+    parser.add_argument('--transports', default=cst.RAW_TRANSPORTS_PATH)
+    parser.add_argument('--revenus', default=cst.RAW_INSEE_PATH)
+    parser.add_argument('--reference-data', nargs='+', default=[cst.RAW_NB_TRAIN_PATH, cst.RAW_NB_TEST_PATH],
+                        help='raw DVF files used to compute IRIS centroids')
+    parser.add_argument('--spatial-grid', help='directory of the precomputed grid of station counts and IRIS revenue '
+                                               '(built if missing or outdated), used instead of exact enrichment')
+    args = parser.parse_args()
+
+    pipeline = artifacts.load_model(args.model, not args.no_compile)
+    features = artifacts.get_model_features(pipeline)
+    if args.features_dict:
+        with open(args.features_dict) as f:
+            features = pipe.get_features_from_dict(json.load(f))
+
+    context = serving.load_context_from_files(args.transports, args.revenus, args.reference_data, args.spatial_grid)
+    vocabulary = None
+    if args.vocabulary and os.path.exists(args.vocabulary):
+        vocabulary = schema.read_housing_vocabulary(args.vocabulary)
+    elif args.vocabulary:
+        vocabulary = prep.get_raw_housing_vocabulary(args.reference_data, is_train=False, chunksize=args.chunksize)
+        schema.write_housing_vocabulary(args.vocabulary, vocabulary)
+
+    report = score_file(args.input, args.output, pipeline, features, context, args.chunksize, args.overlap, args.queue_size, vocabulary)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
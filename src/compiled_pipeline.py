@@ -0,0 +1,250 @@
+"""Compiled preprocessing of fitted pipelines, for low latency predictions on small batches.
+
+`compile_pipeline` turns the fitted transformers of a pipeline from `pipeline.build_pipeline` into a plan of NumPy
+operations, whose predictions are identical to `pipeline.predict` (unseen categories and missing values included).
+"""
+import numpy as np
+import pandas as pd
+
+def compile_pipeline(pipeline):
+    """Compile the preprocessing of a fitted pipeline from `pipeline.build_pipeline` into a flat plan of NumPy operations.
+    The fitted statistics (scaler offsets and scales, frequency tables, one-hot categories, target encoding tables) are
+    extracted once, and each prediction writes the encoded features into a preallocated buffer with array operations
+    before calling the estimator, instead of going through pandas and ColumnTransformer dispatch.
+
+    The operations are the ones applied by the fitted transformers, in the same order and with the same types, so
+    predictions match `pipeline.predict`.
+
+    Args:
+        pipeline: fitted sklearn pipeline with `feature_engine`, `encoder` and `estimator` steps.
+
+    Returns:
+        CompiledPipeline: object with the `predict` and `transform` methods of the pipeline
+    """
+    feature_engine = pipeline.named_steps['feature_engine']
+    encoder = pipeline.named_steps['encoder']
+
+    frequency_tables = {
+        col: LookupTable(list(frequencies.keys()), list(frequencies.values()), unknown_value=np.nan)
+        for col, frequencies in feature_engine.encoder_dict_.items()
+    }
+
+    features = list(encoder.feature_names_in_)
+    categorical_positions = get_categorical_positions(pipeline.named_steps['estimator'])
+    steps = []
+    n_outputs = 0
+    for name, transformer, cols in encoder.transformers_:
+        if transformer == 'drop' or len(cols) == 0:
+            continue
+        if name == 'remainder':
+            cols = [features[col] for col in cols]
+
+        step = compile_transformer(transformer, list(cols), n_outputs, categorical_positions)
+        steps.append(step)
+        n_outputs = step['stop']
+
+    return CompiledPipeline(features, frequency_tables, steps, n_outputs, pipeline.named_steps['estimator'], encoder.sparse_output_)
+
+
+def compile_transformer(transformer, cols: list, start: int, categorical_positions: list = ()) -> dict:
+    """Extract the fitted statistics of a ColumnTransformer step, writing its outputs from column `start` of the buffer.
+
+    Args:
+        transformer: fitted transformer (or 'passthrough').
+        cols (list): input columns of the transformer.
+        start (int): first output column.
+        categorical_positions (list, optional): output columns used by the estimator as native categorical features,
+            whose (non-numeric) values cannot be written to the buffer. Defaults to ().
+
+    Returns:
+        dict: step of the compiled plan
+    """
+    # Imported here so that compiled pipelines loaded from model artifacts (see `artifacts.load_model_artifact`) do
+    # not import the preprocessing libraries
+    from category_encoders.target_encoder import TargetEncoder
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler, MinMaxScaler
+
+    if isinstance(transformer, str) and transformer == 'passthrough':
+        categorical_cols = [col for i, col in enumerate(cols) if start + i in categorical_positions]
+        if categorical_cols:
+            raise ValueError(f'Cannot compile passthrough columns {categorical_cols} used as native categorical features')
+        return {'kind': 'passthrough', 'cols': cols, 'start': start, 'stop': start + len(cols)}
+
+    if isinstance(transformer, MinMaxScaler):
+        if transformer.clip:
+            raise ValueError('Cannot compile a MinMaxScaler with clip=True')
+        return {
+            'kind': 'min_max_scaled', 'cols': cols, 'start': start, 'stop': start + len(cols),
+            'scale': transformer.scale_, 'offset': transformer.min_,
+        }
+
+    if isinstance(transformer, StandardScaler):
+        return {
+            'kind': 'standard_scaled', 'cols': cols, 'start': start, 'stop': start + len(cols),
+            'mean': transformer.mean_ if transformer.with_mean else np.zeros(len(cols)),
+            'scale': transformer.scale_ if transformer.with_std else np.ones(len(cols)),
+        }
+
+    if isinstance(transformer, OneHotEncoder):
+        if transformer.drop is not None or getattr(transformer, '_infrequent_enabled', False):
+            raise ValueError('Cannot compile a OneHotEncoder with dropped or infrequent categories')
+        tables, stop = [], start
+        for categories in transformer.categories_:
+            # Unknown categories (index -1) select the last row of the lookup values, which is all zeros
+            one_hot = np.vstack([np.eye(len(categories)), np.zeros((1, len(categories)))])
+            tables.append(LookupTable(categories, one_hot, unknown_value=None))
+            stop += len(categories)
+        return {'kind': 'one_hot_encoded', 'cols': cols, 'start': start, 'stop': stop, 'tables': tables}
+
+    if isinstance(transformer, TargetEncoder):
+        tables = []
+        for ordinal_mapping in transformer.ordinal_encoder.mapping:
+            col = ordinal_mapping['col']
+            mapping = ordinal_mapping['mapping']
+            codes = mapping[~mapping.index.isna()]
+            # Missing values seen during fit are a category with their own code, others are encoded as -2
+            missing_codes = mapping[mapping.index.isna()]
+            missing_code = missing_codes.iloc[0] if len(missing_codes) > 0 else -2
+            encoding = transformer.mapping[col]
+            tables.append(LookupTable(
+                list(codes.index), encoding.loc[codes.to_numpy()].to_numpy(),
+                unknown_value=encoding.loc[-1], missing_value=encoding.loc[missing_code],
+            ))
+        return {'kind': 'target_encoded', 'cols': cols, 'start': start, 'stop': start + len(cols), 'tables': tables}
+
+    raise ValueError(f'Cannot compile transformer {transformer!r}')
+
+
+def get_categorical_positions(estimator) -> list:
+    """Positions of the encoded features that a fitted estimator uses as native categorical features."""
+    library = type(estimator).__module__.split('.')[0]
+    if library == 'lightgbm':
+        return list(estimator.booster_.params.get('categorical_column') or [])
+    if library == 'xgboost':
+        return [i for i, feature_type in enumerate(estimator.get_booster().feature_types or []) if feature_type == 'c']
+    if library == 'catboost':
+        return list(estimator.get_cat_feature_indices())
+    return []
+
+
+class LookupTable:
+    """Mapping from categories to values (scalars or rows) applied to arrays with a single hash table lookup.
+    Unknown categories are mapped to unknown_value and, if missing_value is set, missing values to missing_value.
+
+    Args:
+        categories (list): categories seen during fit.
+        values (list | np.array): value of each category (with an extra last row for unknown categories if
+            unknown_value is None).
+        unknown_value (optional): value of unknown categories.
+        missing_value (optional): value of missing categories. Defaults to None (missing values are categories).
+    """
+    def __init__(self, categories, values, unknown_value, missing_value=None):
+        self.index = pd.Index(categories, dtype=object)
+        self.values = np.asarray(values, dtype=float)
+        if unknown_value is not None:
+            self.values = np.append(self.values, unknown_value)
+        self.missing_value = missing_value
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        # get_indexer returns -1 for unknown categories, which selects the last value
+        result = self.values[self.index.get_indexer(keys)]
+        if self.missing_value is not None:
+            result[pd.isna(keys)] = self.missing_value
+        return result
+
+
+class CompiledPipeline:
+    """Prediction path of a fitted pipeline compiled with `compile_pipeline`.
+    The encoded features are written into a buffer reused across calls, so an object should not be shared by threads
+    predicting concurrently.
+
+    Args:
+        features (list): input features of the pipeline.
+        frequency_tables (dict): frequency lookup table of each count/frequency encoded feature.
+        steps (list): compiled ColumnTransformer steps (see `compile_transformer`).
+        n_outputs (int): number of encoded features.
+        estimator: fitted estimator.
+        sparse_output (bool, optional): pass a sparse matrix to the estimator, as the fitted ColumnTransformer does.
+            Defaults to False.
+    """
+    def __init__(self, features: list, frequency_tables: dict, steps: list, n_outputs: int, estimator, sparse_output: bool = False):
+        self.features = features
+        self.frequency_tables = frequency_tables
+        self.steps = steps
+        self.n_outputs = n_outputs
+        self.estimator = estimator
+        self.sparse_output = sparse_output
+        self.buffer = np.empty((0, n_outputs))
+
+    def predict(self, X) -> np.ndarray:
+        """Predict from a dataframe (or dictionary of arrays) with the input features of the pipeline."""
+        encoded = self.encode(X)
+        if self.sparse_output:
+            from scipy import sparse
+            return self.estimator.predict(sparse.csr_matrix(encoded))
+        return self.estimator.predict(encoded)
+
+    def transform(self, X) -> np.ndarray:
+        """Encode features as the preprocessing steps of the pipeline (returns a dense copy)."""
+        return self.encode(X).copy()
+
+    def encode(self, X) -> np.ndarray:
+        n_rows = len(X[self.features[0]])
+        if self.buffer.shape[0] < n_rows:
+            self.buffer = np.empty((n_rows, self.n_outputs))
+        out = self.buffer[:n_rows]
+
+        for step in self.steps:
+            block = out[:, step['start']:step['stop']]
+            kind = step['kind']
+            if kind == 'passthrough':
+                for i, col in enumerate(step['cols']):
+                    block[:, i] = self.get_column(X, col)
+            elif kind in ['min_max_scaled', 'standard_scaled']:
+                # Scalers compute in the common type of their input columns (float32 if they are all float32)
+                dtype = self.get_step_dtype(X, step['cols'])
+                scaled = block if dtype == block.dtype else np.empty(block.shape, dtype=dtype)
+                for i, col in enumerate(step['cols']):
+                    scaled[:, i] = self.get_column(X, col)
+                if kind == 'min_max_scaled':
+                    scaled *= step['scale']
+                    scaled += step['offset']
+                else:
+                    scaled -= step['mean']
+                    scaled /= step['scale']
+                if scaled is not block:
+                    block[:] = scaled
+            elif kind == 'one_hot_encoded':
+                position = 0
+                for col, table in zip(step['cols'], step['tables']):
+                    n_categories = len(table.index)
+                    block[:, position:position + n_categories] = table.lookup(np.asarray(X[col], dtype=object))
+                    position += n_categories
+            elif kind == 'target_encoded':
+                for i, (col, table) in enumerate(zip(step['cols'], step['tables'])):
+                    block[:, i] = table.lookup(np.asarray(X[col], dtype=object))
+
+        return out
+
+    def get_step_dtype(self, X, cols: list):
+        """Floating type of the array built by sklearn from the input columns of a step."""
+        dtypes = [np.float64 if col in self.frequency_tables else get_numpy_dtype(X[col]) for col in cols]
+        dtype = np.result_type(*dtypes)
+        return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+    def get_column(self, X, col: str) -> np.ndarray:
+        """Get a numeric input column, after frequency encoding if the feature is count/frequency encoded."""
+        if col not in self.frequency_tables:
+            return np.asarray(X[col], dtype=float)
+
+        keys = np.asarray(X[col], dtype=object)
+        if pd.isna(keys).any():
+            raise ValueError(f'{col} contains missing values, which cannot be frequency encoded')
+        return self.frequency_tables[col].lookup(keys)
+
+
+def get_numpy_dtype(values) -> np.dtype:
+    """NumPy type of an input column, without converting it when it already has one."""
+    if isinstance(getattr(values, 'dtype', None), np.dtype):
+        return values.dtype
+    return np.asarray(values[:0]).dtype
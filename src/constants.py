@@ -14,6 +14,8 @@ PREPROCESSED_NB_TEST_PATH = os.path.join(RAW_NB_PATH, 'dvf', 'dvf_test_preproces
 
 PREDICTIONS_PATH = os.path.join('..', 'data', 'predictions', 'test_predictions.csv')
 
+FEATURE_CACHE_PATH = os.path.join('..', 'data', 'cache', 'features')
+
 # Column selection and name mapping
 train_cols = ['Date mutation', 'Nature mutation', 'Type de voie', 'Commune',
        'Surface Carrez du 1er lot', 'Surface Carrez du 2eme lot', 'Nombre de lots',
@@ -25,6 +27,23 @@ test_cols = ['Date mutation', 'Nature mutation', 'Type de voie', 'Commune',
        'Type local', 'Surface reelle bati', 'Nombre pieces principales', 
        'lon', 'lat', 'code_district_custom', 'code_IRIS']
 
+# Types of raw columns that are not inferred consistently across chunks (French decimals are parsed during preprocessing)
+raw_dtypes = {
+       'Nature mutation': str, 
+       'Type de voie': str, 
+       'Commune': str,
+       'Surface Carrez du 1er lot': str, 
+       'Surface Carrez du 2eme lot': str, 
+       'Type local': str, 
+       'Surface reelle bati': float, 
+       'Nombre pieces principales': float, 
+       'lon': float, 
+       'lat': float, 
+       'code_district_custom': str, 
+       'code_IRIS': float, 
+       'Valeur fonciere': str
+}
+
 column_names_mapping = {
        'Date mutation': 'date_mutation', 
        'Nature mutation': 'nature_mutation', 
@@ -42,12 +61,70 @@ column_names_mapping = {
        'Valeur fonciere': 'valeur'
 }
 
+# Parameters for preprocessing
+preprocessing_chunk_size = 100000
+
 # Parameters for external geo data
-limit_distance_district_center = 1.2
 short_distance_station = 0.5
+earth_radius_km = 6371.0088
+haversine_max_relative_error = 0.0056
+wgs84_semi_major_axis_km = 6378.137
+wgs84_flattening = 1 / 298.257223563
+geodesic_tolerance_km = 1e-6
+distance_chunk_size = 10000
+station_count_tile_size = 0.01
+station_count_partitions_per_worker = 4
+proximity_radii = [0.25, 0.5, 1.0]
+
+# Parameters for the spatial feature grid: bounds of Paris (lat_min, lat_max, lon_min, lon_max), side of the cells and
+# number of housing units compared with exact enrichment when building the grid
+spatial_grid_bounds = (48.815, 48.903, 2.224, 2.470)
+spatial_grid_cell_size_m = 25
+spatial_grid_report_size = 100000
+
+# Types of preprocessed and enriched columns in memory and in storage (see `schema.apply_housing_schema`)
+housing_dtypes = {
+       'date_mutation': 'int32', 
+       'nature_mutation': 'category', 
+       'type_voie': 'category', 
+       'commune': 'category',
+       'surface_carrez_1er_lot': 'float32', 
+       'surface_carrez_2e_lot': 'float32', 
+       'nb_lots': 'int16',
+       'type_local': 'category', 
+       'surface_reelle_bati': 'float32', 
+       'nb_pieces': 'float32', 
+       # Coordinates are kept in float64: float32 rounds them by up to ~0.5m, which changes station counts near the radii
+       'lon': 'float64', 
+       'lat': 'float64', 
+       'district': 'category',
+       'code_iris': 'int32',
+       f'n_metros_within_{short_distance_station}km': 'int16', 
+       f'n_trains_within_{short_distance_station}km': 'int16', 
+       'med_revenue_iris_2018': 'float32'
+}
+
+# Parameters for the feature cache
+feature_cache_max_bytes = 2 * 1024 ** 3
+feature_cache_cell_size_deg = 0.05
+
+# Parameters for serving
+serving_host = '127.0.0.1'
+serving_port = 8000
+serving_max_batch_size = 64
+
+# Parameters for batch scoring
+batch_scoring_chunk_size = 50000
+batch_scoring_queue_size = 2
 
 # Parameters for models
+preprocessing_cache_max_bytes = 2 * 1024 ** 3
+incremental_n_estimators = 50
+# Learning rate of the trees added on new rows, relative to the learning rate of the booster
+incremental_learning_rate_factor = 0.1
+incremental_max_rmse_increase = 0.05
 random_seed = 40
 train_size = 0.75
+cv_n_splits = 3
 raw_target_col = "valeur"
-target_col = "valeur_m2"
\ No newline at end of file
+target_col = "valeur_m2"
@@ -1,12 +1,24 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
 import pandas as pd
 
 import src.constants as cst
 import src.pipeline as pipe
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_absolute_percentage_error, mean_squared_error
 
-def fit_and_evaluate_pipeline(estimator, features_dict: dict, X_train: pd.DataFrame, y_train: pd.Series, X_test: pd.DataFrame, y_test: pd.Series) -> dict:
+# sklearn and threadpoolctl are imported by the functions using them, so that importing this module (e.g. for
+# `evaluate_model` in `src.incremental`) does not import them
+
+# Name of the parameter controlling the number of threads, by estimator family (sklearn/XGBoost/LightGBM, CatBoost)
+THREAD_PARAMS = ['n_jobs', 'thread_count']
+
+# Encoded fold matrices and targets shared by the cross-validation tasks of a worker process, set once by `init_cv_worker`
+_worker_data = {}
+
+def fit_and_evaluate_pipeline(estimator, features_dict: dict, X_train: pd.DataFrame, y_train: pd.Series, X_test: pd.DataFrame, y_test: pd.Series, memory=None) -> dict:
     """Create a pipeline from an estimator and encoder, using a dictionary of feature preprocessing.
     Fit the pipeline and evaluate it on a test set.
 
@@ -17,13 +29,14 @@ def fit_and_evaluate_pipeline(estimator, features_dict: dict, X_train: pd.DataFr
         y_train (pd.DataFrame): y_train
         X_test (pd.DataFrame): X_test
         y_test (pd.DataFrame): y_test
+        memory (pipe.PreprocessingMemory, optional): cache of fitted preprocessing steps. Defaults to None.
 
     Returns:
         dict: dictionary of evaluation metrics (RMSE and MAPE)
     """
     # Create a pipeline
     features = pipe.get_features_from_dict(features_dict)
-    pipeline = pipe.build_pipeline(estimator, features_dict)
+    pipeline = pipe.build_pipeline(estimator, features_dict, memory=memory)
 
     # Fit the pipeline on the train set
     pipeline.fit(X_train[features], y_train)
@@ -43,6 +56,8 @@ def evaluate_model(estimator, X_test_encoded: pd.DataFrame, y_test: pd.Series) -
     Returns:
         dict: dictionary of evaluation metrics (RMSE and MAPE)
     """
+    from sklearn.metrics import mean_absolute_percentage_error, mean_squared_error
+
     predictions = estimator.predict(X_test_encoded)
     metrics = {
         'mape': mean_absolute_percentage_error(y_test, predictions), 
@@ -56,6 +71,8 @@ def split_train_test(data: pd.DataFrame):
     Args:
         data (pd.DataFrame): train data
     """
+    from sklearn.model_selection import train_test_split
+
     X_train, X_test, y_train, y_test = train_test_split(
         data.drop(columns=[cst.raw_target_col, cst.target_col]), 
         data[cst.target_col], 
@@ -69,4 +86,190 @@ def split_train_test(data: pd.DataFrame):
     assert X_train.shape[0]==y_train.shape[0]==y_train_valeur.shape[0]
     assert X_test.shape[0]==y_test.shape[0]==y_test_valeur.shape[0]
     
-    return X_train, X_test, y_train, y_test, y_train_valeur, y_test_valeur
\ No newline at end of file
+    return X_train, X_test, y_train, y_test, y_train_valeur, y_test_valeur
+
+def cross_validate_models(models: dict, data: pd.DataFrame, n_splits: int = cst.cv_n_splits, n_workers: int = None, threads_per_task: int = None) -> pd.DataFrame:
+    """Cross-validate several models on the same folds, running every (model, fold) pair in parallel in a pool of
+    processes. Folds are split once, and the preprocessing steps of each features_dict are fitted and applied once per
+    fold (see `encode_cv_folds`): models sharing a features_dict reuse the same encoded matrices, which are sent once
+    to each worker process. Models are evaluated on the price per m2 (`cst.target_col`) and on the total price
+    (`cst.raw_target_col`) reconstructed from the surface.
+
+    Columns left unprocessed that are not numeric (e.g. `commune` for CatBoost) are passed to estimators as pandas
+    categorical columns, declared as `cat_features` for CatBoost (see `get_native_categorical_fit_params`).
+
+    Args:
+        models (dict): dictionary of model names and (estimator, features_dict) tuples.
+        data (pd.DataFrame): training data with the features, `surface_reelle_bati` and `cst.raw_target_col` columns.
+        n_splits (int, optional): number of folds. Defaults to cst.cv_n_splits.
+        n_workers (int, optional): number of (model, fold) pairs evaluated in parallel. Defaults to None (number of
+            CPUs). With 1, pairs are evaluated in the current process.
+        threads_per_task (int, optional): number of threads per model. Defaults to None (CPUs divided by n_workers).
+
+    Returns:
+        pd.DataFrame: one row per model and fold with RMSE/MAPE on the price per m2 and on the total price
+    """
+    from sklearn.base import clone
+
+    n_tasks = len(models) * n_splits
+    n_workers = min(n_workers or os.cpu_count(), n_tasks)
+    threads_per_task = threads_per_task or max(1, os.cpu_count() // n_workers)
+
+    targets = get_cv_targets(data)
+    folds = get_cv_folds(data.shape[0], n_splits)
+    features_dicts = {name: features_dict for name, (_, features_dict) in models.items()}
+    fold_matrices, model_matrices = encode_cv_folds(features_dicts, data, targets[cst.target_col], folds)
+
+    tasks = [
+        (name, model_matrices[name], fold, set_thread_params(clone(estimator), threads_per_task))
+        for name, (estimator, _) in models.items() for fold in range(n_splits)
+    ]
+    results = []
+    if n_workers == 1:
+        for name, matrices_key, fold, estimator in tasks:
+            metrics = fit_and_evaluate_fold(estimator, fold_matrices[(matrices_key, fold)], targets, folds[fold])
+            results.append({'model': name, 'fold': fold} | metrics)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_workers, initializer=init_cv_worker, initargs=(fold_matrices, targets, folds, threads_per_task)
+        ) as executor:
+            futures = {
+                executor.submit(run_cv_task, estimator, matrices_key, fold): (name, fold)
+                for name, matrices_key, fold, estimator in tasks
+            }
+            for future in as_completed(futures):
+                name, fold = futures[future]
+                results.append({'model': name, 'fold': fold} | future.result())
+
+    return pd.DataFrame(results).sort_values(['model', 'fold']).reset_index(drop=True)
+
+
+def get_cv_targets(data: pd.DataFrame) -> pd.DataFrame:
+    """Get the price per m2, total price and surface of each row, as float arrays aligned with the rows of data."""
+    surface = data['surface_reelle_bati'].to_numpy(dtype=float)
+    valeur = data[cst.raw_target_col].to_numpy(dtype=float)
+    valeur_m2 = data[cst.target_col].to_numpy(dtype=float) if cst.target_col in data.columns else valeur / surface
+    return pd.DataFrame({cst.target_col: valeur_m2, cst.raw_target_col: valeur, 'surface_reelle_bati': surface})
+
+
+def get_cv_folds(n_rows: int, n_splits: int = cst.cv_n_splits) -> list:
+    """Split row positions into shuffled folds (seeded with cst.random_seed).
+
+    Args:
+        n_rows (int): number of rows.
+        n_splits (int, optional): number of folds. Defaults to cst.cv_n_splits.
+
+    Returns:
+        list: list of (train positions, test positions) tuples
+    """
+    from sklearn.model_selection import KFold
+
+    kfold = KFold(n_splits=n_splits, shuffle=True, random_state=cst.random_seed)
+    return list(kfold.split(np.zeros((n_rows, 1))))
+
+
+def encode_cv_folds(features_dicts: dict, data: pd.DataFrame, y: np.ndarray, folds: list) -> tuple:
+    """Fit the preprocessing steps of `pipeline.build_pipeline` on the train rows of each fold and encode its train and
+    test rows, once per distinct features_dict.
+
+    Args:
+        features_dicts (dict): dictionary of model names and dictionaries of feature preprocessing.
+        data (pd.DataFrame): training data.
+        y (np.ndarray): target (price per m2), aligned with the rows of data.
+        folds (list): output of `get_cv_folds`.
+
+    Returns:
+        tuple(dict, dict): encoded (train, test) matrices by (features_dict key, fold), and features_dict key by model
+    """
+    model_matrices = {name: json.dumps(features_dict, sort_keys=True) for name, features_dict in features_dicts.items()}
+    fold_matrices = {}
+    for name, matrices_key in model_matrices.items():
+        if (matrices_key, 0) in fold_matrices:
+            continue
+        features = pipe.get_features_from_dict(features_dicts[name])
+        for fold, (train_positions, test_positions) in enumerate(folds):
+            preprocessing = pipe.build_pipeline(None, features_dicts[name])[:-1]
+            X_train = preprocessing.fit_transform(data[features].iloc[train_positions], y[train_positions])
+            X_test = preprocessing.transform(data[features].iloc[test_positions])
+            fold_matrices[(matrices_key, fold)] = (
+                to_fold_matrix(X_train, preprocessing), to_fold_matrix(X_test, preprocessing)
+            )
+    return fold_matrices, model_matrices
+
+
+def to_fold_matrix(X_encoded, preprocessing):
+    """Keep numeric encoded matrices as they are, and convert matrices with non-numeric columns to dataframes with
+    feature names, where non-numeric columns are categorical."""
+    if not isinstance(X_encoded, np.ndarray) or X_encoded.dtype != object:
+        return X_encoded
+
+    names = [name.split('__', 1)[-1] for name in preprocessing.get_feature_names_out()]
+    X_encoded = pd.DataFrame(X_encoded, columns=names).infer_objects()
+    categorical_cols = X_encoded.columns[X_encoded.dtypes == object]
+    return X_encoded.astype({col: 'category' for col in categorical_cols})
+
+
+def init_cv_worker(fold_matrices: dict, targets: pd.DataFrame, folds: list, threads_per_task: int):
+    """Store the encoded folds once per worker process and limit the threads of the BLAS and OpenMP libraries loaded
+    in the process (estimators are limited with `set_thread_params`)."""
+    import threadpoolctl
+
+    threadpoolctl.threadpool_limits(limits=threads_per_task)
+    _worker_data.update(fold_matrices=fold_matrices, targets=targets, folds=folds)
+
+
+def run_cv_task(estimator, matrices_key: str, fold: int) -> dict:
+    """Fit and evaluate an estimator on an encoded fold, using the data of the worker process."""
+    return fit_and_evaluate_fold(
+        estimator, _worker_data['fold_matrices'][(matrices_key, fold)], _worker_data['targets'], _worker_data['folds'][fold]
+    )
+
+
+def fit_and_evaluate_fold(estimator, matrices: tuple, targets: pd.DataFrame, fold: tuple) -> dict:
+    """Fit an estimator on the encoded train rows of a fold and evaluate it on the price per m2 and the total price of
+    its test rows.
+
+    Args:
+        estimator: model object
+        matrices (tuple): encoded train and test matrices of the fold.
+        targets (pd.DataFrame): output of `get_cv_targets`.
+        fold (tuple): train and test positions of the fold.
+
+    Returns:
+        dict: RMSE and MAPE on the price per m2 and on the total price (`_valeur` suffix), and fit time
+    """
+    from sklearn.metrics import mean_absolute_percentage_error, mean_squared_error
+
+    X_train, X_test = matrices
+    train_targets, test_targets = targets.iloc[fold[0]], targets.iloc[fold[1]]
+
+    start = time.perf_counter()
+    estimator.fit(X_train, train_targets[cst.target_col].to_numpy(), **get_native_categorical_fit_params(estimator, X_train))
+    seconds = time.perf_counter() - start
+
+    predictions_m2 = estimator.predict(X_test)
+    predictions = predictions_m2 * test_targets['surface_reelle_bati'].to_numpy()
+    valeur = test_targets[cst.raw_target_col].to_numpy()
+    return {
+        'mape': float(mean_absolute_percentage_error(test_targets[cst.target_col], predictions_m2)),
+        'rmse': float(np.sqrt(mean_squared_error(test_targets[cst.target_col], predictions_m2))),
+        'mape_valeur': float(mean_absolute_percentage_error(valeur, predictions)),
+        'rmse_valeur': float(np.sqrt(mean_squared_error(valeur, predictions))),
+        'seconds': seconds,
+    }
+
+
+def get_native_categorical_fit_params(estimator, X) -> dict:
+    """Declare the categorical columns of a dataframe as `cat_features` for CatBoost estimators (LightGBM detects
+    pandas categorical columns, XGBoost requires `enable_categorical=True`)."""
+    if type(estimator).__module__.split('.')[0] != 'catboost' or not isinstance(X, pd.DataFrame):
+        return {}
+    categorical_cols = [col for col in X.columns if isinstance(X[col].dtype, pd.CategoricalDtype)]
+    return {'cat_features': categorical_cols} if categorical_cols else {}
+
+
+def set_thread_params(estimator, n_threads: int):
+    """Set the number of threads of an estimator, if it has a parameter for it."""
+    estimator_params = estimator.get_params()
+    thread_params = {param: n_threads for param in THREAD_PARAMS if param in estimator_params}
+    return estimator.set_params(**thread_params)
@@ -1,189 +1,315 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 import pandas as pd
-from geopy import distance
 
 import src.constants as cst
+import src.feature_cache as feature_cache
+import src.instrumentation as instrumentation
+import src.schema as schema
+import src.shared_arrays as shared_arrays
+import src.external_data.proximity as proximity
+
+# Shared arrays and station index of a worker process, set once by `init_station_count_worker`
+_worker_data = {}
 
-def count_close_stations_all_housing_units_in_train_test(train: pd.DataFrame, test: pd.DataFrame, transports: pd.DataFrame) -> pd.DataFrame:
+def count_close_stations_all_housing_units_in_train_test(train: pd.DataFrame, test: pd.DataFrame, transports: pd.DataFrame, cache_dir: str = None, n_workers: int = 1) -> pd.DataFrame:
     """Main function to count the number of metros/trains within short_distance_station km from each housing unit in the training set.
 
     Args:
         train (pd.DataFrame): DVF train dataset.
         test (pd.DataFrame): DVF test dataset.
         transports (pd.DataFrame): open dataset from Ile-de-France Mobilités.
-        short_distance_station (float, optional): distance in kilometers for which we compute the # of connections. Defaults to 0.5.
+        cache_dir (str, optional): feature cache directory (e.g. cst.FEATURE_CACHE_PATH). If set, counts are stored by
+            coordinates and only unseen coordinates are computed. Defaults to None.
+        n_workers (int, optional): number of processes counting stations (None for the number of CPUs, see
+            `count_close_stations_housing_units_in_parallel`). Defaults to 1.
 
     Returns:
-        pd.DataFrame: [description]
+        pd.DataFrame, pd.DataFrame: train and test sets with station counts
     """
     # Set parameters
-    limit_distance = cst.limit_distance_district_center
     short_distance_station = cst.short_distance_station
 
-    # Preprocess the `transports` dataset
+    # Preprocess the `transports` dataset and index stations by location
     transports = get_transportation_count_per_station(transports)
+    station_index = build_station_index(transports)
 
-    # Preprocess the `data` dataset by adding coordinates
-    train = create_housing_unit_coordinates_col(train)
-    test = create_housing_unit_coordinates_col(test)
+    # Count the number of stations close to each housing unit
+    instrumentation.progress('station_counts', dataset='train', n_units=train.shape[0])
+    train = count_close_stations_all_housing_units_in_dataset(train, transports, station_index, short_distance_station, cache_dir, n_workers)
 
-    # Get the district centers
-    average_coordinates = compute_average_coordinates_by_district(train)
+    instrumentation.progress('station_counts', dataset='test', n_units=test.shape[0])
+    test = count_close_stations_all_housing_units_in_dataset(test, transports, station_index, short_distance_station, cache_dir, n_workers)
+    return train, test
 
-    # Get the stations that lie within limit_distance kilometers from each district center
-    closest_stations_per_district = get_closest_stations_dict_per_district(average_coordinates, transports, limit_distance)
 
-    # Count the number of stations close to each housing unit (in train)
-    print('Preprocessing train...')
-    train = count_close_stations_all_housing_units_in_dataset(train, closest_stations_per_district, short_distance_station)
+def count_close_stations_all_housing_units_in_dataset(data: pd.DataFrame, transports: pd.DataFrame, station_index, short_distance_station: float, cache_dir: str = None, n_workers: int = 1) -> pd.DataFrame:
+    """Function to count the number of metros/trains within short_distance_station km from each housing unit in a dataset.
+    Stations are retrieved with radius queries on the station index (see `proximity.compute_proximity_features`).
 
-    print('Preprocessing test...')
-    test = count_close_stations_all_housing_units_in_dataset(test, closest_stations_per_district, short_distance_station)
-    return train, test
+    Args:
+        data (pd.DataFrame): DVF dataset with lat/lon columns.
+        transports (pd.DataFrame): output of `get_transportation_count_per_station`.
+        station_index (dict): proximity index of stations built with `build_station_index`.
+        short_distance_station (float): geographic perimeter to count metro/train stations. Defaults to 0.5.
+        cache_dir (str, optional): feature cache directory. Defaults to None (no cache).
+        n_workers (int, optional): number of processes counting stations (None for the number of CPUs). Defaults to 1.
 
+    Returns:
+        pd.DataFrame: same dataset with `n_metros_within_{d}km` and `n_trains_within_{d}km` columns
+    """
+    units_lat, units_lon = data['lat'].to_numpy(dtype=float), data['lon'].to_numpy(dtype=float)
+    if cache_dir is None:
+        n_transports = count_close_stations_housing_units(units_lat, units_lon, transports, station_index, short_distance_station, n_workers)
+    else:
+        n_transports = count_close_stations_housing_units_with_cache(units_lat, units_lon, transports, station_index, short_distance_station, cache_dir, n_workers)
 
-def count_close_stations_all_housing_units_in_dataset(data: pd.DataFrame, closest_stations_dict_per_district: dict, short_distance_station: float):
-    n_metros_units = []
-    n_trains_units = []
+    data[f'n_metros_within_{short_distance_station}km'] = n_transports['n_metros']
+    data[f'n_trains_within_{short_distance_station}km'] = n_transports['n_trains']
+    return schema.apply_housing_schema(data)
 
-    count = 0
 
-    for _, unit_row in data.iterrows():
-        # For tracking purposes in the notebook (could be replaced by a logger)
-        count += 1 
-        if count%1000==0:
-            print(f'Processed {count} units...')
-        
-        unit_coordinates = unit_row['coordinates']
-        unit_district = unit_row['district']
-        n_transports = count_close_stations_housing_unit(
-            unit_coordinates, unit_district, closest_stations_dict_per_district, short_distance_station
-        )
-        n_metros_units.append(n_transports['n_metros'])
-        n_trains_units.append(n_transports['n_trains'])
+def count_close_stations_housing_units(units_lat: np.ndarray, units_lon: np.ndarray, transports: pd.DataFrame, station_index, short_distance_station: float, n_workers: int = 1) -> dict:
+    """Function to count the number of metro/train connections that lie within 0.5km of a batch of housing units.
+
+    Args:
+        units_lat (np.ndarray): latitudes of the housing units.
+        units_lon (np.ndarray): longitudes of the housing units.
+        transports (pd.DataFrame): output of `get_transportation_count_per_station`.
+        station_index (dict): proximity index of stations built with `build_station_index`.
+        short_distance_station (float): geographic perimeter to count metro/train stations. Defaults to 0.5.
+        n_workers (int, optional): number of processes counting stations (None for the number of CPUs). Defaults to 1.
+
+    Returns:
+        dict: {n_metros: array,  n_trains: array} within short_distance_station kilometers from each housing unit.
+    """
+    if n_workers != 1 and len(units_lat) > cst.distance_chunk_size:
+        return count_close_stations_housing_units_in_parallel(units_lat, units_lon, transports, short_distance_station, n_workers)
 
-    data[f'n_metros_within_{short_distance_station}km'] = n_metros_units
-    data[f'n_trains_within_{short_distance_station}km'] = n_trains_units
-    return data
+    return count_close_stations(units_lat, units_lon, station_index, short_distance_station)
 
 
-def count_close_stations_housing_unit(unit_coordinates: tuple, unit_district: str, closest_stations_dict_per_district: dict, short_distance_station: float) -> dict:
-    """Function to count the number of stations that lie within 0.5km of a given housing unit. 
+def count_close_stations(units_lat: np.ndarray, units_lon: np.ndarray, station_index: dict, short_distance_station: float, report_progress: bool = True) -> dict:
+    """Count the metro and train (train + RER) connections of the stations within short_distance_station km of each
+    housing unit, with `proximity.compute_proximity_features`.
 
     Args:
-        unit_coordinates (tuple): coordinates of the housing unit.
-        unit_district (str): district of the housing unit.
-        closest_stations_dict_per_district (dict): dictionary with stations within 1.2km of the district center for each district.
-        short_distance_station (float): geographic perimeter to count metro/train stations. Defaults to 0.5.
+        units_lat (np.ndarray): latitudes of the housing units.
+        units_lon (np.ndarray): longitudes of the housing units.
+        station_index (dict): proximity index of stations built with `build_station_index`.
+        short_distance_station (float): geographic perimeter to count metro/train stations.
+        report_progress (bool, optional): emit progress events. Defaults to True.
 
     Returns:
-        dict: {n_metros: x,  n_trains: y} within short_distance_station kilometers from the housing unit.
+        dict: {n_metros: array,  n_trains: array} within short_distance_station kilometers from each housing unit.
     """
-    
-    # Get stations that are less than 1.2km away from the district center (for computation time purpose)
-    closest_stations_district_df = closest_stations_dict_per_district[unit_district]
-    closest_stations_district_df['distance_to_unit'] = closest_stations_district_df['station_coordinates'].apply(
-        lambda station_coord: distance.geodesic(station_coord, unit_coordinates)
+    features = proximity.compute_proximity_features(
+        units_lat, units_lon, station_index, [short_distance_station], nearest=False, report_progress=report_progress
     )
+    return {key: features[f'{key}_within_{short_distance_station}km'].to_numpy() for key in ['n_metros', 'n_trains']}
 
-    # Filter stations that are below short_distance_station kilometers (0.5 by default)
-    short_distance_stations = closest_stations_district_df.query('distance_to_unit <= @short_distance_station')
 
-    # Count the total number of outbound connections from short distance stations (metro & train/RER)
-    n_transports = {'n_metros': 0, 'n_trains': 0}
-    if closest_stations_district_df.shape[0] > 0:
-        n_transports['n_metros'] = short_distance_stations['metro'].sum()
-        n_transports['n_trains'] = short_distance_stations[['train', 'rer']].sum().sum()
+def build_station_index(transports: pd.DataFrame) -> dict:
+    """Build a proximity index over stations (see `proximity.build_proximity_index`), with the number of metro and
+    train connections of each station as values.
 
-    return n_transports
+    Args:
+        transports (pd.DataFrame): output of `get_transportation_count_per_station`.
+
+    Returns:
+        dict: proximity index of stations
+    """
+    return proximity.build_proximity_index({'stations': get_station_poi_table(transports)})
 
 
-def get_closest_stations_dict_per_district(average_coordinates: pd.DataFrame, transports: pd.DataFrame, limit_distance: float) -> dict: 
-    """Function to store a dataframe with all stations below limit_distance kilometers from a district's center, for each district.
-    The goal is to limit the number of stations for which we compute the exact distance to a given housing unit. 
-    We assume that stations that are further than 1.2km away from a unit's district center will not lie within 0.5km from the unit. 
+def get_station_poi_table(transports: pd.DataFrame) -> pd.DataFrame:
+    """Get the coordinates and the number of metro and train (train + RER) connections of each station.
 
     Args:
-        average_coordinates (pd.DataFrame): a dataset with the district center coordinates for each district.
-        transports (pd.DataFrame): a dataset with IDF stations and their geographic coordinates.
-        limit_distance (float): distance limit in kilometers from the district center . Defaults to 1.2.
+        transports (pd.DataFrame): output of `get_transportation_count_per_station`.
 
     Returns:
-        dict: a dictionary with districts as keys and stations within 1.2km from the center stored in a dataframe with coordinates.
+        pd.DataFrame: lat, lon, metros and trains columns, one row per station
     """
-    closest_stations_per_district = {}
+    return pd.DataFrame({
+        'lat': transports['station_lat'].to_numpy(dtype=float),
+        'lon': transports['station_lon'].to_numpy(dtype=float),
+        'metros': transports['metro'].to_numpy(),
+        'trains': transports[['train', 'rer']].sum(axis=1).to_numpy(),
+    })
 
-    for _, district_row in average_coordinates.iterrows():
-        district_name = district_row['district']
-        district_coordinates = district_row['coordinates']
 
-        district_transports = transports.copy()
-        district_transports['distance_from_district_center'] = district_transports['station_coordinates'].apply(
-            lambda station_coord: distance.geodesic(station_coord, district_coordinates)
-        )
-        district_transports = district_transports.query("distance_from_district_center <= @limit_distance")
-        closest_stations_per_district[district_name] = district_transports
+def count_close_stations_housing_units_in_parallel(units_lat: np.ndarray, units_lon: np.ndarray, transports: pd.DataFrame, short_distance_station: float, n_workers: int = None) -> dict:
+    """Same as `count_close_stations_housing_units`, with units split into partitions counted by a pool of processes.
+    Units are sorted by spatial tile (`station_count_tile_size` degrees) so that each partition covers a compact area,
+    and the partitions are contiguous ranges of this order. Station coordinates and values, unit coordinates and
+    output counts live in a shared memory block: workers build the station index once, read their range of units
+    and write counts back at the original positions of the units, so only partition bounds are sent to workers.
 
-    return closest_stations_per_district
+    Args:
+        units_lat (np.ndarray): latitudes of the housing units.
+        units_lon (np.ndarray): longitudes of the housing units.
+        transports (pd.DataFrame): output of `get_transportation_count_per_station`.
+        short_distance_station (float): geographic perimeter to count metro/train stations.
+        n_workers (int, optional): number of processes. Defaults to None (number of CPUs).
 
+    Returns:
+        dict: {n_metros: array,  n_trains: array} within short_distance_station kilometers from each housing unit.
+    """
+    n_workers = n_workers or os.cpu_count()
+    n_units = len(units_lat)
+
+    tiles_lat = np.floor(units_lat / cst.station_count_tile_size)
+    tiles_lon = np.floor(units_lon / cst.station_count_tile_size)
+    order = np.lexsort((tiles_lon, tiles_lat))
+
+    # Several partitions per worker balance the load between dense and sparse areas
+    n_partitions = min(n_workers * cst.station_count_partitions_per_worker, -(-n_units // cst.distance_chunk_size))
+    bounds = np.linspace(0, n_units, n_partitions + 1).astype(int)
+
+    stations = get_station_poi_table(transports)
+    block, layout = shared_arrays.create_shared_arrays(
+        {f'station_{col}': stations[col].to_numpy() for col in stations.columns}
+        | {'units_lat': units_lat[order], 'units_lon': units_lon[order], 'order': order}
+        | {f'n_{col}': np.zeros(n_units, dtype=stations[col].dtype) for col in ['metros', 'trains']}
+    )
 
-def get_transportation_count_per_station(transports: pd.DataFrame) -> pd.DataFrame:
-    """Function to group station rows and count the total number of transportation means by station
+    try:
+        with ProcessPoolExecutor(
+            max_workers=min(n_workers, n_partitions), initializer=init_station_count_worker,
+            initargs=(block.name, layout, list(stations.columns), short_distance_station)
+        ) as executor:
+            futures = [executor.submit(count_close_stations_in_partition, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+            n_done = 0
+            for future in as_completed(futures):
+                n_done += future.result()
+                instrumentation.progress('station_counts', done=n_done, total=n_units)
+
+        arrays = shared_arrays.get_arrays_from_buffer(block.buf, layout)
+        n_transports = {key: arrays[key].copy() for key in ['n_metros', 'n_trains']}
+        del arrays
+    finally:
+        block.close()
+        block.unlink()
+
+    return n_transports
+
+
+def init_station_count_worker(block_name: str, layout: dict, station_cols: list, short_distance_station: float):
+    """Attach the shared arrays and build the station index once per worker process."""
+    block, arrays = shared_arrays.attach_shared_arrays(block_name, layout)
+    stations = pd.DataFrame({col: arrays[f'station_{col}'] for col in station_cols})
+    _worker_data.update(
+        block=block, arrays=arrays, short_distance_station=short_distance_station,
+        station_index=proximity.build_proximity_index({'stations': stations}),
+    )
+
+
+def count_close_stations_in_partition(start: int, stop: int) -> int:
+    """Count stations close to a range of the sorted units and write counts at their original positions."""
+    arrays = _worker_data['arrays']
+    n_transports = count_close_stations(
+        arrays['units_lat'][start:stop], arrays['units_lon'][start:stop], _worker_data['station_index'],
+        _worker_data['short_distance_station'], report_progress=False,
+    )
+    positions = arrays['order'][start:stop]
+    for key, counts in n_transports.items():
+        arrays[key][positions] = counts
+    return stop - start
+
+
+def count_close_stations_housing_units_with_cache(units_lat: np.ndarray, units_lon: np.ndarray, transports: pd.DataFrame, station_index, short_distance_station: float, cache_dir: str, n_workers: int = 1) -> dict:
+    """Same as `count_close_stations_housing_units`, reusing counts stored in the feature cache.
+    The cache table holds one row per distinct (lat, lon) and is keyed by the content of the transports dataset and
+    the geo parameters, so only coordinates that were never seen with these inputs are computed. Rows are partitioned
+    in cells of cst.feature_cache_cell_size_deg degrees: a call only reads the cells of its coordinates and appends the
+    new counts in new files, so its cost grows with the number of units rather than with the size of the cache.
 
     Args:
-        transports (pd.DataFrame): open dataset from Ile-de-France mobilités with inbound/outbound connections
+        units_lat (np.ndarray): latitudes of the housing units.
+        units_lon (np.ndarray): longitudes of the housing units.
+        transports (pd.DataFrame): output of `get_transportation_count_per_station`.
+        station_index (dict): proximity index of stations built with `build_station_index`.
+        short_distance_station (float): geographic perimeter to count metro/train stations. Defaults to 0.5.
+        cache_dir (str): feature cache directory.
+        n_workers (int, optional): number of processes counting stations (None for the number of CPUs). Defaults to 1.
 
     Returns:
-        pd.DataFrame: open dataset with a unique row per station
+        dict: {n_metros: array,  n_trains: array} within short_distance_station kilometers from each housing unit.
     """
-    transports_cols = ['fer', 'train', 'rer', 'metro']
-    func_agg_cols = {'Geo Point': 'first'} | {col: 'sum' for col in transports_cols}
-
-    transports = transports.groupby('nom_long').agg(func_agg_cols)
-    transports['station_coordinates'] = transports['Geo Point'].apply(
-        lambda point: get_coordinates_tuple_from_geopoint(point)
+    cache_key = feature_cache.get_cache_key(
+        'station_counts', transports[['Geo Point', 'train', 'rer', 'metro']], short_distance_station,
+        cst.earth_radius_km, cst.haversine_max_relative_error
+    )
+    units = pd.DataFrame({'lat': units_lat, 'lon': units_lon})
+    distinct_units = units.drop_duplicates()
+    distinct_units = distinct_units.assign(cell=get_cache_cells(distinct_units['lat'].to_numpy(), distinct_units['lon'].to_numpy()))
+
+    cached_counts = feature_cache.read_cache_partitions(cache_dir, cache_key, distinct_units['cell'].unique())
+    if cached_counts is None:
+        cached_counts = pd.DataFrame({'lat': [], 'lon': [], 'n_metros': [], 'n_trains': []}).astype({'n_metros': np.int64, 'n_trains': np.int64})
+    # Concurrent calls may append the same coordinates twice
+    cached_counts = cached_counts.drop_duplicates(subset=['lat', 'lon'])
+
+    new_units = distinct_units.merge(cached_counts[['lat', 'lon']], how='left', on=['lat', 'lon'], indicator=True)
+    new_units = new_units.query("_merge == 'left_only'").drop(columns='_merge')
+
+    instrumentation.count('station_count_cache_hits', distinct_units.shape[0] - new_units.shape[0])
+    instrumentation.count('station_count_cache_misses', new_units.shape[0])
+    if new_units.shape[0] > 0:
+        new_counts = count_close_stations_housing_units(
+            new_units['lat'].to_numpy(), new_units['lon'].to_numpy(), transports, station_index, short_distance_station, n_workers
         )
+        new_units = new_units.assign(**new_counts)
+        feature_cache.append_cache_partitions(cache_dir, cache_key, new_units, 'cell')
+        cached_counts = pd.concat([cached_counts, new_units.drop(columns='cell')], ignore_index=True)
 
-    return transports
+    n_transports = units.merge(cached_counts, how='left', on=['lat', 'lon'])
+    return {key: n_transports[key].to_numpy() for key in ['n_metros', 'n_trains']}
 
 
-def compute_average_coordinates_by_district(data: pd.DataFrame) -> pd.DataFrame:
-    """Function that computes the district center coordinates for each district using the average from the training set 
+def get_cache_cells(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Get the name of the feature cache partition of each coordinate, a cell of cst.feature_cache_cell_size_deg degrees.
 
     Args:
-        data (pd.DataFrame): DVF dataset
+        lat (np.ndarray): latitudes.
+        lon (np.ndarray): longitudes.
 
     Returns:
-        pd.DataFrame: dataset with the district name and associated district center as a tuple
+        np.ndarray: cell names such as '977_46'
     """
-    average_coordinates = data.groupby('district')[['lat', 'lon']].mean().reset_index()
-    average_coordinates = create_housing_unit_coordinates_col(average_coordinates)
-    return average_coordinates.drop(columns=['lat', 'lon'])
+    lat_cells = np.floor(np.asarray(lat, dtype=float) / cst.feature_cache_cell_size_deg).astype(np.int64).astype(str)
+    lon_cells = np.floor(np.asarray(lon, dtype=float) / cst.feature_cache_cell_size_deg).astype(np.int64).astype(str)
+    return np.char.add(np.char.add(lat_cells, '_'), lon_cells)
 
 
-def create_housing_unit_coordinates_col(data: pd.DataFrame) -> pd.DataFrame:
-    """Create a column with coordinates as a tuple from lat and lon columns
+def get_transportation_count_per_station(transports: pd.DataFrame) -> pd.DataFrame:
+    """Function to group station rows and count the total number of transportation means by station
 
     Args:
-        data (pd.DataFrame): any dataset with lat/lon columns stored as floats
+        transports (pd.DataFrame): open dataset from Ile-de-France mobilités with inbound/outbound connections
 
     Returns:
-        pd.DataFrame: same dataset with coordinates stored in a column
+        pd.DataFrame: open dataset with a unique row per station
     """
-    data['coordinates'] = data['lat'].astype(str) + ',' + data['lon'].astype(str)
-    data['coordinates'] = data['coordinates'].apply(
-        lambda point: get_coordinates_tuple_from_geopoint(point)
-        )
-    return data
-    
+    transports_cols = ['fer', 'train', 'rer', 'metro']
+    func_agg_cols = {'Geo Point': 'first'} | {col: 'sum' for col in transports_cols}
+
+    transports = transports.groupby('nom_long').agg(func_agg_cols)
+    transports[['station_lat', 'station_lon']] = get_coordinates_from_geopoints(transports['Geo Point'])
+
+    return transports
+
 
-def get_coordinates_tuple_from_geopoint(geopoint: str) -> tuple:
-    """Process a geopoint stored as a string in "lat, lon" format into a coordinates tuple
+def get_coordinates_from_geopoints(geopoints: pd.Series) -> np.ndarray:
+    """Parse geopoints stored as strings in "lat, lon" format into an array of coordinates
 
     Args:
-        geopoint (str): "lat, lon" string-type geopoint
+        geopoints (pd.Series): "lat, lon" string-type geopoints
 
     Returns:
-        tuple: coordinates stored in a tuple
+        np.ndarray: lat and lon columns, one row per geopoint
     """
-    coords = [float(c) for c in geopoint.split(',')]
-    return tuple(coords)
\ No newline at end of file
+    return geopoints.str.split(',', expand=True).astype(float).to_numpy().reshape(-1, 2)
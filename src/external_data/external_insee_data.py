@@ -1,39 +1,58 @@
 import pandas as pd
-from geopy import distance
 
-import src.external_data.external_geo_data as ext_geo
+import src.feature_cache as feature_cache
+import src.instrumentation as instrumentation
+import src.schema as schema
+import src.external_data.spatial_index as spatial_index
 
-def add_external_insee_revenue_data(train: pd.DataFrame, test: pd.DataFrame, revenus: pd.DataFrame) -> pd.DataFrame:
+def add_external_insee_revenue_data(train: pd.DataFrame, test: pd.DataFrame, revenus: pd.DataFrame, cache_dir: str = None) -> pd.DataFrame:
     """Add 2018 median revenue data by IRIS code in train and test data. 
 
     Args:
         train (pd.DataFrame): train data
         test (pd.DataFrame): test data
         revenus (pd.DataFrame): INSEE revenue data
+        cache_dir (str, optional): feature cache directory (e.g. cst.FEATURE_CACHE_PATH). If set, the closest IRIS zones
+            are stored for the IRIS codes and coordinates of the rows. Defaults to None.
 
     Returns:
         pd.DataFrame, pd.DataFrame: train and test sets with revenue data
     """
     # Fix type of IRIS codes
-    train['code_iris'] = train['code_iris'].astype(int).astype(str)
-    test['code_iris'] = test['code_iris'].astype(int).astype(str)
+    train['code_iris'] = schema.to_iris_codes(train['code_iris'])
+    test['code_iris'] = schema.to_iris_codes(test['code_iris'])
 
     # Get a dictionary to map missing IRIS zones to the closest zone
-    closest_iris_to_non_mapped_dict = get_closest_iris_zone_to_missing_codes(train, test, revenus)
+    if cache_dir is None:
+        closest_iris_to_non_mapped_dict = get_closest_iris_zone_to_missing_codes(train, test, revenus)
+    else:
+        closest_iris_to_non_mapped_dict = get_closest_iris_zone_to_missing_codes_with_cache(train, test, revenus, cache_dir)
 
     # Replace missing IRIS
     train['code_iris_mappable'] = train['code_iris'].replace(closest_iris_to_non_mapped_dict)
     test['code_iris_mappable'] = test['code_iris'].replace(closest_iris_to_non_mapped_dict)
 
     # Merge median revenue value for 2018
-    median_revenue_dict = dict(revenus.set_index('IRIS')['DISP_MED18'])
+    median_revenue_dict = get_median_revenue_by_iris(revenus)
     train['med_revenue_iris_2018'] = train['code_iris_mappable'].map(median_revenue_dict)
     test['med_revenue_iris_2018'] = test['code_iris_mappable'].map(median_revenue_dict)
 
     train.drop(columns=['code_iris', 'code_iris_mappable'], inplace=True)
     test.drop(columns=['code_iris', 'code_iris_mappable'], inplace=True)
 
-    return train, test
+    return schema.apply_housing_schema(train), schema.apply_housing_schema(test)
+
+def get_median_revenue_by_iris(revenus: pd.DataFrame) -> dict:
+    """Get a dictionary with the 2018 median revenue of each IRIS code (as an integer, see `schema.to_iris_codes`).
+
+    Args:
+        revenus (pd.DataFrame): INSEE revenue data
+
+    Returns:
+        dict: mapping of IRIS codes to median revenue
+    """
+    revenus = revenus.assign(IRIS=schema.to_iris_codes(revenus['IRIS'])).dropna(subset=['IRIS'])
+    return dict(zip(revenus['IRIS'].astype(int), revenus['DISP_MED18']))
 
 def get_closest_iris_zone_to_missing_codes(train: pd.DataFrame, test: pd.DataFrame, revenus: pd.DataFrame) -> dict:
     """Get a dictionary with the closest available IRIS code for each IRIS code from train/test that is not available in INSEE data.
@@ -47,22 +66,115 @@ def get_closest_iris_zone_to_missing_codes(train: pd.DataFrame, test: pd.DataFra
         dict: mapping of missing IRIS codes to the closest IRIS zone
     """
     iris_mapped, iris_non_mapped = get_iris_codes(train, test, revenus)
+    avg_coordinates_by_iris = compute_average_coordinates_by_iris(train, test)
+    return get_closest_iris_zone_from_coordinates(
+        avg_coordinates_by_iris.loc[iris_mapped, :], avg_coordinates_by_iris.loc[iris_non_mapped, :]
+    )
+
+def get_closest_iris_zone_to_missing_codes_with_cache(train: pd.DataFrame, test: pd.DataFrame, revenus: pd.DataFrame, cache_dir: str) -> dict:
+    """Same as `get_closest_iris_zone_to_missing_codes`, reusing the results stored in the feature cache.
+    The cache table is keyed by the INSEE codes and holds the centroid of each IRIS code of the last call, with the
+    closest available zone and its distance for unavailable codes. As rows are added, only the centroids that moved are
+    looked up again: an unavailable code whose centroid and closest zone did not move keeps its closest zone unless an
+    available zone that moved (or appeared) is now closer, which is checked with a nearest neighbour query on these
+    zones only. Other unavailable codes are resolved against all available zones.
 
-    train_test_concat = pd.concat([train, test])[['code_iris', 'lat', 'lon']]
-    avg_coordinates_by_iris = train_test_concat.groupby('code_iris').mean()
-    avg_coordinates_by_iris = ext_geo.create_housing_unit_coordinates_col(avg_coordinates_by_iris)
-    avg_coordinates_by_iris_mapped = avg_coordinates_by_iris.loc[iris_mapped, :]
+    Args:
+        train (pd.DataFrame): train data
+        test (pd.DataFrame): test data
+        revenus (pd.DataFrame): INSEE revenue data
+        cache_dir (str): feature cache directory
 
-    closest_iris_to_non_mapped_dict = {}
-    for code in iris_non_mapped:
-        code_mean_coordinates = avg_coordinates_by_iris.loc[code, 'coordinates']
-        avg_coordinates_by_iris_mapped['dist_to_code'] = avg_coordinates_by_iris_mapped['coordinates'].apply(
-            lambda iris_coord: distance.geodesic(iris_coord, code_mean_coordinates).km
-        )
-        closest_mapped_iris = avg_coordinates_by_iris_mapped.sort_values('dist_to_code', ascending=True).index[0]
-        closest_iris_to_non_mapped_dict[code] = closest_mapped_iris
+    Returns:
+        dict: mapping of missing IRIS codes to the closest IRIS zone
+    """
+    avg_coordinates_by_iris = compute_average_coordinates_by_iris(train, test)
+    avg_coordinates_by_iris.index = avg_coordinates_by_iris.index.astype('int64')
+    avg_coordinates_by_iris['is_mapped'] = avg_coordinates_by_iris.index.isin(set(get_median_revenue_by_iris(revenus)))
+    cache_key = feature_cache.get_cache_key('closest_iris', revenus['IRIS'])
+    cached_iris = feature_cache.read_cache_table(cache_dir, cache_key)
+    if cached_iris is None:
+        cached_iris = pd.DataFrame({'code_iris': [], 'lat': [], 'lon': [], 'is_mapped': [], 'code_iris_mappable': [], 'distance_km': []})
+    n_cached_codes = cached_iris.shape[0]
+    cached_iris = cached_iris.astype({'code_iris': 'int64'}).set_index('code_iris').reindex(avg_coordinates_by_iris.index)
+
+    is_unchanged = (
+        (cached_iris['lat'] == avg_coordinates_by_iris['lat']) & (cached_iris['lon'] == avg_coordinates_by_iris['lon'])
+        & (cached_iris['is_mapped'] == avg_coordinates_by_iris['is_mapped'])
+    )
+    mapped = avg_coordinates_by_iris.loc[avg_coordinates_by_iris['is_mapped'], ['lat', 'lon']]
+    moved_mapped = mapped.loc[~is_unchanged[mapped.index]]
+    non_mapped = avg_coordinates_by_iris.loc[~avg_coordinates_by_iris['is_mapped'], ['lat', 'lon']]
+    closest_iris = cached_iris.loc[non_mapped.index, ['code_iris_mappable', 'distance_km']]
+
+    # Cached results are kept if the unavailable code and its closest zone did not move
+    is_reusable = is_unchanged[non_mapped.index] & closest_iris['code_iris_mappable'].isin(mapped.index.difference(moved_mapped.index))
+    instrumentation.count('closest_iris_cache_hits', int(is_reusable.sum()))
+    instrumentation.count('closest_iris_cache_misses', int((~is_reusable).sum()))
+    if mapped.shape[0] > 0 and non_mapped.shape[0] > 0:
+        closest_iris.loc[~is_reusable, :] = get_closest_iris_zone_and_distance(mapped, non_mapped.loc[~is_reusable])
+        # Zones that moved may now be closer than the cached closest zones
+        if moved_mapped.shape[0] > 0 and is_reusable.any():
+            closest_moved_iris = get_closest_iris_zone_and_distance(moved_mapped, non_mapped.loc[is_reusable])
+            is_closer = closest_moved_iris['distance_km'] < closest_iris.loc[is_reusable, 'distance_km']
+            closest_iris.loc[is_closer[is_closer].index, :] = closest_moved_iris.loc[is_closer]
+
+    if not is_unchanged.all() or n_cached_codes != avg_coordinates_by_iris.shape[0]:
+        feature_cache.write_cache_table(cache_dir, cache_key, avg_coordinates_by_iris.join(closest_iris).reset_index())
+
+    closest_iris = closest_iris.dropna(subset=['code_iris_mappable'])
+    return dict(zip(closest_iris.index, closest_iris['code_iris_mappable'].astype('int64')))
+
+def get_closest_iris_zone_and_distance(avg_coordinates_by_iris_mapped: pd.DataFrame, avg_coordinates_by_iris_non_mapped: pd.DataFrame) -> pd.DataFrame:
+    """Get the closest available IRIS code of each unavailable IRIS code, with the geodesic distance between their average coordinates.
 
-    return closest_iris_to_non_mapped_dict 
+    Args:
+        avg_coordinates_by_iris_mapped (pd.DataFrame): lat/lon of available IRIS codes, indexed by IRIS code
+        avg_coordinates_by_iris_non_mapped (pd.DataFrame): lat/lon of unavailable IRIS codes, indexed by IRIS code
+
+    Returns:
+        pd.DataFrame: code_iris_mappable and distance_km, indexed by unavailable IRIS code
+    """
+    if avg_coordinates_by_iris_non_mapped.shape[0] == 0:
+        return pd.DataFrame({'code_iris_mappable': [], 'distance_km': []}, index=avg_coordinates_by_iris_non_mapped.index)
+
+    # Index mapped IRIS centroids once, then resolve all missing codes with a single nearest neighbour query
+    iris_index = spatial_index.build_spatial_index(avg_coordinates_by_iris_mapped['lat'], avg_coordinates_by_iris_mapped['lon'])
+    closest_positions, closest_distances = spatial_index.query_nearest_geodesic(
+        iris_index, avg_coordinates_by_iris_non_mapped['lat'].to_numpy(), avg_coordinates_by_iris_non_mapped['lon'].to_numpy()
+    )
+    return pd.DataFrame({
+        'code_iris_mappable': avg_coordinates_by_iris_mapped.index[closest_positions], 'distance_km': closest_distances
+    }, index=avg_coordinates_by_iris_non_mapped.index)
+
+def get_closest_iris_zone_from_coordinates(avg_coordinates_by_iris_mapped: pd.DataFrame, avg_coordinates_by_iris_non_mapped: pd.DataFrame) -> dict:
+    """Get a dictionary with the closest available IRIS code for each unavailable IRIS code, from their average coordinates.
+
+    Args:
+        avg_coordinates_by_iris_mapped (pd.DataFrame): lat/lon of available IRIS codes, indexed by IRIS code
+        avg_coordinates_by_iris_non_mapped (pd.DataFrame): lat/lon of unavailable IRIS codes, indexed by IRIS code
+
+    Returns:
+        dict: mapping of missing IRIS codes to the closest IRIS zone
+    """
+    if avg_coordinates_by_iris_mapped.shape[0] == 0 or avg_coordinates_by_iris_non_mapped.shape[0] == 0:
+        return {}
+
+    closest_iris = get_closest_iris_zone_and_distance(avg_coordinates_by_iris_mapped, avg_coordinates_by_iris_non_mapped)
+    return dict(zip(closest_iris.index, closest_iris['code_iris_mappable']))
+
+def compute_average_coordinates_by_iris(train: pd.DataFrame, test: pd.DataFrame) -> pd.DataFrame:
+    """Compute the average coordinates of each IRIS code over train and test data.
+
+    Args:
+        train (pd.DataFrame): train data
+        test (pd.DataFrame): test data
+
+    Returns:
+        pd.DataFrame: lat/lon indexed by IRIS code
+    """
+    train_test_concat = pd.concat([train, test])[['code_iris', 'lat', 'lon']]
+    return train_test_concat.groupby('code_iris').mean()
 
 def get_iris_codes(train: pd.DataFrame, test: pd.DataFrame, revenus: pd.DataFrame) -> tuple:
     """Get lists of IRIS codes in train/test that are either available or unavailable in INSEE data.
@@ -73,13 +185,13 @@ def get_iris_codes(train: pd.DataFrame, test: pd.DataFrame, revenus: pd.DataFram
         revenus (pd.DataFrame): INSEE revenue data
 
     Returns:
-        tuple(list, list): lists available and unavailable IRIS codes
+        tuple(list, list): lists available and unavailable IRIS codes, without missing codes
     """
-    # Get all IRIS codes in train & test
-    iris_codes = set(list(train['code_iris']) + list(test['code_iris']))
+    # Get all IRIS codes in train & test (missing codes have no average coordinates, see `compute_average_coordinates_by_iris`)
+    iris_codes = set(pd.concat([train['code_iris'], test['code_iris']]).dropna())
 
     # Get IRIS codes available in INSEE data
-    insee_iris = set(revenus['IRIS'])
+    insee_iris = set(get_median_revenue_by_iris(revenus))
 
     # Separate mappable/non mappable codes
     iris_mapped, iris_non_mapped = [], []
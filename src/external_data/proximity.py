@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+
+import src.constants as cst
+import src.instrumentation as instrumentation
+import src.schema as schema
+import src.external_data.spatial_index as spatial_index
+
+def build_proximity_index(poi_tables: dict) -> dict:
+    """Build a single spatial index over several tables of points of interest (POI), e.g. stations, schools or parks.
+    Each table has lat/lon columns and optional numeric value columns (e.g. number of metro lines of a station),
+    which are summed over the POIs within each radius by `compute_proximity_features`.
+
+    Args:
+        poi_tables (dict): dictionary of POI type names and dataframes with lat, lon and value columns.
+            Value column names must be unique across tables.
+
+    Returns:
+        dict: proximity index (spatial index over all POIs, POI type and values of each indexed point)
+    """
+    value_names = [col for table in poi_tables.values() for col in table.columns if col not in ['lat', 'lon']]
+    if len(set(value_names)) < len(value_names):
+        raise ValueError(f'Value columns must be unique across POI tables, got {value_names}')
+
+    all_pois = pd.concat([table[['lat', 'lon']] for table in poi_tables.values()], ignore_index=True)
+    index = spatial_index.build_spatial_index(all_pois['lat'].to_numpy(dtype=float), all_pois['lon'].to_numpy(dtype=float))
+
+    poi_names = list(poi_tables)
+    poi_codes = np.repeat(np.arange(len(poi_names)), [table.shape[0] for table in poi_tables.values()])
+    values = {}
+    for poi_name, table in poi_tables.items():
+        for col in table.columns.drop(['lat', 'lon']):
+            # Values are aligned with the index: points of other POI types are worth 0
+            poi_values = np.zeros(len(poi_codes), dtype=table[col].dtype)
+            poi_values[poi_codes == poi_names.index(poi_name)] = table[col].to_numpy()
+            values[col] = poi_values
+
+    return {
+        'index': index,
+        # Input coordinates, which geodesic distances are computed from (degrees converted back from the radians of
+        # the index can differ in the last bits, which changes distances within a nanometer of the radius)
+        'coordinates': all_pois[['lat', 'lon']].to_numpy(dtype=float),
+        'poi_names': poi_names,
+        'poi_codes': poi_codes,
+        'poi_indexes': {
+            poi_name: spatial_index.build_spatial_index(table['lat'].to_numpy(dtype=float), table['lon'].to_numpy(dtype=float))
+            for poi_name, table in poi_tables.items()
+        },
+        'values': values,
+    }
+
+
+def get_proximity_feature_names(proximity_index: dict, radii: list, nearest: bool = True) -> list:
+    """Get the names of the columns computed by `compute_proximity_features`, e.g. to fill a features_dict:
+    `n_{poi}_within_{radius}km` (number of POIs), `n_{value}_within_{radius}km` (sum of a value column over POIs) and
+    `distance_to_nearest_{poi}_km` (haversine distance to the nearest POI).
+
+    Args:
+        proximity_index (dict): output of `build_proximity_index`.
+        radii (list): distance limits in kilometers.
+        nearest (bool, optional): include nearest POI distances. Defaults to True.
+
+    Returns:
+        list: feature names
+    """
+    names = []
+    for radius in sorted(set(radii)):
+        names += [f'n_{poi_name}_within_{radius}km' for poi_name in proximity_index['poi_names']]
+        names += [f'n_{value_name}_within_{radius}km' for value_name in proximity_index['values']]
+    if nearest:
+        names += [f'distance_to_nearest_{poi_name}_km' for poi_name in proximity_index['poi_names']]
+    return names
+
+
+def compute_proximity_features(units_lat: np.ndarray, units_lon: np.ndarray, proximity_index: dict, radii: list, nearest: bool = True, exact_boundary: bool = True, report_progress: bool = True) -> pd.DataFrame:
+    """Count POIs and sum their values within several radii of each housing unit, and get the distance to the nearest
+    POI of each type. The index is queried once per unit at the largest radius, and the candidates are then filtered
+    for every radius, so additional radii and POI types only add array operations.
+
+    As in `spatial_index.query_radius`, haversine distances that fall within the error band around any radius are
+    re-evaluated as geodesic distances if exact_boundary is set to True (see `spatial_index.get_geodesic_distances`),
+    so counts are identical to a filter on geopy distances.
+    Nearest distances are haversine distances.
+
+    Args:
+        units_lat (np.ndarray): latitudes of the housing units.
+        units_lon (np.ndarray): longitudes of the housing units.
+        proximity_index (dict): output of `build_proximity_index`.
+        radii (list): distance limits in kilometers.
+        nearest (bool, optional): compute nearest POI distances. Defaults to True.
+        exact_boundary (bool, optional): resolve ambiguous distances as geodesic distances. Defaults to True.
+        report_progress (bool, optional): emit a progress event after each chunk of `distance_chunk_size` units.
+            Defaults to True.
+
+    Returns:
+        pd.DataFrame: one row per housing unit, with columns named as in `get_proximity_feature_names`
+    """
+    radii = sorted(set(radii))
+    features = {name: [] for name in get_proximity_feature_names(proximity_index, radii, nearest)}
+
+    for chunk_start in range(0, len(units_lat), cst.distance_chunk_size):
+        chunk = slice(chunk_start, chunk_start + cst.distance_chunk_size)
+        chunk_features = compute_proximity_features_in_chunk(
+            np.asarray(units_lat[chunk], dtype=float), np.asarray(units_lon[chunk], dtype=float),
+            proximity_index, radii, nearest, exact_boundary
+        )
+        for name, values in chunk_features.items():
+            features[name].append(values)
+        if report_progress:
+            instrumentation.progress('proximity_features', done=min(chunk_start + cst.distance_chunk_size, len(units_lat)), total=len(units_lat))
+
+    return pd.DataFrame({
+        name: np.concatenate(values) if values else np.zeros(0, dtype=get_feature_dtype(proximity_index, name))
+        for name, values in features.items()
+    })
+
+
+def compute_proximity_features_in_chunk(units_lat: np.ndarray, units_lon: np.ndarray, proximity_index: dict, radii: list, nearest: bool, exact_boundary: bool) -> dict:
+    """Compute the proximity features of a chunk of housing units (see `compute_proximity_features`)."""
+    n_units = len(units_lat)
+    error = cst.haversine_max_relative_error if exact_boundary else 0
+    max_radius = radii[-1]
+
+    # Flatten the (unit, POI) candidate pairs within the largest radius
+    query_points = np.radians(np.column_stack([units_lat, units_lon]).astype(float))
+    indices, distances = proximity_index['index'].query_radius(
+        query_points, r=(max_radius + max_radius * error) / cst.earth_radius_km, return_distance=True
+    )
+    n_candidates = np.array([len(unit_indices) for unit_indices in indices], dtype=np.int64)
+    units = np.repeat(np.arange(n_units), n_candidates)
+    points = np.concatenate(indices).astype(np.int64)
+    haversine_distances = np.concatenate(distances) * cst.earth_radius_km
+    instrumentation.count('haversine_distances', len(points))
+
+    pair_distances = haversine_distances
+    if exact_boundary:
+        uncertain = np.zeros(len(points), dtype=bool)
+        for radius in radii:
+            error_margin = radius * error
+            uncertain |= (haversine_distances >= radius - error_margin) & (haversine_distances <= radius + error_margin)
+
+        if uncertain.any():
+            uncertain_units, uncertain_points = units[uncertain], proximity_index['coordinates'][points[uncertain]]
+            pair_distances = haversine_distances.copy()
+            pair_distances[uncertain] = spatial_index.get_geodesic_distances(
+                units_lat[uncertain_units], units_lon[uncertain_units], uncertain_points[:, 0], uncertain_points[:, 1], radii
+            )
+
+    features = {}
+    for radius in radii:
+        within = pair_distances <= radius
+        units_within, points_within = units[within], points[within]
+        poi_codes_within = proximity_index['poi_codes'][points_within]
+
+        for poi_code, poi_name in enumerate(proximity_index['poi_names']):
+            features[f'n_{poi_name}_within_{radius}km'] = np.bincount(units_within[poi_codes_within == poi_code], minlength=n_units)
+        for value_name, values in proximity_index['values'].items():
+            sums = np.bincount(units_within, weights=values[points_within], minlength=n_units)
+            features[f'n_{value_name}_within_{radius}km'] = sums.astype(values.dtype)
+
+    if nearest:
+        features |= get_nearest_poi_distances(units_lat, units_lon, proximity_index, units, points, haversine_distances)
+    return features
+
+
+def get_nearest_poi_distances(units_lat: np.ndarray, units_lon: np.ndarray, proximity_index: dict, units: np.ndarray, points: np.ndarray, haversine_distances: np.ndarray) -> dict:
+    """Get the haversine distance to the nearest POI of each type from the candidate pairs of the radius query, and
+    query the index of the POI type only for units without any candidate of that type."""
+    features = {}
+    poi_codes = proximity_index['poi_codes'][points]
+    for poi_code, poi_name in enumerate(proximity_index['poi_names']):
+        is_poi = poi_codes == poi_code
+        nearest_distances = np.full(len(units_lat), np.inf)
+        np.minimum.at(nearest_distances, units[is_poi], haversine_distances[is_poi])
+
+        missing = np.isinf(nearest_distances)
+        if missing.any() and proximity_index['poi_indexes'][poi_name].data.shape[0] > 0:
+            _, missing_distances = spatial_index.query_nearest(
+                proximity_index['poi_indexes'][poi_name], units_lat[missing], units_lon[missing], k=1
+            )
+            nearest_distances[missing] = missing_distances[:, 0]
+        features[f'distance_to_nearest_{poi_name}_km'] = nearest_distances
+    return features
+
+
+def get_feature_dtype(proximity_index: dict, name: str):
+    """Type of a proximity feature, to build empty columns."""
+    if name.startswith('distance_to_nearest_'):
+        return float
+    for value_name, values in proximity_index['values'].items():
+        if name.startswith(f'n_{value_name}_within_'):
+            return values.dtype
+    return np.int64
+
+
+def add_proximity_features(data: pd.DataFrame, proximity_index: dict, radii: list = cst.proximity_radii, nearest: bool = True) -> pd.DataFrame:
+    """Add proximity features (see `compute_proximity_features`) to a dataset with lat/lon columns.
+
+    Args:
+        data (pd.DataFrame): dataset with lat/lon columns.
+        proximity_index (dict): output of `build_proximity_index`.
+        radii (list, optional): distance limits in kilometers. Defaults to cst.proximity_radii.
+        nearest (bool, optional): add nearest POI distances. Defaults to True.
+
+    Returns:
+        pd.DataFrame: same dataset with proximity feature columns (small integer counts and float32 distances)
+    """
+    features = compute_proximity_features(
+        data['lat'].to_numpy(dtype=float), data['lon'].to_numpy(dtype=float), proximity_index, radii, nearest
+    )
+    features = schema.apply_housing_schema(features)
+    for name in features.columns:
+        data[name] = features[name].to_numpy()
+    return data
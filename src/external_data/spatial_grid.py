@@ -0,0 +1,191 @@
+"""Precomputed features on a regular grid of small cells, stored as memory-mapped arrays.
+
+Features that only depend on the location of a housing unit (e.g. station counts) are computed once at the center
+of each cell: looking them up for a unit is then an index computation and an array read. A grid is a directory with
+one `.npy` file per feature (flat arrays of row-major cells) and a `metadata.json` file describing the cells, written
+last so that a grid is only read once complete.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import src.constants as cst
+
+METADATA_FILE_NAME = 'metadata.json'
+
+
+def get_grid_geometry(bounds: tuple = cst.spatial_grid_bounds, cell_size_m: float = cst.spatial_grid_cell_size_m) -> dict:
+    """Get the cells of a regular latitude/longitude grid with square cells of about cell_size_m meters.
+    The longitude step is scaled by the cosine of the central latitude, so cells are square at city scale.
+
+    Args:
+        bounds (tuple, optional): (lat_min, lat_max, lon_min, lon_max) of the grid. Defaults to cst.spatial_grid_bounds.
+        cell_size_m (float, optional): side of the cells in meters. Defaults to cst.spatial_grid_cell_size_m.
+
+    Returns:
+        dict: grid geometry (bounds, cell steps in degrees and number of rows and columns)
+    """
+    lat_min, lat_max, lon_min, lon_max = bounds
+    lat_step = np.degrees(cell_size_m / 1000 / cst.earth_radius_km)
+    lon_step = lat_step / np.cos(np.radians((lat_min + lat_max) / 2))
+    return {
+        'lat_min': lat_min,
+        'lon_min': lon_min,
+        'lat_step': float(lat_step),
+        'lon_step': float(lon_step),
+        'n_rows': int(np.ceil((lat_max - lat_min) / lat_step)),
+        'n_cols': int(np.ceil((lon_max - lon_min) / lon_step)),
+        'cell_size_m': cell_size_m,
+    }
+
+
+def get_cell_centers(geometry: dict) -> tuple:
+    """Get the latitudes and longitudes of the centers of all cells, in row-major order."""
+    lat = geometry['lat_min'] + (np.arange(geometry['n_rows']) + 0.5) * geometry['lat_step']
+    lon = geometry['lon_min'] + (np.arange(geometry['n_cols']) + 0.5) * geometry['lon_step']
+    return np.repeat(lat, geometry['n_cols']), np.tile(lon, geometry['n_rows'])
+
+
+def get_cell_positions(geometry: dict, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Get the position of the cell containing each point in the flat feature arrays, or -1 for points outside
+    the grid (or with missing coordinates).
+
+    Args:
+        geometry (dict): output of `get_grid_geometry`.
+        lat (np.ndarray): latitudes of the points.
+        lon (np.ndarray): longitudes of the points.
+
+    Returns:
+        np.ndarray: cell positions
+    """
+    rows = np.floor((np.asarray(lat, dtype=float) - geometry['lat_min']) / geometry['lat_step'])
+    cols = np.floor((np.asarray(lon, dtype=float) - geometry['lon_min']) / geometry['lon_step'])
+    inside = (rows >= 0) & (rows < geometry['n_rows']) & (cols >= 0) & (cols < geometry['n_cols'])
+
+    positions = np.full(len(rows), -1, dtype=np.int64)
+    positions[inside] = rows[inside].astype(np.int64) * geometry['n_cols'] + cols[inside].astype(np.int64)
+    return positions
+
+
+def write_spatial_grid(path: str, geometry: dict, features: dict, metadata: dict = None):
+    """Write the features of all cells of a grid to a directory, readable with `load_spatial_grid`.
+
+    Args:
+        path (str): grid directory.
+        geometry (dict): output of `get_grid_geometry`.
+        features (dict): dictionary of feature names and arrays with one value per cell (see `get_cell_centers`).
+        metadata (dict, optional): additional JSON-serializable metadata (e.g. a build key and report). Defaults to None.
+    """
+    n_cells = geometry['n_rows'] * geometry['n_cols']
+    os.makedirs(path, exist_ok=True)
+    # Remove the metadata of a previous grid first, so that a partially written grid is never read
+    if os.path.exists(os.path.join(path, METADATA_FILE_NAME)):
+        os.remove(os.path.join(path, METADATA_FILE_NAME))
+
+    for name, values in features.items():
+        if len(values) != n_cells:
+            raise ValueError(f'Feature {name} has {len(values)} values for {n_cells} cells')
+        np.save(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(values))
+
+    metadata = (metadata or {}) | {
+        'geometry': geometry,
+        'features': {name: np.asarray(values).dtype.str for name, values in features.items()},
+    }
+    with open(os.path.join(path, METADATA_FILE_NAME), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def read_grid_metadata(path: str) -> dict:
+    """Read the metadata of a grid, or None if the directory does not contain a complete grid."""
+    metadata_path = os.path.join(path, METADATA_FILE_NAME)
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+def load_spatial_grid(path: str) -> dict:
+    """Load a grid written with `write_spatial_grid`. Feature arrays are memory-mapped: only the pages of the cells
+    that are looked up are read, and processes loading the same grid share them through the page cache.
+
+    Args:
+        path (str): grid directory.
+
+    Returns:
+        dict: grid (metadata, geometry and read-only feature arrays)
+    """
+    metadata = read_grid_metadata(path)
+    if metadata is None:
+        raise ValueError(f'No spatial grid in {path}')
+    return {
+        'metadata': metadata,
+        'geometry': metadata['geometry'],
+        'features': {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in metadata['features']},
+    }
+
+
+def lookup_spatial_grid(grid: dict, lat: np.ndarray, lon: np.ndarray) -> tuple:
+    """Get the features of the cells containing a batch of points.
+
+    Args:
+        grid (dict): output of `load_spatial_grid`.
+        lat (np.ndarray): latitudes of the points.
+        lon (np.ndarray): longitudes of the points.
+
+    Returns:
+        tuple(dict, np.ndarray): dictionary of feature names and arrays (writable copies, with zeros for points
+        outside the grid) and mask of the points inside the grid
+    """
+    positions = get_cell_positions(grid['geometry'], lat, lon)
+    inside = positions >= 0
+    features = {}
+    for name, values in grid['features'].items():
+        features[name] = np.zeros(len(positions), dtype=values.dtype)
+        features[name][inside] = values[positions[inside]]
+    return features, inside
+
+
+def get_accuracy_report(grid_features: dict, exact_features: dict) -> dict:
+    """Compare features looked up in a grid with features computed exactly for the same points.
+
+    Args:
+        grid_features (dict): dictionary of feature names and arrays looked up in the grid.
+        exact_features (dict): dictionary of feature names and arrays computed exactly.
+
+    Returns:
+        dict: share of identical values, mean and max absolute error and mean exact value by feature
+    """
+    report = {}
+    for name, exact_values in exact_features.items():
+        # Exact values are compared at the precision of the grid (e.g. float32 revenues)
+        exact_values = np.asarray(exact_values).astype(grid_features[name].dtype).astype(float)
+        errors = np.abs(np.asarray(grid_features[name], dtype=float) - exact_values)
+        report[name] = {
+            'share_identical': float(np.mean(errors == 0)) if len(errors) else None,
+            'mean_absolute_error': float(np.nanmean(errors)) if len(errors) else None,
+            'max_absolute_error': float(np.nanmax(errors)) if len(errors) else None,
+            'mean_exact_value': float(np.nanmean(exact_values)) if len(errors) else None,
+        }
+    return report
+
+
+def get_majority_values(positions: np.ndarray, values: np.ndarray, fill_values: np.ndarray) -> np.ndarray:
+    """Get the most frequent value of the points in each cell, or the fill value of the cell for cells without points.
+
+    Args:
+        positions (np.ndarray): cell positions of the points (-1 for points outside the grid).
+        values (np.ndarray): values of the points.
+        fill_values (np.ndarray): values of the cells without points, one per cell.
+
+    Returns:
+        np.ndarray: one value per cell
+    """
+    inside = (positions >= 0) & ~pd.isna(values)
+    votes = pd.DataFrame({'position': positions[inside], 'value': values[inside]}).value_counts(sort=True)
+    majority = votes.index.to_frame(index=False).drop_duplicates('position')
+
+    cell_values = np.array(fill_values, copy=True)
+    cell_values[majority['position'].to_numpy()] = majority['value'].to_numpy()
+    return cell_values
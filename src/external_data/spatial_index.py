@@ -0,0 +1,196 @@
+import numpy as np
+
+import src.constants as cst
+import src.instrumentation as instrumentation
+
+# sklearn is imported when an index is built and geopy by the functions computing geodesic distances, only when a
+# distance is ambiguous, so that loading the module (e.g. in a scoring process using a spatial grid) stays fast
+
+def build_spatial_index(lat: np.ndarray, lon: np.ndarray):
+    """Build a ball tree over a set of points using the haversine metric, to answer radius and nearest neighbour queries.
+    Index positions follow the order of the input arrays.
+
+    Args:
+        lat (np.ndarray): latitudes of the points (in degrees).
+        lon (np.ndarray): longitudes of the points (in degrees).
+
+    Returns:
+        BallTree: spatial index
+    """
+    from sklearn.neighbors import BallTree
+
+    points = np.radians(np.column_stack([lat, lon]).astype(float))
+    return BallTree(points, metric='haversine')
+
+
+def query_radius(index, lat: np.ndarray, lon: np.ndarray, radius: float, exact_boundary: bool = True) -> tuple:
+    """Get all indexed points that lie within radius kilometers from each query point.
+    Distances are haversine distances, whose relative error against the WGS-84 geodesic distance computed by geopy
+    is below `haversine_max_relative_error`. If exact_boundary is set to True, the index is queried with a radius
+    extended by this error, and points whose distance falls within the error band are re-evaluated with geopy,
+    so that the result is identical to a geodesic-based filter.
+
+    Args:
+        index (BallTree): spatial index built with `build_spatial_index`.
+        lat (np.ndarray): latitudes of the query points.
+        lon (np.ndarray): longitudes of the query points.
+        radius (float): distance limit in kilometers.
+        exact_boundary (bool, optional): resolve ambiguous points with geopy. Defaults to True.
+
+    Returns:
+        tuple(np.ndarray, np.ndarray): arrays (of object dtype) with, for each query point, the positions of the
+        points within radius kilometers and their distances in kilometers
+    """
+    query_points = np.radians(np.column_stack([lat, lon]).astype(float))
+    error_margin = radius * cst.haversine_max_relative_error if exact_boundary else 0
+    query_radius_rad = (radius + error_margin) / cst.earth_radius_km
+
+    indices, distances = index.query_radius(query_points, r=query_radius_rad, return_distance=True)
+    distances = distances * cst.earth_radius_km
+    if instrumentation.is_enabled():
+        instrumentation.count('haversine_distances', sum(len(query_indices) for query_indices in indices))
+    if not exact_boundary:
+        return indices, distances
+
+    from geopy import distance
+    index_points = np.degrees(np.asarray(index.data))
+    for query, (query_indices, query_distances) in enumerate(zip(indices, distances)):
+        uncertain = query_distances >= radius - error_margin
+        if not uncertain.any():
+            continue
+        instrumentation.count('geodesic_distances', int(uncertain.sum()))
+        query_distances = query_distances.copy()
+        query_distances[uncertain] = [
+            distance.geodesic((lat[query], lon[query]), tuple(index_points[position])).km
+            for position in query_indices[uncertain]
+        ]
+        keep = query_distances <= radius
+        indices[query], distances[query] = query_indices[keep], query_distances[keep]
+
+    return indices, distances
+
+
+def query_nearest(index, lat: np.ndarray, lon: np.ndarray, k: int = 1) -> tuple:
+    """Get the k nearest indexed points from each query point.
+
+    Args:
+        index (BallTree): spatial index built with `build_spatial_index`.
+        lat (np.ndarray): latitudes of the query points.
+        lon (np.ndarray): longitudes of the query points.
+        k (int, optional): number of neighbours. Defaults to 1.
+
+    Returns:
+        tuple(np.ndarray, np.ndarray): (n_points, k) arrays with the positions of the nearest points
+        and their haversine distances in kilometers, sorted by increasing distance
+    """
+    query_points = np.radians(np.column_stack([lat, lon]).astype(float))
+    distances, indices = index.query(query_points, k=k, return_distance=True, sort_results=True)
+    return indices, distances * cst.earth_radius_km
+
+
+def query_nearest_geodesic(index, lat: np.ndarray, lon: np.ndarray) -> tuple:
+    """Get the nearest indexed point from each query point according to the geodesic distance computed by geopy.
+    The haversine nearest neighbour gives an upper bound of the geodesic distance to the nearest point, so only points
+    within that bound (extended by the haversine error) need to be re-ranked with geopy.
+
+    Args:
+        index (BallTree): spatial index built with `build_spatial_index`.
+        lat (np.ndarray): latitudes of the query points.
+        lon (np.ndarray): longitudes of the query points.
+
+    Returns:
+        tuple(np.ndarray, np.ndarray): positions of the nearest points and their geodesic distances in kilometers
+    """
+    from geopy import distance
+
+    _, nearest_distances = query_nearest(index, lat, lon, k=1)
+    error = cst.haversine_max_relative_error
+    candidates_radius = nearest_distances[:, 0] * (1 + error) / (1 - error) + 1e-9
+
+    query_points = np.radians(np.column_stack([lat, lon]).astype(float))
+    candidates = index.query_radius(query_points, r=candidates_radius / cst.earth_radius_km)
+    index_points = np.degrees(np.asarray(index.data))
+
+    nearest_positions = np.zeros(len(candidates), dtype=np.int64)
+    nearest_geodesic_distances = np.zeros(len(candidates))
+    for query, query_candidates in enumerate(candidates):
+        geodesic_distances = [
+            distance.geodesic((lat[query], lon[query]), tuple(index_points[position])).km
+            for position in query_candidates
+        ]
+        instrumentation.count('geodesic_distances', len(geodesic_distances))
+        nearest = np.argmin(geodesic_distances)
+        nearest_positions[query] = query_candidates[nearest]
+        nearest_geodesic_distances[query] = geodesic_distances[nearest]
+
+    return nearest_positions, nearest_geodesic_distances
+
+
+def get_geodesic_distances(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray, radii: list = ()) -> np.ndarray:
+    """Compute WGS-84 geodesic distances between pairs of points with a vectorized Vincenty inverse formula.
+    Vincenty distances differ from the geopy (Karney) distances by less than a micrometer at city scale, so pairs
+    whose distance is within `geodesic_tolerance_km` of one of the radii, or for which the formula does not converge,
+    are evaluated with geopy: comparisons of the distances with the radii are then identical to geopy.
+
+    Args:
+        lat1 (np.ndarray): latitudes of the first points.
+        lon1 (np.ndarray): longitudes of the first points.
+        lat2 (np.ndarray): latitudes of the second points.
+        lon2 (np.ndarray): longitudes of the second points.
+        radii (list, optional): distance limits the distances will be compared with. Defaults to ().
+
+    Returns:
+        np.ndarray: geodesic distances in kilometers
+    """
+    distances = get_vincenty_distances(lat1, lon1, lat2, lon2)
+
+    ambiguous = np.isnan(distances)
+    for radius in radii:
+        ambiguous |= np.abs(distances - radius) <= cst.geodesic_tolerance_km
+    if ambiguous.any():
+        from geopy import distance
+        instrumentation.count('geodesic_distances', int(ambiguous.sum()))
+        distances[ambiguous] = [
+            distance.geodesic((lat1[pair], lon1[pair]), (lat2[pair], lon2[pair])).km for pair in np.flatnonzero(ambiguous)
+        ]
+    return distances
+
+
+def get_vincenty_distances(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray, max_iter: int = 200) -> np.ndarray:
+    """Vectorized Vincenty inverse formula on the WGS-84 ellipsoid (NaN where it does not converge, e.g. antipodes)."""
+    a, f = cst.wgs84_semi_major_axis_km, cst.wgs84_flattening
+    b = a * (1 - f)
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(values, dtype=float)) for values in (lat1, lon1, lat2, lon2))
+
+    longitude_difference = lon2 - lon1
+    reduced_lat1, reduced_lat2 = np.arctan((1 - f) * np.tan(lat1)), np.arctan((1 - f) * np.tan(lat2))
+    sin_u1, cos_u1, sin_u2, cos_u2 = np.sin(reduced_lat1), np.cos(reduced_lat1), np.sin(reduced_lat2), np.cos(reduced_lat2)
+
+    lambda_ = longitude_difference.copy()
+    converged = np.zeros(len(lambda_), dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lambda, cos_lambda = np.sin(lambda_), np.cos(lambda_)
+            sin_sigma = np.sqrt((cos_u2 * sin_lambda) ** 2 + (cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda) ** 2)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lambda
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0, cos_u1 * cos_u2 * sin_lambda / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+            c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+
+            previous_lambda = lambda_
+            lambda_ = longitude_difference + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2))
+            )
+            converged = np.abs(lambda_ - previous_lambda) < 1e-12
+            if converged.all():
+                break
+
+    u2 = cos2_alpha * (a ** 2 - b ** 2) / b ** 2
+    coef_a = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    coef_b = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = coef_b * sin_sigma * (cos_2sigma_m + coef_b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) - coef_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+    ))
+    return np.where(converged, b * coef_a * (sigma - delta_sigma), np.nan)
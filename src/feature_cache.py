@@ -0,0 +1,178 @@
+import hashlib
+import os
+import shutil
+import uuid
+
+import pandas as pd
+
+import src.constants as cst
+
+def get_cache_key(*inputs) -> str:
+    """Compute a content hash from datasets and parameters, used as a cache key.
+    Datasets are hashed by value (column names included), other inputs by their repr.
+
+    Args:
+        *inputs: pd.DataFrame, pd.Series or any object with a stable repr (float, str, tuple...)
+
+    Returns:
+        str: hexadecimal sha256 digest
+    """
+    digest = hashlib.sha256()
+    for value in inputs:
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            digest.update(repr(list(value.columns) if isinstance(value, pd.DataFrame) else value.name).encode())
+            digest.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+        else:
+            digest.update(repr(value).encode())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def read_cache_table(cache_dir: str, key: str) -> pd.DataFrame:
+    """Read a cached table stored in parquet format, and mark it as recently used.
+
+    Args:
+        cache_dir (str): cache directory.
+        key (str): cache key (see `get_cache_key`).
+
+    Returns:
+        pd.DataFrame: cached table, or None if the key is not in the cache
+    """
+    path = get_cache_table_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+
+    os.utime(path)
+    return pd.read_parquet(path)
+
+
+def write_cache_table(cache_dir: str, key: str, table: pd.DataFrame, max_bytes: int = cst.feature_cache_max_bytes):
+    """Write a table to the cache in parquet format, then evict the least recently used tables above max_bytes.
+
+    Args:
+        cache_dir (str): cache directory.
+        key (str): cache key (see `get_cache_key`).
+        table (pd.DataFrame): table to store.
+        max_bytes (int, optional): size limit of the cache directory. Defaults to cst.feature_cache_max_bytes.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = get_cache_table_path(cache_dir, key)
+
+    # Write to a temporary file first so that concurrent readers never see a partial table
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    table.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+    evict_cache(cache_dir, max_bytes, keep=[path])
+
+
+def read_cache_partitions(cache_dir: str, key: str, partitions: list) -> pd.DataFrame:
+    """Read the rows of some partitions of a partitioned cache table, and mark them as recently used.
+    Only the files of the requested partitions are read, so the cost does not grow with the rest of the table.
+
+    Args:
+        cache_dir (str): cache directory.
+        key (str): cache key (see `get_cache_key`).
+        partitions (list): names of the partitions to read (see `append_cache_partitions`).
+
+    Returns:
+        pd.DataFrame: rows of the requested partitions, or None if none of them is in the cache
+    """
+    tables = []
+    for partition in partitions:
+        partition_dir = os.path.join(get_cache_partitions_dir(cache_dir, key), str(partition))
+        if not os.path.isdir(partition_dir):
+            continue
+        for entry in os.scandir(partition_dir):
+            if entry.name.endswith('.parquet'):
+                os.utime(entry.path)
+                tables.append(pd.read_parquet(entry.path))
+
+    if len(tables) == 0:
+        return None
+    return pd.concat(tables, ignore_index=True)
+
+
+def append_cache_partitions(cache_dir: str, key: str, table: pd.DataFrame, partition_col: str, max_bytes: int = cst.feature_cache_max_bytes):
+    """Append rows to a partitioned cache table, then evict the least recently used entries above max_bytes.
+    Rows are grouped by the value of partition_col and each group is written to a new parquet file in the directory
+    of its partition, so existing files are never read nor rewritten.
+
+    Args:
+        cache_dir (str): cache directory.
+        key (str): cache key (see `get_cache_key`).
+        table (pd.DataFrame): rows to append.
+        partition_col (str): column holding the partition name of each row (used as a directory name).
+        max_bytes (int, optional): size limit of the cache directory. Defaults to cst.feature_cache_max_bytes.
+    """
+    partitions_dir = get_cache_partitions_dir(cache_dir, key)
+    for partition, rows in table.groupby(partition_col, sort=False):
+        partition_dir = os.path.join(partitions_dir, str(partition))
+        os.makedirs(partition_dir, exist_ok=True)
+        path = os.path.join(partition_dir, f'{uuid.uuid4().hex}.parquet')
+
+        # Write to a temporary file first so that concurrent readers never see a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        rows.drop(columns=partition_col).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    evict_cache(cache_dir, max_bytes, keep=[partitions_dir])
+
+
+def evict_cache(cache_dir: str, max_bytes: int, keep: list = ()):
+    """Remove the least recently used entries of a cache directory until its total size is below max_bytes.
+    Entries are files or directories directly under cache_dir.
+
+    Args:
+        cache_dir (str): cache directory.
+        max_bytes (int): size limit of the cache directory.
+        keep (list, optional): paths that should not be evicted. Defaults to ().
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        entries.append((get_last_used_time(entry.path), get_size(entry.path), entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        if path in keep:
+            continue
+        remove_path(path)
+        total_size -= size
+
+
+def get_cache_table_path(cache_dir: str, key: str) -> str:
+    """Get the path of a cached table from its key."""
+    return os.path.join(cache_dir, f'{key}.parquet')
+
+
+def get_cache_partitions_dir(cache_dir: str, key: str) -> str:
+    """Get the directory of a partitioned cached table from its key."""
+    return os.path.join(cache_dir, key)
+
+
+def get_size(path: str) -> int:
+    """Get the size in bytes of a file or directory."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def get_last_used_time(path: str) -> float:
+    """Get the last modification time of a file, or of the most recently modified file in a directory."""
+    if os.path.isfile(path):
+        return os.path.getmtime(path)
+    times = [os.path.getmtime(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    return max(times, default=os.path.getmtime(path))
+
+
+def remove_path(path: str):
+    """Remove a file or directory."""
+    if os.path.isfile(path):
+        os.remove(path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
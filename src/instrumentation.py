@@ -0,0 +1,258 @@
+"""Opt-in instrumentation of the preprocessing, enrichment and modeling functions.
+
+Usage:
+    with instrumentation.instrument() as trace:
+        train, test = ext_geo.count_close_stations_all_housing_units_in_train_test(train, test, transports)
+    trace.write_chrome_trace('trace.json')  # open in chrome://tracing or https://ui.perfetto.dev
+
+While enabled, the public functions of the instrumented modules are replaced by wrappers recording wall time, rows in
+and out, resident memory and the counters incremented during each call (e.g. distance evaluations). When disabled,
+the original functions are restored, so the only remaining cost is the `is_enabled` check of `count`.
+
+Progress events (`progress`) are always emitted on the `src` logger, and also recorded in the trace while enabled.
+"""
+import contextlib
+import functools
+import importlib
+import inspect
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+INSTRUMENTED_MODULES = [
+    'src.preprocessing',
+    'src.external_data.external_geo_data',
+    'src.external_data.external_insee_data',
+    'src.external_data.spatial_index',
+    'src.pipeline',
+    'src.evaluation',
+]
+
+logger = logging.getLogger('src')
+
+# Trace of the current run and functions replaced by wrappers, set by `enable`
+_trace = None
+_original_functions = {}
+
+
+class Trace:
+    """Calls, counters and progress events recorded during an instrumented run."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+        self.calls = []
+        self.progress_events = []
+        self.counters = {}
+        self.local = threading.local()
+
+    def get_stack(self) -> list:
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def get_time_us(self) -> float:
+        return (time.perf_counter() - self.start) * 1e6
+
+    def summary(self) -> pd.DataFrame:
+        """Aggregate calls by function: number of calls, total and maximum wall time, rows and peak memory.
+
+        Returns:
+            pd.DataFrame: one row per function, sorted by total time
+        """
+        calls = pd.DataFrame(self.calls, columns=['name', 'seconds', 'rows_in', 'rows_out', 'peak_rss_increase_mb'])
+        summary = calls.groupby('name').agg(
+            n_calls=('seconds', 'size'), seconds=('seconds', 'sum'), max_seconds=('seconds', 'max'),
+            rows_in=('rows_in', 'sum'), rows_out=('rows_out', 'sum'), peak_rss_increase_mb=('peak_rss_increase_mb', 'max'),
+        )
+        return summary.sort_values('seconds', ascending=False)
+
+    def to_chrome_trace(self) -> dict:
+        """Convert the trace to the Chrome trace event format (calls as complete events, progress as instant events)."""
+        events = [
+            {
+                'name': call['name'], 'ph': 'X', 'ts': call['start_us'], 'dur': call['seconds'] * 1e6,
+                'pid': self.pid, 'tid': call['thread'],
+                'args': {key: call[key] for key in ['rows_in', 'rows_out', 'rss_start_mb', 'peak_rss_increase_mb', 'counters']},
+            }
+            for call in self.calls
+        ]
+        events += [
+            {'name': event['stage'], 'ph': 'i', 's': 't', 'ts': event['ts_us'], 'pid': self.pid, 'tid': event['thread'], 'args': event['fields']}
+            for event in self.progress_events
+        ]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'counters': self.counters}}
+
+    def write_chrome_trace(self, path: str):
+        """Write the trace in the Chrome trace event format."""
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f, default=to_json_compatible)
+
+    def write_json(self, path: str):
+        """Write calls, counters and progress events as JSON."""
+        with open(path, 'w') as f:
+            json.dump(
+                {'calls': self.calls, 'counters': self.counters, 'progress_events': self.progress_events}, f, default=to_json_compatible
+            )
+
+
+def enable(modules: list = INSTRUMENTED_MODULES) -> Trace:
+    """Start a new trace and replace the public functions of the modules by instrumented wrappers.
+
+    Args:
+        modules (list, optional): names of the modules to instrument. Defaults to INSTRUMENTED_MODULES.
+
+    Returns:
+        Trace: trace of the run
+    """
+    global _trace
+    disable()
+    _trace = Trace()
+
+    for module_name in modules:
+        module = importlib.import_module(module_name)
+        for name, func in inspect.getmembers(module, inspect.isfunction):
+            if name.startswith('_') or func.__module__ != module_name:
+                continue
+            _original_functions[(module, name)] = func
+            setattr(module, name, instrument_function(func, f'{module_name.split(".")[-1]}.{name}'))
+
+    return _trace
+
+
+def disable() -> Trace:
+    """Restore the original functions and stop the current trace.
+
+    Returns:
+        Trace: trace of the run, or None if instrumentation was not enabled
+    """
+    global _trace
+    for (module, name), func in _original_functions.items():
+        setattr(module, name, func)
+    _original_functions.clear()
+
+    trace, _trace = _trace, None
+    return trace
+
+
+@contextlib.contextmanager
+def instrument(modules: list = INSTRUMENTED_MODULES):
+    """Context manager enabling instrumentation (see `enable`) and yielding the trace."""
+    trace = enable(modules)
+    try:
+        yield trace
+    finally:
+        disable()
+
+
+def is_enabled() -> bool:
+    return _trace is not None
+
+
+def count(name: str, value: int = 1):
+    """Increment a counter of the current run and of the instrumented call in progress (no-op when disabled)."""
+    if _trace is None:
+        return
+    _trace.counters[name] = _trace.counters.get(name, 0) + value
+    stack = _trace.get_stack()
+    if stack:
+        stack[-1]['counters'][name] = stack[-1]['counters'].get(name, 0) + value
+
+
+def progress(stage: str, message: str = None, **fields):
+    """Emit a structured progress event on the `src` logger, recorded in the trace when instrumentation is enabled.
+
+    Args:
+        stage (str): name of the stage, e.g. 'station_counts'.
+        message (str, optional): log message. Defaults to None (stage and fields).
+        **fields: event fields, e.g. dataset='train', done=10000, total=50000.
+    """
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(message or ' '.join([stage] + [f'{key}={value}' for key, value in fields.items()]), extra={'stage': stage, 'fields': fields})
+    if _trace is not None:
+        _trace.progress_events.append({'stage': stage, 'ts_us': _trace.get_time_us(), 'thread': threading.get_ident(), 'fields': fields})
+
+
+def instrument_function(func, name: str):
+    """Wrap a function to record its calls in the current trace."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = _trace
+        if trace is None:
+            return func(*args, **kwargs)
+
+        stack = trace.get_stack()
+        # The peak memory counter is reset at each call, so the peak reached so far is passed on to enclosing calls
+        peak_rss = get_peak_rss_mb()
+        for parent_call in stack:
+            parent_call['peak_rss_mb'] = max(parent_call['peak_rss_mb'], peak_rss)
+        reset_peak_rss()
+
+        call = {
+            'name': name, 'thread': threading.get_ident(), 'start_us': trace.get_time_us(), 'seconds': None,
+            'rows_in': count_rows(list(args) + list(kwargs.values())), 'rows_out': None,
+            'rss_start_mb': get_rss_mb(), 'peak_rss_mb': 0.0, 'counters': {},
+        }
+        stack.append(call)
+        try:
+            result = func(*args, **kwargs)
+            call['rows_out'] = count_rows(list(result) if isinstance(result, tuple) else [result])
+            return result
+        finally:
+            stack.pop()
+            call['seconds'] = (trace.get_time_us() - call['start_us']) / 1e6
+            call['peak_rss_mb'] = max(call['peak_rss_mb'], get_peak_rss_mb())
+            for parent_call in stack:
+                parent_call['peak_rss_mb'] = max(parent_call['peak_rss_mb'], call['peak_rss_mb'])
+            call['peak_rss_increase_mb'] = max(0.0, call.pop('peak_rss_mb') - call['rss_start_mb'])
+            trace.calls.append(call)
+
+    return wrapper
+
+
+def count_rows(values: list) -> int:
+    """Total number of rows of the dataframes, series and arrays in a list of values."""
+    return sum(len(value) for value in values if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)) and np.ndim(value) > 0)
+
+
+def get_rss_mb() -> float:
+    """Current resident memory of the process (Linux only, 0 elsewhere)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except OSError:
+        return 0.0
+
+
+def get_peak_rss_mb() -> float:
+    """Peak resident memory of the process (VmHWM on Linux, since ru_maxrss is inherited across exec)."""
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident memory of the process to its current value (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def to_json_compatible(value):
+    """Convert numpy scalars to python values, and values that are not JSON serializable to strings."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str, list, dict)):
+        return value
+    return str(value)
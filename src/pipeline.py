@@ -1,21 +1,31 @@
+import hashlib
 import itertools
+from collections import OrderedDict
 
-from sklearn.compose import make_column_transformer
-from sklearn.preprocessing import OneHotEncoder, StandardScaler, MinMaxScaler
-from sklearn.pipeline import Pipeline
-from category_encoders.target_encoder import TargetEncoder
-from feature_engine.encoding import CountFrequencyEncoder
+import numpy as np
+import pandas as pd
 
-def build_pipeline(estimator, features_dict: dict):
+import src.constants as cst
+
+# Preprocessing libraries (and joblib and scipy, used when caching fitted steps) are imported by the functions using
+# them, so that importing this module (e.g. for `get_features_from_dict` in scoring workers) does not import them
+
+def build_pipeline(estimator, features_dict: dict, memory=None):
     """Build a pipeline from an estimator and dictionary of feature preprocessing.
+    If memory is set, fitted preprocessing steps and their transformed matrices are reused across pipelines with the
+    same features_dict and training rows (e.g. several estimators evaluated on the same CV fold).
 
     Args:
         estimator: model object
         features_dict (dict): dictionary of feature preprocessing
+        memory (PreprocessingMemory, optional): cache of fitted preprocessing steps. Defaults to None.
 
     Returns:
         pipeline: sklearn pipeline object
     """
+    from feature_engine.encoding import CountFrequencyEncoder
+    from sklearn.pipeline import Pipeline
+
     # First, get the encoder
     encoder = get_encoder(features_dict)
     
@@ -25,7 +35,8 @@ def build_pipeline(estimator, features_dict: dict):
     pipeline = Pipeline([
         ("feature_engine", feature_engine), 
         ("encoder", encoder), 
-        ("estimator", estimator)]
+        ("estimator", estimator)],
+        memory=memory
     )
 
     return pipeline
@@ -52,6 +63,10 @@ def get_encoder(features_dict: dict):
     Returns:
         encoder: sklearn column transformer.
     """
+    from category_encoders.target_encoder import TargetEncoder
+    from sklearn.compose import make_column_transformer
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler, MinMaxScaler
+
     encoder = make_column_transformer(
         (MinMaxScaler(), features_dict['min_max_scaled']), 
         (StandardScaler(), features_dict['standard_scaled']), 
@@ -72,4 +87,87 @@ def get_features_from_dict(features_dict: dict) -> list:
     """
     features_dict_copy = features_dict.copy()
     features = list(itertools.chain.from_iterable(features_dict_copy.values()))
-    return features
\ No newline at end of file
+    return features
+
+
+class PreprocessingMemory:
+    """In-memory cache of fitted preprocessing steps, to pass as `memory` to `build_pipeline`.
+    It implements the `cache` method that sklearn pipelines call on joblib.Memory objects, but keeps results in memory
+    and identifies inputs with `pd.util.hash_pandas_object`, which is much faster than joblib hashing on string columns.
+
+    Results are keyed by the (unfitted) transformer, which holds the features_dict, and by the content of the rows and
+    target it is fitted on, which identify the fold. Least recently used results are evicted once the size of the
+    transformed matrices exceeds max_bytes.
+
+    Args:
+        max_bytes (int, optional): memory budget for transformed matrices. Defaults to cst.preprocessing_cache_max_bytes.
+    """
+    def __init__(self, max_bytes: int = cst.preprocessing_cache_max_bytes):
+        self.max_bytes = max_bytes
+        self.results = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def cache(self, func):
+        import joblib
+
+        def cached_func(transformer, X, y, *args, **kwargs):
+            key = (joblib.hash(transformer), hash_data(X), hash_data(y))
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return self.results[key][0]
+
+            self.misses += 1
+            result = func(transformer, X, y, *args, **kwargs)
+            self.store(key, result)
+            return result
+
+        return cached_func
+
+    def store(self, key: tuple, result: tuple):
+        n_bytes = get_n_bytes(result[0])
+        self.results[key] = (result, n_bytes)
+        self.n_bytes += n_bytes
+
+        while self.n_bytes > self.max_bytes and len(self.results) > 1:
+            _, (_, evicted_n_bytes) = self.results.popitem(last=False)
+            self.n_bytes -= evicted_n_bytes
+
+    def clear(self):
+        self.results.clear()
+        self.n_bytes = 0
+
+
+def hash_data(data) -> str:
+    """Hash the content of a dataframe, series or array (index and column names included).
+
+    Args:
+        data (pd.DataFrame | pd.Series | np.array | None): data to hash
+
+    Returns:
+        str: hexadecimal digest
+    """
+    digest = hashlib.sha1()
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        digest.update(repr(list(data.columns) if isinstance(data, pd.DataFrame) else data.name).encode())
+        digest.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    elif isinstance(data, np.ndarray) and data.dtype != object:
+        digest.update(repr((data.dtype, data.shape)).encode())
+        digest.update(np.ascontiguousarray(data).tobytes())
+    else:
+        import joblib
+        digest.update(joblib.hash(data).encode())
+    return digest.hexdigest()
+
+
+def get_n_bytes(data) -> int:
+    """Get the memory size of a transformed matrix (dataframe, dense or sparse array)."""
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=True).sum())
+    from scipy import sparse
+    if sparse.issparse(data):
+        data = data.tocsr()
+        return data.data.nbytes + data.indices.nbytes + data.indptr.nbytes
+    return getattr(data, 'nbytes', 0)
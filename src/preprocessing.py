@@ -1,17 +1,22 @@
+import numpy as np
+import pandas as pd
+
 import src.constants as cst
+import src.schema as schema
 
-def preprocess_housing_data(data, is_train):
+def preprocess_housing_data(data, is_train, vocabulary=None):
     """Preprocess training or test data.
 
     Args:
         data (pd.DataFrame): training data with selected and renamed columns.
         is_train (bool, optional): boolean to indicate if train or test dataset. Defaults to True.
-    """
-    # Mask "ventes" and rows with non-null district
-    data = data.query("(nature_mutation=='Vente') & (district==district)")
+        vocabulary (dict, optional): categories shared by train and test (see `schema.get_housing_vocabulary`).
+            Defaults to None (categories of the dataset).
 
-    # Fill missing surface Carrez values
-    data.loc[:, 'surface_carrez_1er_lot'] = data.loc[:, 'surface_carrez_1er_lot'].fillna(data['surface_reelle_bati'].astype(str))
+    Returns:
+        pd.DataFrame: preprocessed data with the types of the housing data model (see `schema.apply_housing_schema`)
+    """
+    data = select_housing_sales(data).copy()
 
     # Clean float values
     if is_train: 
@@ -19,14 +24,58 @@ def preprocess_housing_data(data, is_train):
     else: 
         float_cols_to_clean = ['surface_carrez_1er_lot', 'surface_carrez_2e_lot']
 
+    data = clean_housing_values(data, float_cols_to_clean)
+    return schema.apply_housing_schema(data, vocabulary)
+
+def select_housing_sales(data):
+    """Select the "ventes" with a non-null district, the rows kept by `preprocess_housing_data`.
+
+    Args:
+        data (pd.DataFrame): housing data with selected and renamed columns.
+
+    Returns:
+        pd.DataFrame
+    """
+    return data.query("(nature_mutation=='Vente') & (district==district)")
+
+def clean_housing_values(data, float_cols_to_clean):
+    """Fill missing surface Carrez values, parse float columns stored with French decimals and clip the number of rooms.
+
+    Args:
+        data (pd.DataFrame): housing data with selected and renamed columns.
+        float_cols_to_clean (list): columns to parse as floats.
+
+    Returns:
+        pd.DataFrame
+    """
+    # Clean float values, filling missing surface Carrez values with the built surface
     for col in float_cols_to_clean:
-        data.loc[:, col] = data.loc[:, col].str.replace(',', '.').astype(float)
-        data.loc[:, col] = data.loc[:, col].fillna(0)
+        values = parse_french_decimals(data[col])
+        if col == 'surface_carrez_1er_lot':
+            values = values.fillna(data['surface_reelle_bati'].astype(float))
+        data[col] = values.fillna(0)
 
     # Clip zero values in nb_pieces to 1
-    data.loc[:, 'nb_pieces'] = data.loc[:, 'nb_pieces'].clip(lower=1)
+    # Same as clip(lower=1) (missing values stay missing), without the overhead of Series.clip on small batches
+    data['nb_pieces'] = np.maximum(data['nb_pieces'], 1)
     return data
 
+def parse_french_decimals(values):
+    """Parse values stored as strings with a comma decimal separator (e.g. "650000,00") as floats.
+
+    Args:
+        values (pd.Series): strings, numbers or missing values.
+
+    Returns:
+        pd.Series
+    """
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return values.astype(float)
+    if pd.api.types.infer_dtype(values, skipna=True) in ['string', 'empty']:
+        # Strings and missing values only (e.g. scored records): missing values stay missing through str.replace
+        return values.str.replace(',', '.', regex=False).astype(float)
+    return values.astype(str).str.replace(',', '.').where(values.notna()).astype(float)
+
 def prepare_housing_data(data, is_train):
     """Function to select relevant columns and rename them
 
@@ -45,4 +94,81 @@ def prepare_housing_data(data, is_train):
     # Rename columns
     data = data.rename(columns=cst.column_names_mapping)
 
-    return data
\ No newline at end of file
+    return data
+
+def preprocess_housing_data_in_chunks(input_path: str, output_path: str, is_train: bool, chunksize: int = cst.preprocessing_chunk_size, vocabulary: dict = None) -> int:
+    """Prepare and preprocess a raw DVF csv file by chunks of rows, writing each preprocessed chunk to a csv file.
+    Every step of `prepare_housing_data` and `preprocess_housing_data` is row-wise, so the output is the same as
+    with the whole file loaded in memory (using `read_raw_housing_data`), while peak memory only depends on chunksize.
+    All chunks use the same categories, read from the file before preprocessing unless a vocabulary is given.
+
+    Args:
+        input_path (str): path of the raw train or test csv file.
+        output_path (str): path of the preprocessed csv file.
+        is_train (bool): boolean to indicate if train or test dataset.
+        chunksize (int, optional): number of raw rows read at once. Defaults to cst.preprocessing_chunk_size.
+        vocabulary (dict, optional): categories shared by train and test (see `schema.get_housing_vocabulary`).
+            Defaults to None (categories of the file, see `get_raw_housing_vocabulary`).
+
+    Returns:
+        int: number of rows written
+    """
+    n_rows = 0
+    is_first_chunk = True
+    if vocabulary is None:
+        vocabulary = get_raw_housing_vocabulary([input_path], is_train, chunksize)
+
+    for chunk in read_raw_housing_data(input_path, is_train, chunksize=chunksize):
+        chunk = prepare_housing_data(chunk, is_train)
+        chunk = preprocess_housing_data(chunk, is_train, vocabulary)
+
+        chunk.to_csv(output_path, index=True, mode='w' if is_first_chunk else 'a', header=is_first_chunk)
+        n_rows += chunk.shape[0]
+        is_first_chunk = False
+
+    return n_rows
+
+def get_raw_housing_vocabulary(paths: list, is_train: bool, chunksize: int = cst.preprocessing_chunk_size) -> dict:
+    """Get the categories of the categorical columns of raw DVF csv files (see `schema.get_housing_vocabulary`),
+    reading only these columns by chunks of rows. Only the rows kept by `preprocess_housing_data` are used, so the
+    categories are the same as with the whole file preprocessed in memory.
+
+    Args:
+        paths (list): paths of the raw train or test csv files.
+        is_train (bool): boolean to indicate if train or test datasets.
+        chunksize (int, optional): number of raw rows read at once. Defaults to cst.preprocessing_chunk_size.
+
+    Returns:
+        dict: dictionary of column names and pd.CategoricalDtype with sorted categories
+    """
+    cols = [
+        col for col in (cst.train_cols if is_train else cst.test_cols)
+        if cst.housing_dtypes.get(cst.column_names_mapping.get(col, col)) == 'category'
+    ]
+    categories = []
+    for path in paths:
+        for chunk in read_raw_housing_data(path, is_train, chunksize=chunksize, cols=cols):
+            chunk = select_housing_sales(chunk.rename(columns=cst.column_names_mapping))
+            categories += [chunk[[col]].drop_duplicates() for col in chunk.columns]
+    return schema.get_housing_vocabulary(*categories)
+
+def read_raw_housing_data(path: str, is_train: bool, chunksize: int = None, cols: list = None):
+    """Read the columns of a raw DVF csv file that are used by `prepare_housing_data`, with explicit types.
+
+    Args:
+        path (str): path of the raw train or test csv file.
+        is_train (bool): boolean to indicate if train or test dataset.
+        chunksize (int, optional): if set, return an iterator over chunks of rows. Defaults to None.
+        cols (list, optional): raw columns to read. Defaults to None (columns of the train or test dataset).
+
+    Returns:
+        pd.DataFrame or iterator of pd.DataFrame
+    """
+    cols = cols or (cst.train_cols if is_train else cst.test_cols)
+    header = pd.read_csv(path, nrows=0).columns
+
+    # Keep the index column (first column of the file) and the selected columns
+    usecols = [0] + [position for position, col in enumerate(header) if col in cols and position > 0]
+    dtypes = {col: dtype for col, dtype in cst.raw_dtypes.items() if col in cols}
+
+    return pd.read_csv(path, index_col=0, usecols=usecols, dtype=dtypes, chunksize=chunksize)
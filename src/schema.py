@@ -0,0 +1,171 @@
+"""Typed in-memory model of housing datasets, shared by preprocessing, external data enrichment, storage and serving.
+
+Columns are cast to the types of `cst.housing_dtypes`: float64 coordinates, float32 surfaces, categorical labels,
+integer IRIS codes and small integer counts. Categorical columns of train and test use the same categories (see
+`get_housing_vocabulary`), so that category codes are stable across datasets.
+"""
+import json
+import re
+
+import pandas as pd
+
+import src.constants as cst
+
+# Types of enrichment columns that are named after their parameters (e.g. `n_metros_within_0.25km`), integer types
+# only apply to integer columns (sums of float values keep their type)
+COLUMN_PATTERN_DTYPES = {
+    re.compile(r'n_\w+_within_[\d.]+km'): 'int16',
+    re.compile(r'distance_to_nearest_\w+_km'): 'float32',
+}
+
+# Floating types that represent integer types exactly when values are missing
+MISSING_INTEGER_DTYPES = {'int8': 'float32', 'int16': 'float32', 'int32': 'float64', 'int64': 'float64'}
+
+
+def get_housing_vocabulary(*datasets) -> dict:
+    """Get the categories of the categorical columns over several datasets (e.g. train and test), as categorical
+    types to pass to `apply_housing_schema`.
+
+    Args:
+        *datasets (pd.DataFrame): housing datasets.
+
+    Returns:
+        dict: dictionary of column names and pd.CategoricalDtype with sorted categories
+    """
+    vocabulary = {}
+    for col, dtype in cst.housing_dtypes.items():
+        if dtype != 'category' or not any(col in data.columns for data in datasets):
+            continue
+        categories = pd.Index([])
+        for data in datasets:
+            if col in data.columns:
+                values = data[col].cat.categories if isinstance(data[col].dtype, pd.CategoricalDtype) else data[col].dropna().unique()
+                categories = categories.union(pd.Index(values))
+        vocabulary[col] = pd.CategoricalDtype(categories.sort_values())
+    return vocabulary
+
+
+def write_housing_vocabulary(path: str, vocabulary: dict):
+    """Write the categories of a vocabulary (see `get_housing_vocabulary`) to a JSON file, e.g. to reuse the
+    categories of the train and test sets when scoring other files.
+
+    Args:
+        path (str): path of the JSON file.
+        vocabulary (dict): dictionary of column names and pd.CategoricalDtype.
+    """
+    with open(path, 'w') as f:
+        json.dump({col: dtype.categories.tolist() for col, dtype in vocabulary.items()}, f, indent=2)
+
+
+def read_housing_vocabulary(path: str) -> dict:
+    """Read a vocabulary written with `write_housing_vocabulary`.
+
+    Args:
+        path (str): path of the JSON file.
+
+    Returns:
+        dict: dictionary of column names and pd.CategoricalDtype
+    """
+    with open(path) as f:
+        return {col: pd.CategoricalDtype(categories) for col, categories in json.load(f).items()}
+
+
+def apply_housing_schema(data: pd.DataFrame, vocabulary: dict = None) -> pd.DataFrame:
+    """Cast the columns of a housing dataset to the types of the housing data model. Columns that already have their
+    type are not copied, so the schema can be applied after each stage.
+
+    Integer types are only applied to columns without missing values (floats are used otherwise). Values of a
+    categorical column that are not in its vocabulary are appended to its categories, so existing codes are kept.
+
+    Args:
+        data (pd.DataFrame): housing dataset.
+        vocabulary (dict, optional): categorical types by column (see `get_housing_vocabulary`). Defaults to None
+            (categories of the dataset).
+
+    Returns:
+        pd.DataFrame: housing dataset with the types of the data model
+    """
+    dtypes = get_housing_dtypes(data, vocabulary)
+    if not dtypes:
+        return data
+    if 'code_iris' in dtypes:
+        data = data.assign(code_iris=to_iris_codes(data['code_iris']))
+        dtypes.pop('code_iris')
+    return data.astype(dtypes)
+
+
+def get_housing_dtypes(data: pd.DataFrame, vocabulary: dict = None, cast_categories: bool = True) -> dict:
+    """Get the types of the housing data model of the columns of a dataset that do not have them yet
+    (see `apply_housing_schema`).
+
+    Args:
+        data (pd.DataFrame): housing dataset.
+        vocabulary (dict, optional): categorical types by column (see `get_housing_vocabulary`). Defaults to None
+            (categories of the dataset).
+        cast_categories (bool, optional): include categorical columns. If False, they keep their type (e.g. labels
+            of records scored one at a time, where categorical types cost more than scoring). Defaults to True.
+
+    Returns:
+        dict: dictionary of column names and types
+    """
+    dtypes = {}
+    for col, values in data.items():
+        dtype = get_column_dtype(values)
+        if dtype is None or (dtype == 'category' and not cast_categories):
+            continue
+        if dtype == 'category':
+            dtype = get_categorical_dtype(values, (vocabulary or {}).get(col))
+        elif dtype in MISSING_INTEGER_DTYPES and values.isna().any():
+            dtype = MISSING_INTEGER_DTYPES[dtype]
+        if values.dtype != dtype:
+            dtypes[col] = dtype
+    return dtypes
+
+
+def get_column_dtype(values: pd.Series):
+    """Type of a column in the housing data model, or None for columns that keep their type."""
+    if values.name in cst.housing_dtypes:
+        return cst.housing_dtypes[values.name]
+    for pattern, dtype in COLUMN_PATTERN_DTYPES.items():
+        if pattern.fullmatch(str(values.name)):
+            is_integer = pd.api.types.is_integer_dtype(values.dtype)
+            return dtype if is_integer or dtype not in MISSING_INTEGER_DTYPES else None
+    return None
+
+
+def get_categorical_dtype(values: pd.Series, vocabulary_dtype: pd.CategoricalDtype = None) -> pd.CategoricalDtype:
+    """Categorical type of a column: its vocabulary, extended with unseen values if needed."""
+    if vocabulary_dtype is None:
+        return 'category'
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        new_values = values.cat.categories.difference(vocabulary_dtype.categories)
+    else:
+        new_values = pd.Index(values.dropna().unique()).difference(vocabulary_dtype.categories)
+    if len(new_values) == 0:
+        return vocabulary_dtype
+    return pd.CategoricalDtype(vocabulary_dtype.categories.append(new_values))
+
+
+def to_iris_codes(values: pd.Series) -> pd.Series:
+    """Convert IRIS codes stored as numbers or strings to integers (`cst.housing_dtypes['code_iris']`).
+    Codes that are not numeric (e.g. Corsican codes such as 2A0040000) become missing values, stored as floats.
+
+    Args:
+        values (pd.Series): IRIS codes.
+
+    Returns:
+        pd.Series
+    """
+    if pd.api.types.is_integer_dtype(values.dtype):
+        return values.astype(cst.housing_dtypes['code_iris'])
+
+    codes = pd.to_numeric(values, errors='coerce')
+    if codes.isna().any():
+        return codes.astype(float)
+    return codes.astype(cst.housing_dtypes['code_iris'])
+
+
+def get_memory_per_row(data: pd.DataFrame) -> float:
+    """Memory of a dataset in bytes per row, including the contents of object columns and the index."""
+    return data.memory_usage(index=True, deep=True).sum() / max(data.shape[0], 1)
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import threadpoolctl
+from sklearn.base import clone
+from sklearn.model_selection import ParameterSampler
+
+import src.constants as cst
+import src.evaluation as evaluation
+import src.instrumentation as instrumentation
+import src.pipeline as pipe
+
+# Data shared by the trials of a worker process, set once by `init_search_worker`
+_worker_data = {}
+
+def run_parallel_search(estimator, param_samples: list, features_dict: dict, X_train: pd.DataFrame, y_train: pd.Series, X_test: pd.DataFrame, y_test: pd.Series, store_path: str, n_workers: int = None, threads_per_trial: int = None, cache_preprocessing: bool = True) -> pd.DataFrame:
+    """Evaluate an estimator with several sets of hyperparameters, running trials in parallel in a pool of processes.
+    Each trial builds a pipeline with `features_dict` and is evaluated with `evaluation.fit_and_evaluate_pipeline`.
+    Metrics are appended to a JSON lines store as soon as a trial ends: trials already in the store are skipped,
+    so an interrupted search resumes where it stopped.
+
+    The CPU budget is split between trials and models: each of the n_workers trials runs its estimator with
+    threads_per_trial threads (through `n_jobs` or `thread_count`), so that threaded boosters do not oversubscribe cores.
+
+    Args:
+        estimator: model object
+        param_samples (list): list of dictionaries of estimator parameters (optionally prefixed by `estimator__`)
+        features_dict (dict): dictionary of feature preprocessing
+        X_train (pd.DataFrame): X_train
+        y_train (pd.Series): y_train
+        X_test (pd.DataFrame): X_test
+        y_test (pd.Series): y_test
+        store_path (str): path of the JSON lines file storing trial results
+        n_workers (int, optional): number of trials run in parallel. Defaults to None (number of CPUs).
+        threads_per_trial (int, optional): number of threads per model. Defaults to None (CPUs divided by n_workers).
+        cache_preprocessing (bool, optional): reuse fitted encoders across the trials of a worker
+            (see `pipeline.PreprocessingMemory`). Defaults to True.
+
+    Returns:
+        pd.DataFrame: one row per trial with parameters and metrics, sorted by RMSE
+    """
+    n_workers = n_workers or os.cpu_count()
+    threads_per_trial = threads_per_trial or max(1, os.cpu_count() // n_workers)
+
+    data_hash = hash_search_data(X_train, y_train, X_test, y_test)
+    trials = {}
+    for params in param_samples:
+        params = {key.replace('estimator__', '', 1): instrumentation.to_json_compatible(value) for key, value in params.items()}
+        trials[get_trial_id(estimator, params, features_dict, data_hash)] = params
+
+    completed_trials = read_trial_store(store_path)
+    pending_trials = {trial_id: params for trial_id, params in trials.items() if trial_id not in completed_trials}
+
+    if pending_trials:
+        with ProcessPoolExecutor(
+            max_workers=min(n_workers, len(pending_trials)), initializer=init_search_worker,
+            initargs=(features_dict, X_train, y_train, X_test, y_test, threads_per_trial, cache_preprocessing)
+        ) as executor:
+            futures = {
+                executor.submit(run_trial, evaluation.set_thread_params(clone(estimator), threads_per_trial), params): trial_id
+                for trial_id, params in pending_trials.items()
+            }
+            for future in as_completed(futures):
+                trial = {'trial_id': futures[future], 'params': pending_trials[futures[future]]} | future.result()
+                append_trial_to_store(store_path, trial)
+                completed_trials[trial['trial_id']] = trial
+
+    results = [completed_trials[trial_id] for trial_id in trials]
+    results = pd.DataFrame([{'trial_id': trial['trial_id'], **trial['params'], **trial['metrics'], 'seconds': trial['seconds']} for trial in results])
+    return results.sort_values('rmse').reset_index(drop=True)
+
+
+def sample_params(param_distributions: dict, n_iter: int, random_state: int = cst.random_seed) -> list:
+    """Sample sets of parameters from lists or scipy distributions, as in `RandomizedSearchCV`.
+
+    Args:
+        param_distributions (dict): dictionary of parameter names and values to sample from
+        n_iter (int): number of parameter sets
+        random_state (int, optional): random seed. Defaults to cst.random_seed.
+
+    Returns:
+        list: list of dictionaries of parameters
+    """
+    return list(ParameterSampler(param_distributions, n_iter=n_iter, random_state=random_state))
+
+
+def init_search_worker(features_dict: dict, X_train: pd.DataFrame, y_train: pd.Series, X_test: pd.DataFrame, y_test: pd.Series, threads_per_trial: int, cache_preprocessing: bool = True):
+    """Store the search data once per worker process and limit the threads of the BLAS and OpenMP libraries loaded
+    in the process (thread environment variables are only read when a library is loaded, before the worker starts).
+    Estimators are limited with their own thread parameters (see `evaluation.set_thread_params`)."""
+    threadpoolctl.threadpool_limits(limits=threads_per_trial)
+    _worker_data.update(features_dict=features_dict, X_train=X_train, y_train=y_train, X_test=X_test, y_test=y_test)
+    _worker_data['memory'] = pipe.PreprocessingMemory() if cache_preprocessing else None
+
+
+def run_trial(estimator, params: dict) -> dict:
+    """Fit and evaluate a pipeline with a set of estimator parameters, using the data of the worker process."""
+    start = time.perf_counter()
+    estimator.set_params(**params)
+    metrics = evaluation.fit_and_evaluate_pipeline(
+        estimator, _worker_data['features_dict'], _worker_data['X_train'], _worker_data['y_train'],
+        _worker_data['X_test'], _worker_data['y_test'], memory=_worker_data['memory']
+    )
+    return {'metrics': {name: float(value) for name, value in metrics.items()}, 'seconds': time.perf_counter() - start}
+
+
+def get_trial_id(estimator, params: dict, features_dict: dict, data_hash: str) -> str:
+    """Hash the estimator class and parameters (base parameters of the estimator updated with the trial parameters,
+    except thread counts which do not change results), features and data of a trial."""
+    estimator_params = {
+        name: value for name, value in estimator.get_params(deep=False).items() if name not in evaluation.THREAD_PARAMS
+    } | params
+    trial = [type(estimator).__name__, sorted(estimator_params.items()), sorted(features_dict.items()), data_hash]
+    return hashlib.sha256(json.dumps(trial, default=str).encode()).hexdigest()[:16]
+
+
+def hash_search_data(X_train: pd.DataFrame, y_train: pd.Series, X_test: pd.DataFrame, y_test: pd.Series) -> str:
+    """Hash the train and test sets of a search, so that stored trials are only reused on the same data."""
+    return hashlib.sha256(''.join(pipe.hash_data(data) for data in [X_train, y_train, X_test, y_test]).encode()).hexdigest()
+
+
+def read_trial_store(store_path: str) -> dict:
+    """Read the trials stored in a JSON lines file, ignoring a partially written last line."""
+    completed_trials = {}
+    if not os.path.exists(store_path):
+        return completed_trials
+
+    with open(store_path) as f:
+        for line in f:
+            try:
+                trial = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            completed_trials[trial['trial_id']] = trial
+    return completed_trials
+
+
+def append_trial_to_store(store_path: str, trial: dict):
+    """Append a trial to a JSON lines file and flush it to disk. If the file ends with a partially written line
+    (e.g. after an interrupted search), the trial starts on a new line, so that it can be read back."""
+    with open(store_path, 'a+b') as f:
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.write((json.dumps(trial) + '\n').encode())
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,480 @@
+"""Long-lived HTTP service scoring housing units with a fitted pipeline.
+
+Usage (from the repository root):
+    python -m src.serving --model models/tuned_lgbr.sav --features-dict features_lgb.json --port 8000
+
+The pipeline preprocessing is compiled into NumPy operations at startup (see `compiled_pipeline.compile_pipeline`).
+--model also accepts a model artifact directory (see `src.artifacts`), which loads faster than a pickled pipeline.
+
+POST /predict with a JSON record (or a list of records) using the renamed DVF columns (see `cst.column_names_mapping`)
+returns the predicted price per m2 (`valeur_m2`) and total price (`valeur`) for each record. Invalid records (e.g. a
+missing column) get a 400 response, and failures while scoring a 500 response.
+
+Measured with `benchmarks.serving_benchmark` (compiled LightGBM pipeline, single records, clients and server sharing
+one core): p50/p99 latencies of 6-7/8.5-9 ms with one client, and 15-18/22-24 ms with 8 concurrent clients, whose
+requests queue behind the batch being scored.
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import src.artifacts as artifacts
+import src.compiled_pipeline as compiled
+import src.constants as cst
+import src.feature_cache as feature_cache
+import src.pipeline as pipe
+import src.preprocessing as prep
+import src.schema as schema
+import src.external_data.external_geo_data as ext_geo
+import src.external_data.external_insee_data as ext_insee
+import src.external_data.spatial_grid as spatial_grid
+import src.external_data.spatial_index as spatial_index
+
+def build_enrichment_context(transports: pd.DataFrame, revenus: pd.DataFrame, reference_data: pd.DataFrame, spatial_grid_path: str = None) -> dict:
+    """Build the in-memory tables used to enrich incoming records: station index and IRIS median revenue lookup.
+    IRIS codes that are not available in INSEE data are resolved to the closest available IRIS zone as in
+    `ext_insee.add_external_insee_revenue_data`, using IRIS centroids from reference_data. Codes that were never
+    seen are resolved at scoring time to the IRIS zone with the closest centroid.
+
+    Args:
+        transports (pd.DataFrame): open dataset from Ile-de-France Mobilités.
+        revenus (pd.DataFrame): INSEE revenue data.
+        reference_data (pd.DataFrame): housing data with code_iris/lat/lon columns (e.g. prepared train and test sets).
+        spatial_grid_path (str, optional): directory of a precomputed grid of station counts and revenue, built if
+            missing or outdated (see `get_enrichment_grid`). Defaults to None (exact enrichment of every record).
+
+    Returns:
+        dict: enrichment context
+    """
+    transports = ext_geo.get_transportation_count_per_station(transports)
+    median_revenue_dict = ext_insee.get_median_revenue_by_iris(revenus)
+
+    reference_data = reference_data.dropna(subset=['code_iris', 'lat', 'lon'])
+    reference_data = reference_data.assign(code_iris=schema.to_iris_codes(reference_data['code_iris']))
+    avg_coordinates_by_iris = ext_insee.compute_average_coordinates_by_iris(reference_data, reference_data.iloc[:0])
+    is_mapped = avg_coordinates_by_iris.index.isin(set(median_revenue_dict))
+    avg_coordinates_by_iris_mapped = avg_coordinates_by_iris.loc[is_mapped, :]
+
+    closest_iris_to_non_mapped_dict = ext_insee.get_closest_iris_zone_from_coordinates(
+        avg_coordinates_by_iris_mapped, avg_coordinates_by_iris.loc[~is_mapped, :]
+    )
+    iris_revenue = median_revenue_dict | {
+        code: median_revenue_dict[closest_code] for code, closest_code in closest_iris_to_non_mapped_dict.items()
+    }
+
+    iris_codes = np.sort(np.fromiter(iris_revenue, dtype=np.int64, count=len(iris_revenue)))
+    context = {
+        'transports': transports,
+        'station_index': ext_geo.build_station_index(transports),
+        'iris_revenue': iris_revenue,
+        'iris_codes': iris_codes,
+        'iris_codes_revenue': np.array([iris_revenue[code] for code in iris_codes], dtype=float),
+        'iris_index': spatial_index.build_spatial_index(avg_coordinates_by_iris_mapped['lat'], avg_coordinates_by_iris_mapped['lon']),
+        'iris_index_revenue': avg_coordinates_by_iris_mapped.index.map(median_revenue_dict).to_numpy(dtype=float),
+    }
+    if spatial_grid_path is not None:
+        context['spatial_grid'] = get_enrichment_grid(context, reference_data, spatial_grid_path)
+    return context
+
+
+def get_enrichment_grid(context: dict, reference_data: pd.DataFrame, path: str, bounds: tuple = cst.spatial_grid_bounds, cell_size_m: float = cst.spatial_grid_cell_size_m) -> dict:
+    """Load the grid of station counts and IRIS median revenue stored in path, after building it with
+    `build_enrichment_grid` if the directory has no grid or a grid built from other data or parameters.
+
+    Args:
+        context (dict): enrichment context (see `build_enrichment_context`).
+        reference_data (pd.DataFrame): housing data with code_iris/lat/lon columns.
+        path (str): grid directory.
+        bounds (tuple, optional): (lat_min, lat_max, lon_min, lon_max) of the grid. Defaults to cst.spatial_grid_bounds.
+        cell_size_m (float, optional): side of the cells in meters. Defaults to cst.spatial_grid_cell_size_m.
+
+    Returns:
+        dict: memory-mapped grid (see `spatial_grid.load_spatial_grid`)
+    """
+    iris_revenue = pd.Series(context['iris_revenue'], dtype=float).rename_axis('code_iris').reset_index(name='revenue')
+    key = feature_cache.get_cache_key(
+        context['transports'], iris_revenue, reference_data[['code_iris', 'lat', 'lon']],
+        cst.short_distance_station, tuple(bounds), cell_size_m
+    )
+    metadata = spatial_grid.read_grid_metadata(path)
+    if metadata is None or metadata.get('key') != key:
+        build_enrichment_grid(context, reference_data, path, bounds, cell_size_m, key)
+    return spatial_grid.load_spatial_grid(path)
+
+
+def build_enrichment_grid(context: dict, reference_data: pd.DataFrame, path: str, bounds: tuple = cst.spatial_grid_bounds, cell_size_m: float = cst.spatial_grid_cell_size_m, key: str = None) -> dict:
+    """Precompute station counts and IRIS median revenue on a grid of cell_size_m cells and write it to path
+    (see `spatial_grid.write_spatial_grid`), with a report comparing grid lookups to exact enrichment.
+
+    Station counts are computed at the center of each cell, so units within half a cell diagonal of a count radius
+    may differ from their exact counts. The revenue of a cell is the most frequent resolved revenue of the reference
+    units in the cell, or the revenue of the IRIS zone with the closest centroid for cells without reference units.
+    The report compares grid and exact features, and their throughput, on a sample of at most
+    `cst.spatial_grid_report_size` reference units (whose revenues were used to build the grid).
+
+    Args:
+        context (dict): enrichment context (see `build_enrichment_context`).
+        reference_data (pd.DataFrame): housing data with code_iris/lat/lon columns.
+        path (str): grid directory.
+        bounds (tuple, optional): (lat_min, lat_max, lon_min, lon_max) of the grid. Defaults to cst.spatial_grid_bounds.
+        cell_size_m (float, optional): side of the cells in meters. Defaults to cst.spatial_grid_cell_size_m.
+        key (str, optional): key of the data and parameters of the grid, stored in its metadata. Defaults to None.
+
+    Returns:
+        dict: grid size, build time, accuracy by feature and exact and grid enrichment throughputs
+    """
+    start = time.perf_counter()
+    geometry = spatial_grid.get_grid_geometry(bounds, cell_size_m)
+    cells_lat, cells_lon = spatial_grid.get_cell_centers(geometry)
+    features = get_exact_features(pd.DataFrame(index=pd.RangeIndex(len(cells_lat))), cells_lat, cells_lon, context)
+
+    units_lat, units_lon = reference_data['lat'].to_numpy(dtype=float), reference_data['lon'].to_numpy(dtype=float)
+    features['med_revenue_iris_2018'] = spatial_grid.get_majority_values(
+        spatial_grid.get_cell_positions(geometry, units_lat, units_lon),
+        get_iris_revenue(reference_data, units_lat, units_lon, context),
+        features['med_revenue_iris_2018'],
+    )
+    features = {name: np.asarray(values).astype(cst.housing_dtypes[name]) for name, values in features.items()}
+    build_seconds = time.perf_counter() - start
+
+    sample = reference_data.sample(n=min(cst.spatial_grid_report_size, reference_data.shape[0]), random_state=cst.random_seed)
+    sample_lat, sample_lon = sample['lat'].to_numpy(dtype=float), sample['lon'].to_numpy(dtype=float)
+    start = time.perf_counter()
+    exact_features = get_exact_features(sample, sample_lat, sample_lon, context)
+    exact_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    grid_features, inside = spatial_grid.lookup_spatial_grid({'geometry': geometry, 'features': features}, sample_lat, sample_lon)
+    grid_seconds = time.perf_counter() - start
+
+    report = {
+        'n_cells': geometry['n_rows'] * geometry['n_cols'],
+        'cell_size_m': cell_size_m,
+        'grid_bytes': sum(values.nbytes for values in features.values()),
+        'build_seconds': build_seconds,
+        'n_units': sample.shape[0],
+        'share_inside_grid': float(np.mean(inside)) if sample.shape[0] else None,
+        'accuracy': spatial_grid.get_accuracy_report(
+            {name: values[inside] for name, values in grid_features.items()},
+            {name: np.asarray(values)[inside] for name, values in exact_features.items()},
+        ),
+        'exact_rows_per_second': sample.shape[0] / exact_seconds,
+        'grid_rows_per_second': sample.shape[0] / grid_seconds,
+    }
+    spatial_grid.write_spatial_grid(path, geometry, features, {'key': key, 'report': report})
+    return report
+
+
+def enrich_records(records: pd.DataFrame, context: dict) -> pd.DataFrame:
+    """Clean surface values and add station counts and IRIS median revenue to housing records.
+
+    Args:
+        records (pd.DataFrame): housing records with renamed DVF columns.
+        context (dict): enrichment context (see `build_enrichment_context`).
+
+    Returns:
+        pd.DataFrame: enriched records
+    """
+    for col in ['surface_carrez_1er_lot', 'surface_carrez_2e_lot']:
+        if col not in records.columns:
+            records[col] = np.nan
+    records = prep.clean_housing_values(records, ['surface_carrez_1er_lot', 'surface_carrez_2e_lot'])
+
+    # Numeric columns get the types of the housing data model, as in training and batch scoring, so that predictions
+    # do not depend on the path. The frame is rebuilt from arrays, which is faster than astype on few rows
+    dtypes = schema.get_housing_dtypes(records, cast_categories=False)
+    dtypes.pop('code_iris', None)
+    records = pd.DataFrame({
+        col: records[col].to_numpy().astype(dtypes[col]) if col in dtypes else records[col].to_numpy() for col in records.columns
+    }, index=records.index)
+    return add_external_features(records, context)
+
+
+def add_external_features(data: pd.DataFrame, context: dict) -> pd.DataFrame:
+    """Add station counts and IRIS median revenue to preprocessed housing data, using the prebuilt indexes of the
+    enrichment context. If the context has a spatial grid (see `get_enrichment_grid`), features of the units inside
+    the grid are read from their cells, and only units outside the grid are enriched with the indexes.
+
+    Args:
+        data (pd.DataFrame): preprocessed housing data (or cleaned records).
+        context (dict): enrichment context (see `build_enrichment_context`).
+
+    Returns:
+        pd.DataFrame: same dataset with station counts and median revenue
+    """
+    units_lat, units_lon = data['lat'].to_numpy(dtype=float), data['lon'].to_numpy(dtype=float)
+    if 'spatial_grid' in context:
+        features, inside = spatial_grid.lookup_spatial_grid(context['spatial_grid'], units_lat, units_lon)
+        if not inside.all():
+            outside_features = get_exact_features(data[~inside], units_lat[~inside], units_lon[~inside], context)
+            for name, values in outside_features.items():
+                features[name][~inside] = values
+    else:
+        features = get_exact_features(data, units_lat, units_lon, context)
+
+    for name, values in features.items():
+        data[name] = values
+    return data
+
+
+def get_exact_features(data: pd.DataFrame, units_lat: np.ndarray, units_lon: np.ndarray, context: dict) -> dict:
+    """Count stations with the station index and look up IRIS median revenue for each housing unit."""
+    n_transports = ext_geo.count_close_stations_housing_units(
+        units_lat, units_lon, context['transports'], context['station_index'], cst.short_distance_station
+    )
+    return {
+        f'n_metros_within_{cst.short_distance_station}km': n_transports['n_metros'],
+        f'n_trains_within_{cst.short_distance_station}km': n_transports['n_trains'],
+        'med_revenue_iris_2018': get_iris_revenue(data, units_lat, units_lon, context),
+    }
+
+
+def get_iris_revenue(records: pd.DataFrame, units_lat: np.ndarray, units_lon: np.ndarray, context: dict) -> np.ndarray:
+    """Look up the median revenue of each record's IRIS zone, falling back to the zone with the closest centroid.
+    Codes are looked up with a binary search in the sorted codes of the enrichment context."""
+    codes = records['code_iris'] if 'code_iris' in records.columns else pd.Series(np.nan, index=records.index)
+    codes = pd.to_numeric(codes, errors='coerce').to_numpy(dtype=float)
+    revenue = np.full(len(codes), np.nan)
+
+    # Codes sent as floats (e.g. 751010101.0) are truncated to integers
+    known_positions = np.flatnonzero(np.isfinite(codes))
+    known_codes = codes[known_positions].astype(np.int64)
+    positions = np.minimum(np.searchsorted(context['iris_codes'], known_codes), len(context['iris_codes']) - 1)
+    is_found = context['iris_codes'][positions] == known_codes
+    revenue[known_positions[is_found]] = context['iris_codes_revenue'][positions[is_found]]
+
+    unknown = np.isnan(revenue)
+    if unknown.any():
+        closest_positions, _ = spatial_index.query_nearest(context['iris_index'], units_lat[unknown], units_lon[unknown])
+        revenue[unknown] = context['iris_index_revenue'][closest_positions[:, 0]]
+    return revenue
+
+
+def get_required_columns(features: list) -> list:
+    """Columns that scored records must contain: coordinates, surface and the features not added by enrichment."""
+    enriched = [
+        f'n_metros_within_{cst.short_distance_station}km', f'n_trains_within_{cst.short_distance_station}km',
+        'med_revenue_iris_2018', 'surface_carrez_1er_lot', 'surface_carrez_2e_lot',
+    ]
+    return list(dict.fromkeys(['lat', 'lon', 'surface_reelle_bati'] + [col for col in features if col not in enriched]))
+
+
+def validate_records(records: list, required_columns: list):
+    """Check that records can be scored before they are batched with other requests, raising a ValueError otherwise.
+
+    Args:
+        records (list): list of dictionaries with renamed DVF columns.
+        required_columns (list): output of `get_required_columns`.
+    """
+    if len(records) == 0:
+        raise ValueError('No record to score')
+    for i, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ValueError(f'Record {i} is not a JSON object')
+        missing_columns = [col for col in required_columns if col not in record]
+        if missing_columns:
+            raise ValueError(f'Record {i} misses columns {missing_columns}')
+        for col in ['lat', 'lon', 'surface_reelle_bati']:
+            value = record[col]
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not np.isfinite(value):
+                raise ValueError(f'Record {i} has an invalid {col} value {value!r}')
+
+
+def predict_records(records: list, pipeline, features: list, context: dict) -> list:
+    """Enrich and score a batch of housing records.
+
+    Args:
+        records (list): list of dictionaries with renamed DVF columns.
+        pipeline: fitted pipeline (or compiled pipeline) predicting the price per m2.
+        features (list): features used by the pipeline.
+        context (dict): enrichment context (see `build_enrichment_context`).
+
+    Returns:
+        list: list of dictionaries with `valeur_m2` and total `valeur` predictions
+    """
+    records = enrich_records(pd.DataFrame.from_records(records), context)
+    # Compiled pipelines only read their input features, so records are not copied to select them
+    predictions_m2 = pipeline.predict(records if isinstance(pipeline, compiled.CompiledPipeline) else records[features])
+    predictions = predictions_m2 * records['surface_reelle_bati'].to_numpy(dtype=float)
+    return [
+        {cst.target_col: float(prediction_m2), cst.raw_target_col: float(prediction)}
+        for prediction_m2, prediction in zip(predictions_m2, predictions)
+    ]
+
+
+class MicroBatcher:
+    """Group records submitted by concurrent requests into batches scored by a single worker thread.
+    While a batch is being scored, new requests accumulate in the queue and form the next batch, so batch size grows
+    with load without delaying requests when the service is idle (unless max_wait_ms is set).
+
+    Args:
+        predict_batch (callable): function scoring a list of records and returning a list of predictions.
+        max_batch_size (int, optional): maximum number of records per batch. Defaults to cst.serving_max_batch_size.
+        max_wait_ms (float, optional): time to wait for more requests before scoring a batch. Defaults to 0.
+    """
+    def __init__(self, predict_batch, max_batch_size: int = cst.serving_max_batch_size, max_wait_ms: float = 0):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, records: list) -> Future:
+        future = Future()
+        self.queue.put((records, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            n_records = len(batch[0][0])
+            while n_records < self.max_batch_size:
+                try:
+                    item = self.queue.get(timeout=self.max_wait) if self.max_wait > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                n_records += len(item[0])
+            self.score(batch)
+
+    def score(self, batch: list):
+        try:
+            predictions = self.predict_batch([record for records, _ in batch for record in records])
+        except Exception as error:
+            if len(batch) > 1:
+                # Score the requests of the batch one at a time, so that a failing request does not fail the others
+                for item in batch:
+                    self.score([item])
+            else:
+                batch[0][1].set_exception(error)
+            return
+
+        offset = 0
+        for records, future in batch:
+            future.set_result(predictions[offset:offset + len(records)])
+            offset += len(records)
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+
+        # Invalid requests are rejected before batching, so errors while scoring are server failures
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            records = body if isinstance(body, list) else [body]
+            validate_records(records, self.server.required_columns)
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+
+        try:
+            predictions = self.server.batcher.submit(records).result()
+        except Exception as error:
+            self.send_json(500, {'error': repr(error)})
+            return
+
+        self.send_json(200, predictions if isinstance(body, list) else predictions[0])
+
+    def send_json(self, status: int, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PredictionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def create_server(pipeline, features: list, context: dict, host: str = cst.serving_host, port: int = cst.serving_port, max_batch_size: int = cst.serving_max_batch_size, max_wait_ms: float = 0) -> PredictionServer:
+    """Create the HTTP prediction server (call `serve_forever` to start it).
+
+    Args:
+        pipeline: fitted pipeline (or compiled pipeline) predicting the price per m2.
+        features (list): features used by the pipeline.
+        context (dict): enrichment context (see `build_enrichment_context`).
+        host (str, optional): host to bind. Defaults to cst.serving_host.
+        port (int, optional): port to bind (0 for any free port). Defaults to cst.serving_port.
+        max_batch_size (int, optional): maximum number of records per batch. Defaults to cst.serving_max_batch_size.
+        max_wait_ms (float, optional): time to wait for more requests before scoring a batch. Defaults to 0.
+
+    Returns:
+        PredictionServer
+    """
+    server = PredictionServer((host, port), PredictionRequestHandler)
+    server.required_columns = get_required_columns(features)
+    server.batcher = MicroBatcher(
+        lambda records: predict_records(records, pipeline, features, context), max_batch_size, max_wait_ms
+    )
+    return server
+
+
+def load_context_from_files(transports_path: str, revenus_path: str, reference_paths: list, spatial_grid_path: str = None) -> dict:
+    """Build the enrichment context from the raw transports, INSEE and DVF files (and load or build its spatial grid
+    if spatial_grid_path is set). DVF files are read by chunks of rows, keeping only IRIS codes and coordinates."""
+    transports = pd.read_csv(transports_path, sep=';')
+    revenus = pd.read_csv(revenus_path, sep=';')
+    reference_data = pd.concat([
+        prep.prepare_housing_data(chunk, is_train=False)[['code_iris', 'lat', 'lon']]
+        for path in reference_paths
+        for chunk in prep.read_raw_housing_data(path, is_train=False, chunksize=cst.preprocessing_chunk_size)
+    ])
+    return build_enrichment_context(transports, revenus, reference_data, spatial_grid_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='model artifact directory (see `src.artifacts`) or pickled pipeline (e.g. models/tuned_lgbr.sav)')
+    parser.add_argument('--features-dict', help='JSON file with the features_dict used to fit the pipeline (defaults to the input features of the model)')
+    parser.add_argument('--host', default=cst.serving_host)
+    parser.add_argument('--port', type=int, default=cst.serving_port)
+    parser.add_argument('--max-batch-size', type=int, default=cst.serving_max_batch_size)
+    parser.add_argument('--max-wait-ms', type=float, default=0)
+    parser.add_argument('--no-compile', action='store_true', help='score a pickled sklearn pipeline instead of its compiled plan')
+    parser.add_argument('--transports', default=cst.RAW_TRANSPORTS_PATH)
+    parser.add_argument('--revenus', default=cst.RAW_INSEE_PATH)
+    parser.add_argument('--reference-data', nargs='+', default=[cst.RAW_NB_TRAIN_PATH, cst.RAW_NB_TEST_PATH],
+                        help='raw DVF files used to compute IRIS centroids')
+    parser.add_argument('--spatial-grid', help='directory of the precomputed grid of station counts and IRIS revenue '
+                                               '(built if missing or outdated), used instead of exact enrichment')
+    args = parser.parse_args()
+
+    pipeline = artifacts.load_model(args.model, not args.no_compile)
+    features = artifacts.get_model_features(pipeline)
+    if args.features_dict:
+        with open(args.features_dict) as f:
+            features = pipe.get_features_from_dict(json.load(f))
+
+    context = load_context_from_files(args.transports, args.revenus, args.reference_data, args.spatial_grid)
+    server = create_server(pipeline, features, context, args.host, args.port, args.max_batch_size, args.max_wait_ms)
+    print(f'Serving predictions on http://{args.host}:{server.server_address[1]}/predict')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+def create_shared_arrays(arrays: dict) -> tuple:
+    """Copy numpy arrays into a single shared memory block, so that worker processes can read them without copies.
+    The block must be released by the caller with `close` and `unlink` once workers are done.
+
+    Args:
+        arrays (dict): dictionary of array names and numpy arrays (non-object dtypes).
+
+    Returns:
+        tuple(SharedMemory, dict): shared memory block and its layout, to pass to `attach_shared_arrays`
+    """
+    layout, n_bytes = {}, 0
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        layout[name] = (n_bytes, array.dtype.str, array.shape)
+        n_bytes += array.nbytes
+
+    block = shared_memory.SharedMemory(create=True, size=max(n_bytes, 1))
+    for name, shared_array in get_arrays_from_buffer(block.buf, layout).items():
+        shared_array[...] = arrays[name]
+    return block, layout
+
+
+def attach_shared_arrays(block_name: str, layout: dict) -> tuple:
+    """Attach to a shared memory block created with `create_shared_arrays` and get its arrays (views, no copies).
+    The block must stay referenced as long as the arrays are used.
+
+    Args:
+        block_name (str): name of the shared memory block.
+        layout (dict): layout returned by `create_shared_arrays`.
+
+    Returns:
+        tuple(SharedMemory, dict): shared memory block and dictionary of array names and arrays
+    """
+    block = shared_memory.SharedMemory(name=block_name)
+    return block, get_arrays_from_buffer(block.buf, layout)
+
+
+def get_arrays_from_buffer(buffer, layout: dict) -> dict:
+    """Get numpy views of the arrays stored in a buffer with a given layout."""
+    return {
+        name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=buffer, offset=offset)
+        for name, (offset, dtype, shape) in layout.items()
+    }
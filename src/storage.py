@@ -0,0 +1,61 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.ipc as ipc
+
+import src.pipeline as pipe
+import src.schema as schema
+
+def write_housing_data(data: pd.DataFrame, path: str):
+    """Write a preprocessed or enriched housing dataset in Feather format (uncompressed Arrow IPC file), using the
+    types of the housing data model (see `schema.apply_housing_schema`). Uncompressed files can be memory-mapped and
+    read column by column.
+
+    Args:
+        data (pd.DataFrame): housing dataset.
+        path (str): path of the feather file.
+    """
+    data = schema.apply_housing_schema(data)
+    index_name = data.index.name or 'index'
+    feather.write_feather(data.rename_axis(index_name).reset_index(), path, compression='uncompressed')
+
+
+def read_housing_data(path: str, columns: list = None, memory_map: bool = True) -> pd.DataFrame:
+    """Read a housing dataset written with `write_housing_data`.
+
+    Args:
+        path (str): path of the feather file.
+        columns (list, optional): columns to read. Defaults to None (all columns).
+        memory_map (bool, optional): map the file in memory instead of reading it. Defaults to True.
+
+    Returns:
+        pd.DataFrame: housing dataset with its original index
+    """
+    index_name = get_index_name(path)
+    if columns is not None:
+        columns = [index_name] + [col for col in columns if col != index_name]
+
+    data = feather.read_table(path, columns=columns, memory_map=memory_map).to_pandas()
+    return data.set_index(index_name)
+
+
+def read_housing_features(path: str, features_dict: dict, extra_columns: list = (), memory_map: bool = True) -> pd.DataFrame:
+    """Read only the columns used by a dictionary of feature preprocessing (see `pipeline.get_encoder`).
+
+    Args:
+        path (str): path of the feather file.
+        features_dict (dict): dictionary of feature preprocessing.
+        extra_columns (list, optional): other columns to read, e.g. the target. Defaults to ().
+        memory_map (bool, optional): map the file in memory instead of reading it. Defaults to True.
+
+    Returns:
+        pd.DataFrame: housing dataset restricted to the features and extra columns
+    """
+    features = pipe.get_features_from_dict(features_dict)
+    return read_housing_data(path, columns=features + list(extra_columns), memory_map=memory_map)
+
+
+def get_index_name(path: str) -> str:
+    """Get the name of the index column (first column) of a housing dataset written with `write_housing_data`."""
+    with pa.memory_map(path) as source:
+        return ipc.open_file(source).schema.names[0]
@@ -0,0 +1,70 @@
+"""Model artifacts saved from fitted pipelines and loaded back without the preprocessing libraries.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import json
+import pickle
+
+import numpy as np
+import pytest
+from lightgbm import LGBMRegressor
+from sklearn.linear_model import Ridge
+
+import src.artifacts as artifacts
+import src.constants as cst
+import src.pipeline as pipe
+from benchmarks import synthetic
+
+FEATURES_DICT = synthetic.FEATURES_DICT | {'target_encoded': ['type_voie']}
+
+
+@pytest.fixture(scope='module')
+def data():
+    train = synthetic.make_housing_data(2000)
+    test = synthetic.make_housing_data(500, seed=1)
+    # Categories that are not in the training set and missing values
+    test.loc[test.index[:20], 'type_voie'] = 'IMPASSE'
+    test.loc[test.index[20:40], ['commune', 'type_voie']] = None
+    test.loc[test.index[40:60], ['lat', 'nb_pieces']] = np.nan
+    return train, test
+
+
+def fit_pipeline(estimator, train):
+    features = pipe.get_features_from_dict(FEATURES_DICT)
+    pipeline = pipe.build_pipeline(estimator, FEATURES_DICT)
+    pipeline.fit(train[features], train['valeur'] / train['surface_reelle_bati'])
+    return pipeline, features
+
+
+def test_saved_artifact_reproduces_pipeline_predictions(tmp_path, data):
+    train, test = data
+    pipeline, features = fit_pipeline(LGBMRegressor(n_estimators=30, random_state=cst.random_seed, verbose=-1), train)
+
+    metadata = artifacts.save_model_artifact(pipeline, str(tmp_path / 'artifact'))
+    # Metadata is plain JSON
+    with open(tmp_path / 'artifact' / artifacts.METADATA_FILE_NAME) as f:
+        assert json.load(f)['estimator'] == metadata['estimator']
+
+    model = artifacts.load_model_artifact(str(tmp_path / 'artifact'))
+    assert artifacts.get_model_features(model) == features
+    np.testing.assert_array_equal(model.predict(test[features]), pipeline.predict(test[features]))
+    np.testing.assert_array_equal(model.predict(test[features].iloc[:1]), pipeline.predict(test[features].iloc[:1]))
+
+    # Saving again over an existing artifact replaces it
+    with open(tmp_path / 'model.sav', 'wb') as f:
+        pickle.dump(pipeline, f)
+    artifacts.save_model_artifact(pipeline, str(tmp_path / 'artifact'))
+    np.testing.assert_array_equal(
+        artifacts.load_model(str(tmp_path / 'artifact')).predict(test[features]),
+        artifacts.load_model(str(tmp_path / 'model.sav')).predict(test[features]),
+    )
+
+
+def test_artifacts_reject_unsupported_estimators_and_directories(tmp_path, data):
+    train, _ = data
+    pipeline, _ = fit_pipeline(Ridge(), train.dropna())
+
+    with pytest.raises(ValueError):
+        artifacts.save_model_artifact(pipeline, str(tmp_path / 'artifact'))
+    with pytest.raises(ValueError):
+        artifacts.load_model_artifact(str(tmp_path))
@@ -0,0 +1,77 @@
+"""Batch scoring of a raw file by chunks against one-shot scoring of the same rows with `serving.predict_records`.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from lightgbm import LGBMRegressor
+
+import src.batch_scoring as batch_scoring
+import src.compiled_pipeline as compiled
+import src.constants as cst
+import src.pipeline as pipe
+import src.preprocessing as prep
+import src.schema as schema
+import src.serving as serving
+from benchmarks import synthetic
+
+FEATURES_DICT = synthetic.FEATURES_DICT | {'target_encoded': ['type_voie']}
+
+
+@pytest.fixture(scope='module')
+def model():
+    train = synthetic.make_housing_data(2000)
+    features = pipe.get_features_from_dict(FEATURES_DICT)
+    pipeline = pipe.build_pipeline(LGBMRegressor(n_estimators=20, random_state=cst.random_seed, verbose=-1), FEATURES_DICT)
+    pipeline.fit(train[features], train['valeur'] / train['surface_reelle_bati'])
+    return pipeline, features
+
+
+@pytest.mark.parametrize('overlap', [False, True])
+@pytest.mark.parametrize('is_compiled', [False, True])
+def test_score_file_matches_predict_records(tmp_path, model, overlap, is_compiled):
+    pipeline, features = model
+    pipeline = compiled.compile_pipeline(pipeline) if is_compiled else pipeline
+    raw = synthetic.make_raw_dvf_data(700, is_train=False, seed=4)
+    # A category that only appears in the last chunk
+    raw.loc[raw.index[-10:], 'Type de voie'] = 'IMPASSE'
+    input_path, output_path = tmp_path / 'dvf_test.csv', tmp_path / 'predictions.csv'
+    raw.to_csv(input_path)
+    context = serving.build_enrichment_context(
+        synthetic.make_transports(), synthetic.make_revenus(), raw.rename(columns=cst.column_names_mapping)
+    )
+
+    report = batch_scoring.score_file(str(input_path), str(output_path), pipeline, features, context, chunksize=128, overlap=overlap)
+    predictions = pd.read_csv(output_path, index_col=0, float_precision='round_trip')
+
+    # Records of the rows kept by preprocessing, as sent to the prediction service
+    data = prep.select_housing_sales(prep.prepare_housing_data(prep.read_raw_housing_data(str(input_path), is_train=False), is_train=False))
+    records = data.astype(object).where(data.notna(), None).to_dict(orient='records')
+    expected = pd.DataFrame(serving.predict_records(records, pipeline, features, context), index=data.index)
+
+    assert report['n_rows_read'] == raw.shape[0]
+    assert report['n_rows_scored'] == data.shape[0]
+    pd.testing.assert_index_equal(predictions.index, expected.index)
+    # Predictions are written to CSV with the shortest repr of floats, which round trips
+    np.testing.assert_array_equal(predictions[cst.target_col].to_numpy(), expected[cst.target_col].to_numpy())
+    np.testing.assert_array_equal(predictions[cst.raw_target_col].to_numpy(), expected[cst.raw_target_col].to_numpy())
+
+
+def test_score_file_with_vocabulary_file(tmp_path, model):
+    pipeline, features = model
+    raw = synthetic.make_raw_dvf_data(300, is_train=False, seed=5)
+    input_path, vocabulary_path = tmp_path / 'dvf_test.csv', tmp_path / 'vocabulary.json'
+    raw.to_csv(input_path)
+    context = serving.build_enrichment_context(
+        synthetic.make_transports(), synthetic.make_revenus(), raw.rename(columns=cst.column_names_mapping)
+    )
+
+    vocabulary = prep.get_raw_housing_vocabulary([str(input_path)], is_train=False)
+    schema.write_housing_vocabulary(str(vocabulary_path), vocabulary)
+    assert schema.read_housing_vocabulary(str(vocabulary_path)) == vocabulary
+
+    batch_scoring.score_file(str(input_path), str(tmp_path / 'with_file.csv'), pipeline, features, context, chunksize=64,
+                             vocabulary=schema.read_housing_vocabulary(str(vocabulary_path)))
+    batch_scoring.score_file(str(input_path), str(tmp_path / 'without_file.csv'), pipeline, features, context, chunksize=64)
+    assert (tmp_path / 'with_file.csv').read_text() == (tmp_path / 'without_file.csv').read_text()
@@ -0,0 +1,63 @@
+"""Predictions of compiled pipelines against the fitted pipelines they are compiled from.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import numpy as np
+import pytest
+from lightgbm import LGBMRegressor
+from sklearn.linear_model import Ridge
+
+import src.compiled_pipeline as compiled
+import src.constants as cst
+import src.pipeline as pipe
+from benchmarks import synthetic
+
+FEATURES_DICT = synthetic.FEATURES_DICT | {'target_encoded': ['type_voie']}
+
+
+@pytest.fixture(scope='module')
+def data():
+    train = synthetic.make_housing_data(3000)
+    test = synthetic.make_housing_data(500, seed=1)
+
+    # Categories that are not in the training set, and missing values in every kind of column
+    test.loc[test.index[:20], 'commune'] = 'Paris 99e Arrondissement'
+    test.loc[test.index[20:40], 'district'] = 'Quartier inconnu'
+    test.loc[test.index[40:60], 'type_voie'] = 'IMPASSE'
+    test.loc[test.index[60:80], ['commune', 'type_voie']] = None
+    test.loc[test.index[80:100], ['surface_carrez_1er_lot', 'lat', 'n_metros_within_0.5km', 'nb_pieces']] = np.nan
+    return train, test
+
+
+@pytest.mark.parametrize('estimator', [
+    LGBMRegressor(n_estimators=50, random_state=cst.random_seed, verbose=-1),
+    Ridge(),
+])
+def test_compiled_predictions_match_pipeline(data, estimator):
+    train, test = data
+    features = pipe.get_features_from_dict(FEATURES_DICT)
+    pipeline = pipe.build_pipeline(estimator, FEATURES_DICT)
+    pipeline.fit(train[features], train['valeur'] / train['surface_reelle_bati'])
+    compiled_pipeline = compiled.compile_pipeline(pipeline)
+
+    # Ridge does not accept missing values, nor unseen frequency encoded categories (encoded as missing values)
+    X = test[features]
+    if isinstance(estimator, Ridge):
+        X = X.drop(test.index[20:40].append(test.index[80:100]))
+    np.testing.assert_array_equal(compiled_pipeline.predict(X), pipeline.predict(X))
+    np.testing.assert_array_equal(compiled_pipeline.predict(X.iloc[:1]), pipeline.predict(X.iloc[:1]))
+
+
+def test_compiled_pipeline_rejects_missing_frequency_encoded_values(data):
+    train, test = data
+    features = pipe.get_features_from_dict(FEATURES_DICT)
+    pipeline = pipe.build_pipeline(Ridge(), FEATURES_DICT)
+    pipeline.fit(train[features], train['valeur'] / train['surface_reelle_bati'])
+    compiled_pipeline = compiled.compile_pipeline(pipeline)
+
+    # Like the CountFrequencyEncoder of the pipeline
+    X = test[features].iloc[:5].assign(district=None)
+    with pytest.raises(ValueError):
+        pipeline.predict(X)
+    with pytest.raises(ValueError):
+        compiled_pipeline.predict(X)
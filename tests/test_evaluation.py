@@ -0,0 +1,65 @@
+"""Cross-validation of several models on shared encoded folds, in the current process and in a pool of processes.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from lightgbm import LGBMRegressor
+from sklearn.linear_model import Ridge
+
+import src.constants as cst
+import src.evaluation as evaluation
+import src.pipeline as pipe
+from benchmarks import synthetic
+
+N_SPLITS = 3
+METRIC_COLS = ['mape', 'rmse', 'mape_valeur', 'rmse_valeur']
+
+
+@pytest.fixture(scope='module')
+def data():
+    return synthetic.make_housing_data(1500)
+
+
+@pytest.fixture(scope='module')
+def models():
+    # LightGBM has a thread parameter (n_jobs), Ridge has none
+    return {
+        'lgbm': (LGBMRegressor(n_estimators=20, random_state=cst.random_seed, verbose=-1), synthetic.FEATURES_DICT),
+        'ridge': (Ridge(), synthetic.FEATURES_DICT),
+    }
+
+
+def test_set_thread_params_only_sets_existing_params():
+    assert evaluation.set_thread_params(LGBMRegressor(), 2).get_params()['n_jobs'] == 2
+    assert evaluation.set_thread_params(Ridge(), 2).get_params() == Ridge().get_params()
+
+
+def test_cross_validate_models_reports_both_targets(data, models):
+    results = evaluation.cross_validate_models(models, data, n_splits=N_SPLITS, n_workers=1, threads_per_task=1)
+
+    assert results[['model', 'fold']].to_dict(orient='list') == {
+        'model': ['lgbm'] * N_SPLITS + ['ridge'] * N_SPLITS, 'fold': list(range(N_SPLITS)) * 2
+    }
+    assert np.isfinite(results[METRIC_COLS].to_numpy()).all()
+
+    # Ridge fitted on the encoded fold gives the metrics of the whole pipeline fitted on the rows of the fold
+    train_positions, test_positions = evaluation.get_cv_folds(data.shape[0], N_SPLITS)[0]
+    train, test = data.iloc[train_positions], data.iloc[test_positions]
+    features = pipe.get_features_from_dict(synthetic.FEATURES_DICT)
+    pipeline = pipe.build_pipeline(Ridge(), synthetic.FEATURES_DICT)
+    pipeline.fit(train[features], train[cst.raw_target_col] / train['surface_reelle_bati'])
+    predictions = pipeline.predict(test[features]) * test['surface_reelle_bati']
+
+    ridge = results[(results['model'] == 'ridge') & (results['fold'] == 0)].iloc[0]
+    expected = evaluation.evaluate_model(pipeline, test[features], test[cst.raw_target_col] / test['surface_reelle_bati'])
+    np.testing.assert_allclose([ridge['mape'], ridge['rmse']], [expected['mape'], expected['rmse']])
+    np.testing.assert_allclose(ridge['rmse_valeur'], np.sqrt(np.mean((predictions - test[cst.raw_target_col]) ** 2)))
+
+
+def test_cross_validation_in_processes_matches_current_process(data, models):
+    # Tasks run in the pool with `run_cv_task`, on the encoded folds sent once to each worker
+    sequential = evaluation.cross_validate_models(models, data, n_splits=N_SPLITS, n_workers=1, threads_per_task=1)
+    parallel = evaluation.cross_validate_models(models, data, n_splits=N_SPLITS, n_workers=2, threads_per_task=1)
+    pd.testing.assert_frame_equal(parallel[['model', 'fold'] + METRIC_COLS], sequential[['model', 'fold'] + METRIC_COLS])
@@ -0,0 +1,49 @@
+"""Closest available IRIS zones against a brute-force argmin of geopy distances, and IRIS codes that are missing.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import numpy as np
+import pandas as pd
+from geopy import distance
+
+import src.constants as cst
+import src.external_data.external_insee_data as ext_insee
+
+
+def make_centroids(codes: np.ndarray, rng: np.random.Generator) -> pd.DataFrame:
+    """Random IRIS centroids in Paris, indexed by IRIS code."""
+    return pd.DataFrame({'lat': rng.uniform(48.82, 48.90, len(codes)), 'lon': rng.uniform(2.25, 2.42, len(codes))}, index=codes)
+
+
+def test_closest_iris_zone_matches_geopy_argmin():
+    rng = np.random.default_rng(cst.random_seed)
+    mapped = make_centroids(np.arange(751010101, 751010301), rng)
+    non_mapped = make_centroids(np.arange(751020101, 751020181), rng)
+    # Centroids very close to an available zone, where haversine and geodesic distances could disagree
+    non_mapped.iloc[:5] = mapped.iloc[:5].to_numpy() + 1e-6
+
+    closest_iris = ext_insee.get_closest_iris_zone_from_coordinates(mapped, non_mapped)
+
+    expected = {}
+    for code, (lat, lon) in non_mapped.iterrows():
+        distances = [distance.distance((lat, lon), (mapped_lat, mapped_lon)).km for mapped_lat, mapped_lon in mapped.to_numpy()]
+        expected[code] = mapped.index[np.argmin(distances)]
+    assert closest_iris == expected
+
+
+def test_closest_iris_zone_ignores_missing_codes(tmp_path):
+    rng = np.random.default_rng(cst.random_seed)
+    codes = np.arange(751010101, 751010131)
+    revenus = pd.DataFrame({'IRIS': codes[::2].astype(str), 'DISP_MED18': rng.uniform(15000, 40000, len(codes[::2]))})
+    train = make_centroids(rng.choice(codes, 100), rng).rename_axis('code_iris').reset_index()
+    test = make_centroids(rng.choice(codes, 30), rng).rename_axis('code_iris').reset_index()
+    # Codes that are not numeric are converted to missing values (see `schema.to_iris_codes`)
+    train['code_iris'] = train['code_iris'].astype(float)
+    train.loc[:9, 'code_iris'] = np.nan
+
+    mapped, non_mapped = ext_insee.get_iris_codes(train, test, revenus)
+    assert not pd.isna(mapped + non_mapped).any()
+
+    closest_iris = ext_insee.get_closest_iris_zone_to_missing_codes(train, test, revenus)
+    assert closest_iris == ext_insee.get_closest_iris_zone_to_missing_codes_with_cache(train, test, revenus, str(tmp_path))
+    assert set(closest_iris) == set(non_mapped)
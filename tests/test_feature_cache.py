@@ -0,0 +1,89 @@
+"""Cached station counts and closest IRIS zones against the same features computed without the feature cache.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import numpy as np
+import pandas as pd
+
+import src.constants as cst
+import src.instrumentation as instrumentation
+import src.external_data.external_geo_data as ext_geo
+import src.external_data.external_insee_data as ext_insee
+
+
+def make_points(n_points: int, rng: np.random.Generator) -> tuple:
+    """Random points in Paris."""
+    return rng.uniform(48.82, 48.90, n_points), rng.uniform(2.25, 2.42, n_points)
+
+
+def make_transports(n_stations: int, rng: np.random.Generator) -> pd.DataFrame:
+    lat, lon = make_points(n_stations, rng)
+    transports = pd.DataFrame({
+        'nom_long': [f'Station {i}' for i in range(n_stations)],
+        'Geo Point': [f'{station_lat}, {station_lon}' for station_lat, station_lon in zip(lat, lon)],
+        'fer': 0,
+        'train': rng.integers(0, 2, n_stations),
+        'rer': rng.integers(0, 2, n_stations),
+        'metro': rng.integers(0, 3, n_stations),
+    })
+    return ext_geo.get_transportation_count_per_station(transports)
+
+
+def make_iris_rows(n_rows: int, codes: np.ndarray, rng: np.random.Generator) -> pd.DataFrame:
+    lat, lon = make_points(n_rows, rng)
+    return pd.DataFrame({'code_iris': rng.choice(codes, n_rows), 'lat': lat, 'lon': lon})
+
+
+def count_close_stations_with_cache(units_lat: np.ndarray, units_lon: np.ndarray, transports: pd.DataFrame, cache_dir: str) -> tuple:
+    with instrumentation.instrument(modules=[]) as trace:
+        n_transports = ext_geo.count_close_stations_housing_units_with_cache(
+            units_lat, units_lon, transports, ext_geo.build_station_index(transports), cst.short_distance_station, cache_dir
+        )
+    return n_transports, trace.counters
+
+
+def test_station_counts_cache_computes_only_unseen_coordinates(tmp_path):
+    rng = np.random.default_rng(cst.random_seed)
+    transports = make_transports(200, rng)
+    units_lat, units_lon = make_points(300, rng)
+    # Duplicated coordinates are computed once
+    units_lat, units_lon = np.concatenate([units_lat, units_lat[:50]]), np.concatenate([units_lon, units_lon[:50]])
+    delta_lat, delta_lon = make_points(7, rng)
+
+    _, counters = count_close_stations_with_cache(units_lat, units_lon, transports, str(tmp_path))
+    assert counters['station_count_cache_misses'] == 300
+    assert counters['station_count_cache_hits'] == 0
+
+    all_lat, all_lon = np.concatenate([units_lat, delta_lat]), np.concatenate([units_lon, delta_lon])
+    n_transports, counters = count_close_stations_with_cache(all_lat, all_lon, transports, str(tmp_path))
+    assert counters['station_count_cache_misses'] == 7
+    assert counters['station_count_cache_hits'] == 300
+
+    expected = ext_geo.count_close_stations_housing_units(
+        all_lat, all_lon, transports, ext_geo.build_station_index(transports), cst.short_distance_station
+    )
+    for key in ['n_metros', 'n_trains']:
+        np.testing.assert_array_equal(n_transports[key], expected[key])
+
+    # The delta is appended in new files, previous files are left untouched
+    _, counters = count_close_stations_with_cache(delta_lat, delta_lon, transports, str(tmp_path))
+    assert counters['station_count_cache_hits'] == 7
+    assert 'station_count_cache_misses' not in counters or counters['station_count_cache_misses'] == 0
+
+
+def test_closest_iris_cache_matches_uncached_zones_as_rows_are_added(tmp_path):
+    rng = np.random.default_rng(cst.random_seed)
+    codes = np.arange(751010101, 751010161)
+    revenus = pd.DataFrame({'IRIS': codes[::3].astype(str), 'DISP_MED18': rng.uniform(15000, 40000, len(codes[::3]))})
+    train, test = make_iris_rows(200, codes, rng), make_iris_rows(50, codes, rng)
+
+    for n_new_rows in [0, 5, 30]:
+        train = pd.concat([train, make_iris_rows(n_new_rows, codes, rng)], ignore_index=True)
+        with instrumentation.instrument(modules=[]) as trace:
+            cached = ext_insee.get_closest_iris_zone_to_missing_codes_with_cache(train, test, revenus, str(tmp_path))
+        assert cached == ext_insee.get_closest_iris_zone_to_missing_codes(train, test, revenus)
+        if n_new_rows == 0:
+            assert trace.counters['closest_iris_cache_misses'] == len(cached)
+        else:
+            # Moved centroids are looked up again, the other codes reuse the cache
+            assert trace.counters['closest_iris_cache_hits'] > 0
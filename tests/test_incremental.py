@@ -0,0 +1,47 @@
+"""Incremental updates of a fitted pipeline with new rows from the same distribution as its training rows.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import pytest
+from lightgbm import LGBMRegressor
+
+import src.constants as cst
+import src.incremental as incremental
+import src.pipeline as pipe
+from benchmarks import synthetic
+
+FEATURES_DICT = synthetic.FEATURES_DICT | {'target_encoded': ['type_voie']}
+# Relative holdout RMSE increase tolerated for an update on rows from the same distribution
+RMSE_TOLERANCE = 0.02
+
+
+def get_target(data):
+    return data['valeur'] / data['surface_reelle_bati']
+
+
+@pytest.fixture(scope='module')
+def model():
+    train = synthetic.make_housing_data(3000)
+    features = pipe.get_features_from_dict(FEATURES_DICT)
+    pipeline = pipe.build_pipeline(LGBMRegressor(n_estimators=100, random_state=cst.random_seed, verbose=-1), FEATURES_DICT)
+    pipeline.fit(train[features], get_target(train))
+    incremental.init_incremental_stats(pipeline, train[features], get_target(train))
+    return pipeline, features
+
+
+@pytest.mark.parametrize('update_preprocessing', [False, True])
+def test_update_on_same_distribution_does_not_degrade_holdout(model, update_preprocessing):
+    pipeline, features = model
+    new, holdout = synthetic.make_housing_data(1000, seed=1), synthetic.make_housing_data(1000, seed=2)
+
+    updated_pipeline, report = incremental.retrain_incrementally(
+        pipeline, new[features], get_target(new), holdout[features], get_target(holdout), update_preprocessing=update_preprocessing
+    )
+
+    assert report['rmse_change'] <= RMSE_TOLERANCE
+    assert not report['is_drifting']
+    assert updated_pipeline.named_steps['estimator'].booster_.num_trees() == 100 + cst.incremental_n_estimators
+    # The learning rate of the estimator is restored after the update
+    assert updated_pipeline.named_steps['estimator'].learning_rate == pipeline.named_steps['estimator'].learning_rate
+    # The pipeline it was updated from is left untouched
+    assert pipeline.named_steps['estimator'].booster_.num_trees() == 100
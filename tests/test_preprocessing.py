@@ -0,0 +1,33 @@
+"""Preprocessing of raw DVF files by chunks of rows against the preprocessing of the whole file in memory.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import pandas as pd
+import pytest
+
+import src.preprocessing as prep
+import src.schema as schema
+from benchmarks import synthetic
+
+
+@pytest.mark.parametrize('is_train', [True, False])
+def test_preprocess_housing_data_in_chunks_matches_in_memory(tmp_path, is_train):
+    raw = synthetic.make_raw_dvf_data(300, is_train=is_train, seed=2)
+    # A category that only appears in the last chunk
+    raw.loc[raw.index[-10:], 'Type de voie'] = 'IMPASSE'
+    raw_path, output_path = tmp_path / 'raw.csv', tmp_path / 'preprocessed.csv'
+    raw.to_csv(raw_path)
+
+    n_rows = prep.preprocess_housing_data_in_chunks(str(raw_path), str(output_path), is_train, chunksize=64)
+
+    expected = prep.preprocess_housing_data(prep.prepare_housing_data(prep.read_raw_housing_data(str(raw_path), is_train), is_train), is_train)
+    assert n_rows == expected.shape[0]
+    assert output_path.read_text() == expected.to_csv(index=True)
+
+    vocabulary = prep.get_raw_housing_vocabulary([str(raw_path)], is_train, chunksize=64)
+    assert 'IMPASSE' in vocabulary['type_voie'].categories
+    assert vocabulary == schema.get_housing_vocabulary(expected)
+
+    # Every chunk is cast with the categories of the whole file
+    chunk = prep.preprocess_housing_data(prep.prepare_housing_data(raw.iloc[:64].rename_axis(None), is_train), is_train, vocabulary)
+    assert chunk['type_voie'].dtype == expected['type_voie'].dtype
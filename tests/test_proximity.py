@@ -0,0 +1,166 @@
+"""Proximity features and station counts against a brute-force filter on geopy distances, as computed before the
+spatial index, and parallel station counts against sequential ones.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import pytest
+from geopy import distance
+
+import src.constants as cst
+import src.shared_arrays as shared_arrays
+import src.external_data.external_geo_data as ext_geo
+import src.external_data.proximity as proximity
+
+RADII = [0.25, 0.5, 1.0]
+
+
+def make_points(n_points: int, rng: np.random.Generator) -> tuple:
+    """Random points in Paris."""
+    return rng.uniform(48.82, 48.90, n_points), rng.uniform(2.25, 2.42, n_points)
+
+
+def make_boundary_points(units_lat: np.ndarray, units_lon: np.ndarray, radii: list, rng: np.random.Generator) -> tuple:
+    """Points whose geodesic distance to a unit is within `haversine_max_relative_error` of a radius (and within a
+    nanometer of it), where haversine distances alone cannot tell whether they are within the radius."""
+    relative_offsets = np.concatenate([np.linspace(-1, 1, 9) * cst.haversine_max_relative_error, [-1e-7, -1e-9, 0, 1e-9, 1e-7]])
+    points = []
+    for unit_lat, unit_lon in zip(units_lat, units_lon):
+        for radius in radii:
+            for relative_offset in relative_offsets:
+                point = distance.geodesic(kilometers=radius * (1 + relative_offset)).destination(
+                    (unit_lat, unit_lon), bearing=rng.uniform(0, 360)
+                )
+                points.append((point.latitude, point.longitude))
+    points = np.array(points)
+    return points[:, 0], points[:, 1]
+
+
+def get_geodesic_distance_matrix(units_lat: np.ndarray, units_lon: np.ndarray, points_lat: np.ndarray, points_lon: np.ndarray) -> np.ndarray:
+    return np.array([
+        [distance.geodesic((point_lat, point_lon), (unit_lat, unit_lon)).km for point_lat, point_lon in zip(points_lat, points_lon)]
+        for unit_lat, unit_lon in zip(units_lat, units_lon)
+    ])
+
+
+def count_close_stations(units_lat: np.ndarray, units_lon: np.ndarray, transports: pd.DataFrame, radius: float) -> dict:
+    return ext_geo.count_close_stations_housing_units(units_lat, units_lon, transports, ext_geo.build_station_index(transports), radius)
+
+
+@pytest.fixture(scope='module')
+def pois():
+    rng = np.random.default_rng(cst.random_seed)
+    units_lat, units_lon = make_points(40, rng)
+    boundary_lat, boundary_lon = make_boundary_points(units_lat[:10], units_lon[:10], RADII, rng)
+    random_lat, random_lon = make_points(200, rng)
+
+    lat, lon = np.concatenate([boundary_lat, random_lat]), np.concatenate([boundary_lon, random_lon])
+    kinds = rng.choice(['stations', 'schools'], len(lat))
+    tables = {
+        kind: pd.DataFrame({'lat': lat[kinds == kind], 'lon': lon[kinds == kind]})
+        for kind in ['stations', 'schools']
+    }
+    tables['stations']['lines'] = rng.integers(1, 4, tables['stations'].shape[0])
+    distances = {
+        kind: get_geodesic_distance_matrix(units_lat, units_lon, table['lat'], table['lon']) for kind, table in tables.items()
+    }
+    return units_lat, units_lon, tables, distances
+
+
+@pytest.fixture(scope='module')
+def stations():
+    rng = np.random.default_rng(cst.random_seed)
+    units_lat, units_lon = make_points(40, rng)
+    boundary_lat, boundary_lon = make_boundary_points(units_lat[:10], units_lon[:10], RADII, rng)
+    random_lat, random_lon = make_points(100, rng)
+    lat, lon = np.concatenate([boundary_lat, random_lat]), np.concatenate([boundary_lon, random_lon])
+
+    # Raw IDF Mobilités rows, one per station
+    transports = pd.DataFrame({
+        'nom_long': [f'Station {i}' for i in range(len(lat))],
+        'Geo Point': [f'{station_lat}, {station_lon}' for station_lat, station_lon in zip(lat, lon)],
+        'fer': 0,
+        'train': rng.integers(0, 2, len(lat)),
+        'rer': rng.integers(0, 2, len(lat)),
+        'metro': rng.integers(0, 3, len(lat)),
+    })
+    transports = ext_geo.get_transportation_count_per_station(transports)
+    # Stations are sorted by name when grouped, so distances are computed in the same order
+    station_coordinates = transports['Geo Point'].str.split(',', expand=True).astype(float).to_numpy()
+    distances = get_geodesic_distance_matrix(units_lat, units_lon, station_coordinates[:, 0], station_coordinates[:, 1])
+    return units_lat, units_lon, transports, distances
+
+
+def test_count_close_stations_matches_geopy_filter(stations):
+    units_lat, units_lon, transports, distances = stations
+
+    # Boundary points make the test meaningful: some pairs lie in the error band of the haversine distance
+    assert any(np.any(np.abs(distances - radius) <= radius * cst.haversine_max_relative_error) for radius in RADII)
+    for radius in RADII:
+        n_transports = count_close_stations(units_lat, units_lon, transports, radius)
+        within = distances <= radius
+        np.testing.assert_array_equal(n_transports['n_metros'], within @ transports['metro'].to_numpy())
+        np.testing.assert_array_equal(n_transports['n_trains'], within @ (transports['train'] + transports['rer']).to_numpy())
+
+
+def test_compute_proximity_features_matches_geopy_filter(pois):
+    units_lat, units_lon, tables, distances = pois
+    features = proximity.compute_proximity_features(
+        units_lat, units_lon, proximity.build_proximity_index(tables), RADII, nearest=False, report_progress=False
+    )
+
+    for radius in RADII:
+        for kind in tables:
+            np.testing.assert_array_equal(features[f'n_{kind}_within_{radius}km'], (distances[kind] <= radius).sum(axis=1))
+        np.testing.assert_array_equal(
+            features[f'n_lines_within_{radius}km'], (distances['stations'] <= radius) @ tables['stations']['lines'].to_numpy()
+        )
+
+
+def test_compute_proximity_features_nearest_distances(pois):
+    units_lat, units_lon, tables, _ = pois
+    features = proximity.compute_proximity_features(
+        units_lat, units_lon, proximity.build_proximity_index(tables), [0.1], report_progress=False
+    )
+
+    for kind, table in tables.items():
+        lat1, lon1 = np.radians(units_lat)[:, None], np.radians(units_lon)[:, None]
+        lat2, lon2 = np.radians(table['lat'].to_numpy())[None, :], np.radians(table['lon'].to_numpy())[None, :]
+        haversine = 2 * cst.earth_radius_km * np.arcsin(np.sqrt(
+            np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        ))
+        np.testing.assert_allclose(features[f'distance_to_nearest_{kind}_km'], haversine.min(axis=1), rtol=1e-9)
+
+
+def test_count_close_stations_in_parallel_matches_sequential(stations, monkeypatch):
+    units_lat, units_lon, transports, _ = stations
+    # Several partitions per worker, whose counts are written back in the original order of the units
+    monkeypatch.setattr(cst, 'distance_chunk_size', 4)
+    for radius in RADII:
+        n_transports = ext_geo.count_close_stations_housing_units_in_parallel(units_lat, units_lon, transports, radius, n_workers=2)
+        expected = count_close_stations(units_lat, units_lon, transports, radius)
+        for key in ['n_metros', 'n_trains']:
+            np.testing.assert_array_equal(n_transports[key], expected[key])
+
+
+def test_count_close_stations_in_parallel_releases_shared_memory_on_error(stations, monkeypatch):
+    units_lat, units_lon, transports, _ = stations
+    blocks = []
+    create_shared_arrays = shared_arrays.create_shared_arrays
+
+    def create_recorded_shared_arrays(arrays):
+        block, layout = create_shared_arrays(arrays)
+        blocks.append(block.name)
+        return block, layout
+
+    monkeypatch.setattr(shared_arrays, 'create_shared_arrays', create_recorded_shared_arrays)
+    # Workers fail on an invalid radius
+    with pytest.raises(TypeError):
+        ext_geo.count_close_stations_housing_units_in_parallel(units_lat, units_lon, transports, 'invalid', n_workers=2)
+
+    assert len(blocks) == 1
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=blocks[0])
@@ -0,0 +1,42 @@
+"""Housing data model: coordinates keep the station counts of the raw coordinates, in memory and through CSV files.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import numpy as np
+import pandas as pd
+from geopy import distance
+
+import src.constants as cst
+import src.schema as schema
+import src.external_data.external_geo_data as ext_geo
+from benchmarks import synthetic
+
+
+def count_close_stations(data: pd.DataFrame, transports: pd.DataFrame) -> dict:
+    return ext_geo.count_close_stations_housing_units(
+        data['lat'].to_numpy(dtype=float), data['lon'].to_numpy(dtype=float), transports,
+        ext_geo.build_station_index(transports), cst.short_distance_station
+    )
+
+
+def test_schema_keeps_station_counts_of_raw_coordinates(tmp_path):
+    rng = np.random.default_rng(cst.random_seed)
+    transports = ext_geo.get_transportation_count_per_station(synthetic.make_transports(50))
+
+    # Units a few centimeters inside and outside the radius of a station
+    units = []
+    for station_lat, station_lon in transports[['station_lat', 'station_lon']].to_numpy()[:20]:
+        for offset_km in [-5e-5, -1e-5, 1e-5, 5e-5]:
+            point = distance.distance(kilometers=cst.short_distance_station + offset_km).destination((station_lat, station_lon), rng.uniform(0, 360))
+            units.append((point.latitude, point.longitude))
+    data = synthetic.make_housing_data(len(units)).assign(lat=[lat for lat, _ in units], lon=[lon for _, lon in units])
+    expected = count_close_stations(data, transports)
+
+    typed_data = schema.apply_housing_schema(data)
+    typed_data.to_csv(tmp_path / 'data.csv')
+    read_data = schema.apply_housing_schema(pd.read_csv(tmp_path / 'data.csv', index_col=0))
+    np.testing.assert_array_equal(typed_data[['lat', 'lon']].to_numpy(), data[['lat', 'lon']].to_numpy())
+    for typed in [typed_data, read_data]:
+        n_transports = count_close_stations(typed, transports)
+        for key in ['n_metros', 'n_trains']:
+            np.testing.assert_array_equal(n_transports[key], expected[key])
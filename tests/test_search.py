@@ -0,0 +1,44 @@
+"""Parallel hyperparameter search resumed from its trial store after an interruption.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import json
+
+from sklearn.linear_model import Ridge
+
+import src.search as search
+from benchmarks import synthetic
+
+
+def read_store_lines(store_path) -> list:
+    return store_path.read_text().splitlines()
+
+
+def test_search_resumes_from_a_truncated_store(tmp_path):
+    train, test = synthetic.make_housing_data(2000), synthetic.make_housing_data(200, seed=1)
+    features_dict = synthetic.FEATURES_DICT
+    X_train, y_train = train, train['valeur'] / train['surface_reelle_bati']
+    X_test, y_test = test, test['valeur'] / test['surface_reelle_bati']
+    store_path = tmp_path / 'trials.jsonl'
+
+    def run_search(param_samples):
+        return search.run_parallel_search(
+            Ridge(), param_samples, features_dict, X_train, y_train, X_test, y_test, str(store_path), n_workers=1, threads_per_trial=1
+        )
+
+    param_samples = [{'alpha': alpha} for alpha in [0.1, 1.0, 10.0]]
+    results = run_search(param_samples)
+    lines = read_store_lines(store_path)
+    assert len(lines) == 3
+
+    # Interrupted while writing the last trial
+    truncated_trial = json.loads(lines[-1])
+    store_path.write_text('\n'.join(lines[:-1]) + '\n' + lines[-1][:len(lines[-1]) // 2])
+
+    resumed_results = run_search(param_samples + [{'estimator__alpha': 100.0}])
+    new_lines = read_store_lines(store_path)[len(lines):]
+    # Only the truncated trial and the new trial are run, each on a line of its own
+    assert sorted(json.loads(line)['params']['alpha'] for line in new_lines) == [truncated_trial['params']['alpha'], 100.0]
+    assert len(resumed_results) == 4
+    assert set(results['trial_id']) < set(resumed_results['trial_id'])
+    assert resumed_results.set_index('trial_id').loc[results['trial_id'], 'rmse'].tolist() == results['rmse'].tolist()
@@ -0,0 +1,118 @@
+"""Prediction service in process: enrichment lookups, HTTP responses and isolation of failing requests in batches.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import http.client
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+from lightgbm import LGBMRegressor
+
+import src.compiled_pipeline as compiled
+import src.constants as cst
+import src.pipeline as pipe
+import src.serving as serving
+from benchmarks import synthetic
+
+
+@pytest.fixture(scope='module')
+def model():
+    train = synthetic.make_housing_data(2000)
+    features = pipe.get_features_from_dict(synthetic.FEATURES_DICT)
+    pipeline = pipe.build_pipeline(LGBMRegressor(n_estimators=20, random_state=cst.random_seed, verbose=-1), synthetic.FEATURES_DICT)
+    pipeline.fit(train[features], train['valeur'] / train['surface_reelle_bati'])
+
+    reference_data = synthetic.make_raw_dvf_data(2000, is_train=False).rename(columns=cst.column_names_mapping)
+    context = serving.build_enrichment_context(synthetic.make_transports(), synthetic.make_revenus(), reference_data)
+    return compiled.compile_pipeline(pipeline), features, context
+
+
+@pytest.fixture(scope='module')
+def server(model):
+    pipeline, features, context = model
+    server = serving.create_server(pipeline, features, context, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body) -> tuple:
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        connection.request('POST', '/predict', body=json.dumps(body), headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_get_iris_revenue_matches_dictionary_lookup(model):
+    _, _, context = model
+    known_codes = list(context['iris_revenue'])[:5]
+    records = pd.DataFrame({'code_iris': [float(known_codes[0]), known_codes[1], str(known_codes[2]), np.nan, 'invalid', 1]})
+    units_lat, units_lon = np.full(records.shape[0], 48.85), np.full(records.shape[0], 2.35)
+
+    revenue = serving.get_iris_revenue(records, units_lat, units_lon, context)
+    np.testing.assert_array_equal(revenue[:3], [context['iris_revenue'][code] for code in known_codes[:3]])
+    # Missing, invalid and unknown codes get the revenue of the zone with the closest centroid
+    closest_positions, _ = serving.spatial_index.query_nearest(context['iris_index'], units_lat[3:], units_lon[3:])
+    np.testing.assert_array_equal(revenue[3:], context['iris_index_revenue'][closest_positions[:, 0]])
+
+
+def test_server_scores_a_batch_of_records(server, model):
+    pipeline, features, context = model
+    records = synthetic.make_records(5, seed=3)
+
+    status, predictions = post(server, records)
+    assert status == 200
+    assert predictions == serving.predict_records(records, pipeline, features, context)
+
+    status, prediction = post(server, records[0])
+    assert status == 200
+    assert prediction == predictions[0]
+
+
+def test_server_rejects_malformed_records(server):
+    records = synthetic.make_records(2, seed=3)
+    del records[1]['lat']
+
+    status, content = post(server, records)
+    assert status == 400
+    assert 'lat' in content['error']
+
+    status, content = post(server, [])
+    assert status == 400
+
+
+def test_micro_batcher_isolates_failing_requests():
+    is_scoring, release = threading.Event(), threading.Event()
+    batches = []
+
+    def predict_batch(records):
+        batches.append(list(records))
+        if len(batches) == 1:
+            # Block the worker so that the next requests are queued and batched together
+            is_scoring.set()
+            release.wait()
+        if 'invalid' in records:
+            raise ValueError('invalid record')
+        return [record * 2 for record in records]
+
+    batcher = serving.MicroBatcher(predict_batch, max_batch_size=10)
+    first = batcher.submit([1])
+    assert is_scoring.wait(timeout=10)
+    futures = [batcher.submit([2, 3]), batcher.submit(['invalid']), batcher.submit([4])]
+    release.set()
+
+    assert first.result(timeout=10) == [2]
+    assert futures[0].result(timeout=10) == [4, 6]
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=10)
+    assert futures[2].result(timeout=10) == [8]
+    # The failing batch is scored again one request at a time
+    assert batches[1:] == [[2, 3, 'invalid', 4], [2, 3], ['invalid'], [4]]